@@ -1,30 +1,378 @@
+import os
+import sys
+import time
+import shlex
+import signal
+import selectors
 import subprocess
+import threading
+from collections import deque
+
+from kubeb import tracing
+
+
+class CommandResult(object):
+
+    def __init__(self, command, exitcode, output, error, duration, timed_out=False, cancelled=False,
+                 output_bytes=0):
+        self.command = command
+        self.exitcode = exitcode
+        self.output = output
+        self.error = error
+        self.duration = duration
+        self.timed_out = timed_out
+        self.cancelled = cancelled
+        self.output_bytes = output_bytes
+
+    @property
+    def ok(self):
+        return self.exitcode == 0
+
+    def __iter__(self):
+        # keep `status, output, error = Command(...).execute()` working
+        return iter((self.exitcode, self.output, self.error))
+
+    def __repr__(self):
+        return '<CommandResult {!r} exitcode={} duration={:.2f}s>'.format(
+            self.command, self.exitcode, self.duration)
+
+
+class _Stream(object):
+
+    def __init__(self, name, echo, keep, capture, on_line=None):
+        self.name = name
+        self.echo = echo
+        self.on_line = on_line
+        self.lines = deque(maxlen=None if capture else keep)
+        self.size = 0
+        self._partial = b''
+
+    def feed(self, data):
+        self.size += len(data)
+        data = self._partial + data
+        lines = data.split(b'\n')
+        self._partial = lines.pop()
+        for line in lines:
+            self._add(line)
+
+    def close(self):
+        if self._partial:
+            self._add(self._partial)
+            self._partial = b''
+
+    def _add(self, line):
+        text = line.decode('utf8', errors='replace').rstrip('\r')
+        self.lines.append(text)
+        if self.on_line is not None:
+            self.on_line(self.name, text)
+        if self.echo is not None:
+            print(text, file=self.echo)
+            self.echo.flush()
+
+    def text(self):
+        if not self.lines:
+            return ''
+        return '\n'.join(self.lines) + '\n'
 
 
 class Command(object):
+    """Run an external command, streaming stdout and stderr as it runs.
+
+    `command` may be an argv list or a string; strings are split with shlex
+    unless `shell=True`. Output is kept in bounded tails of `tail` lines per
+    stream unless `capture=True`, and the process is terminated once
+    `timeout` seconds have passed, `cancel()` is called or `cancel_event`
+    is set. `stdin` may be an open file or str/bytes data to feed to the
+    process through a pipe, and `on_line(stream, line)` is called for every
+    output line.
+    """
 
-    def __init__(self, command):
+    kill_grace_period = 5
+
+    def __init__(self, command, timeout=None, tail=200, cancel_event=None, stdin=None):
         self._command = command
+        self._stdin = stdin
+        self._timeout = timeout
+        self._tail = tail
+        self._cancel_event = cancel_event
+        self._process = None
+        self._cancelled = threading.Event()
+
+    def execute(self, shell=False, executable=None, printout=True):
+        return self.run(shell=shell, executable=executable, printout=printout, capture=not printout)
+
+    def run(self, shell=False, executable=None, printout=True, capture=False, on_line=None):
+        command = self._command
+        if not shell and isinstance(command, str):
+            command = shlex.split(command)
+        if shell and not isinstance(command, str):
+            command = ' '.join(shlex.quote(arg) for arg in command)
+
+        argv = command.split() if isinstance(command, str) else command
+        with tracing.span(' '.join([os.path.basename(argv[0])] + list(argv[1:2])), 'subprocess') as span:
+            result = self._call(command, shell=shell, executable=executable, printout=printout, capture=capture,
+                                on_line=on_line)
+            span.set(exitcode=result.exitcode, output_bytes=result.output_bytes)
+            if result.timed_out:
+                span.set(timed_out=True)
+            if result.cancelled:
+                span.set(cancelled=True)
+        return result
+
+    async def run_async(self, printout=True, capture=False, on_line=None):
+        """run() for asyncio code, the process is started with asyncio.create_subprocess_exec.
+
+        Cancelling the awaiting task terminates the process.
+        """
+        command = self._command
+        if isinstance(command, str):
+            command = shlex.split(command)
+
+        with tracing.span(' '.join([os.path.basename(command[0])] + list(command[1:2])), 'subprocess') as span:
+            result = await self._call_async(command, printout=printout, capture=capture, on_line=on_line)
+            span.set(exitcode=result.exitcode, output_bytes=result.output_bytes)
+            if result.timed_out:
+                span.set(timed_out=True)
+            if result.cancelled:
+                span.set(cancelled=True)
+        return result
+
+    def cancel(self):
+        self._cancelled.set()
+        self._terminate()
+
+    def _terminate(self):
+        process = self._process
+        if process is None or process.poll() is not None:
+            return
+
+        try:
+            process.send_signal(signal.SIGTERM)
+            process.wait(self.kill_grace_period)
+        except subprocess.TimeoutExpired:
+            process.kill()
+        except OSError:
+            pass
+
+    @staticmethod
+    def _feed(pipe, data):
+        try:
+            pipe.write(data)
+        except OSError:
+            # child exited without reading everything
+            pass
+        finally:
+            try:
+                pipe.close()
+            except OSError:
+                pass
+
+    def _call(self, command, shell=False, executable=None, printout=True, capture=False, on_line=None):
+        start = time.monotonic()
+        deadline = start + self._timeout if self._timeout else None
+
+        stdin = self._stdin
+        stdin_data = None
+        if isinstance(stdin, (str, bytes)):
+            stdin_data = stdin.encode('utf8') if isinstance(stdin, str) else stdin
+            stdin = subprocess.PIPE
+        elif stdin is None:
+            stdin = subprocess.DEVNULL
+
+        try:
+            self._process = subprocess.Popen(command,
+                                             stdin=stdin,
+                                             stdout=subprocess.PIPE,
+                                             stderr=subprocess.PIPE,
+                                             shell=shell,
+                                             executable=executable)
+        except OSError as e:
+            return CommandResult(command, 127, '', str(e) + '\n', time.monotonic() - start)
+
+        process = self._process
+        if stdin_data is not None:
+            # written from a thread so a child that fills its output pipes first can't deadlock us
+            threading.Thread(target=self._feed, args=(process.stdin, stdin_data), daemon=True).start()
+        if self._cancel_event is not None and self._cancel_event.is_set():
+            self._cancelled.set()
+        if self._cancelled.is_set():
+            self._terminate()
+
+        streams = {
+            process.stdout: _Stream('stdout', sys.stdout if printout else None, self._tail, capture, on_line),
+            process.stderr: _Stream('stderr', sys.stderr if printout else None, self._tail, capture, on_line),
+        }
+
+        timed_out = False
+        try:
+            with selectors.DefaultSelector() as selector:
+                for pipe in streams:
+                    selector.register(pipe, selectors.EVENT_READ)
+
+                while selector.get_map():
+                    wait = None
+                    if deadline is not None:
+                        wait = deadline - time.monotonic()
+                        if wait <= 0:
+                            timed_out = True
+                            self._terminate()
+                            deadline = None
+                    if self._cancel_event is not None and not self._cancelled.is_set():
+                        if self._cancel_event.is_set():
+                            self.cancel()
+                        elif wait is None or wait > 0.5:
+                            wait = 0.5
+                    if timed_out or self._cancelled.is_set():
+                        # children may keep the pipes open after the process is gone
+                        if process.poll() is not None:
+                            break
+                        wait = 1
+
+                    for key, _ in selector.select(wait):
+                        data = os.read(key.fileobj.fileno(), 65536)
+                        if not data:
+                            selector.unregister(key.fileobj)
+                            continue
+                        streams[key.fileobj].feed(data)
+        except BaseException:
+            self._terminate()
+            raise
+        finally:
+            process.stdout.close()
+            process.stderr.close()
+
+        exitcode = process.wait()
+        for stream in streams.values():
+            stream.close()
+
+        stdout, stderr = streams[process.stdout], streams[process.stderr]
+        if timed_out:
+            message = 'Command timed out after {}s: {}\n'.format(self._timeout, command)
+            sys.stderr.write(message)
+
+        return CommandResult(command, exitcode, stdout.text(), stderr.text(),
+                             time.monotonic() - start,
+                             timed_out=timed_out,
+                             cancelled=self._cancelled.is_set(),
+                             output_bytes=stdout.size + stderr.size)
+
+    @staticmethod
+    async def _exited(process, timeout=None):
+        import asyncio
+
+        # process.wait() also waits for the pipes, which children of the process may keep open
+        deadline = time.monotonic() + timeout if timeout is not None else None
+        while process.returncode is None:
+            if deadline is not None and time.monotonic() >= deadline:
+                return False
+            await asyncio.sleep(0.05)
+        return True
+
+    async def _terminate_async(self, process):
+        if process.returncode is not None:
+            return
+
+        try:
+            process.send_signal(signal.SIGTERM)
+            if not await self._exited(process, self.kill_grace_period):
+                process.kill()
+        except ProcessLookupError:
+            pass
+        await self._exited(process)
+
+    @staticmethod
+    async def _feed_async(pipe, data):
+        try:
+            pipe.write(data)
+            await pipe.drain()
+        except (BrokenPipeError, ConnectionResetError):
+            # child exited without reading everything
+            pass
+        finally:
+            pipe.close()
+
+    @staticmethod
+    async def _read_async(pipe, stream):
+        while True:
+            data = await pipe.read(65536)
+            if not data:
+                break
+            stream.feed(data)
+
+    async def _call_async(self, command, printout=True, capture=False, on_line=None):
+        # asyncio is imported by the coroutines only, synchronous commands don't need it
+        import asyncio
+
+        start = time.monotonic()
+        deadline = start + self._timeout if self._timeout else None
+
+        stdin = self._stdin
+        stdin_data = None
+        if isinstance(stdin, (str, bytes)):
+            stdin_data = stdin.encode('utf8') if isinstance(stdin, str) else stdin
+            stdin = asyncio.subprocess.PIPE
+        elif stdin is None:
+            stdin = asyncio.subprocess.DEVNULL
+
+        try:
+            process = await asyncio.create_subprocess_exec(*command,
+                                                           stdin=stdin,
+                                                           stdout=asyncio.subprocess.PIPE,
+                                                           stderr=asyncio.subprocess.PIPE)
+        except OSError as e:
+            return CommandResult(command, 127, '', str(e) + '\n', time.monotonic() - start)
 
-    def execute(self, shell=True, executable=None, printout=True):
-        return self._call(self._command, shell=shell, executable=executable, printout=printout)
+        stdout = _Stream('stdout', sys.stdout if printout else None, self._tail, capture, on_line)
+        stderr = _Stream('stderr', sys.stderr if printout else None, self._tail, capture, on_line)
+        io = [self._read_async(process.stdout, stdout), self._read_async(process.stderr, stderr)]
+        if stdin_data is not None:
+            io.append(self._feed_async(process.stdin, stdin_data))
+        io = asyncio.ensure_future(asyncio.gather(*io))
+        # retrieve the result of a cancelled gather so asyncio doesn't log it
+        io.add_done_callback(lambda future: future.cancelled() or future.exception())
 
-    def _call(self, command, shell=True, executable=None, printout=True):
-        process = subprocess.Popen(command,
-                                   stdout=subprocess.PIPE,
-                                   shell=shell,
-                                   executable=executable,
-                                   universal_newlines=True)
+        timed_out = False
+        try:
+            while not io.done():
+                wait = None
+                if deadline is not None:
+                    wait = deadline - time.monotonic()
+                    if wait <= 0:
+                        timed_out = True
+                        break
+                if self._cancel_event is not None:
+                    if self._cancel_event.is_set():
+                        self._cancelled.set()
+                        break
+                    wait = 0.5 if wait is None else min(wait, 0.5)
+                await asyncio.wait([io], timeout=wait)
+        except asyncio.CancelledError:
+            self._cancelled.set()
+            io.cancel()
+            await self._terminate_async(process)
+            raise
 
-        if printout:
-            while True:
-                stdout = process.stdout.readline()
-                if stdout == '' and process.poll() is not None:
-                    break
-                if stdout:
-                    print(stdout.strip())
+        if io.done():
+            exitcode = await process.wait()
+        else:
+            await self._terminate_async(process)
+            # children may keep the pipes open after the process is gone
+            await asyncio.wait([io], timeout=1)
+            io.cancel()
+            exitcode = process.returncode
+            # asyncio has no public way to drop pipes a child still holds
+            transport = getattr(process, '_transport', None)
+            if transport is not None:
+                transport.close()
+        stdout.close()
+        stderr.close()
 
-        output, error = process.communicate()
-        exitcode = process.returncode
+        if timed_out:
+            message = 'Command timed out after {}s: {}\n'.format(self._timeout, command)
+            sys.stderr.write(message)
 
-        return exitcode, output, error
+        return CommandResult(command, exitcode, stdout.text(), stderr.text(),
+                             time.monotonic() - start,
+                             timed_out=timed_out,
+                             cancelled=self._cancelled.is_set(),
+                             output_bytes=stdout.size + stderr.size)
@@ -2,7 +2,7 @@ from . import file_util
 
 
 def load_config():
-    return file_util.get_yaml_dict(file_util.config_file)
+    return file_util.get_store(file_util.config_file).data()
 
 
 def get_name():
@@ -13,57 +13,51 @@ def get_image():
     return file_util.get_value("image", file_util.config_file)
 
 
-def add_version(tag, message=""):
-    version = file_util.get_value('version', file_util.config_file)
-    if not version:
-        version = []
+def get_ledger():
+    ledger = file_util.get_ledger()
+    if not ledger.exists():
+        versions = file_util.get_value('version', file_util.config_file)
+        if versions and ledger.migrate(versions):
+            file_util.remove_value('version', file_util.config_file)
+    return ledger
+
+
+def add_version(tag, message="", **extra):
+    return get_ledger().append(tag, message, **extra)
 
-    version.append(dict(
-        tag=tag,
-        message=message
-    ))
 
-    file_util.set_value("version", version, file_util.config_file)
+def set_version_pushed(version, digest=None):
+    """Record that an existing version was pushed, keeping its place in the build order"""
+    record = dict(version, pushed=True, digest=digest or version.get('digest'))
+    return get_ledger().append(record.pop('tag'), record.pop('message', ''), **record)
 
 
 def get_versions():
-    return file_util.get_value('version', file_util.config_file)
+    return get_ledger().all()
 
 
 def get_version(version=None):
-    versions = get_versions()
-    if not versions or len(versions) == 0:
-        return None
-
-    found_version = None
+    """`version`, by default the latest one whose push didn't fail"""
+    ledger = get_ledger()
     if not version:
-        found_version = versions[-1]
-    else:
-        try:
-            found_version = next((ver for ver in versions if ver["tag"] == version))
-        except StopIteration:
-            pass
-    return found_version
+        return ledger.latest(lambda v: v.get('pushed') is not False)
+    return ledger.get(version)
 
 
-def get_previous_version(version):
+def get_latest_version():
+    return get_ledger().latest()
 
-    versions = get_versions()
-    if not versions or len(versions) == 0:
-        return None
 
-    previous_version = None
-    versions.sort(key=lambda r: r["tag"])
-    i = 0
-    ver = dict({"tag": ""})
-    while ver["tag"] == version:
-        ver = versions[i]
-        i += 1
+def get_previous_version(version=None):
+    return get_ledger().previous(version)
 
-    if i < len(versions):
-        previous_version = versions[i + 1]
 
-    return previous_version
+def get_recent_versions(count):
+    return get_ledger().recent(count)
+
+
+def get_registries():
+    return file_util.get_value('registries', file_util.config_file, [])
 
 
 def get_template():
@@ -75,16 +69,18 @@ def get_local():
 
 
 def get_env(name):
-    environments = file_util.get_value('env', file_util.config_file)
-    if not environments:
-        return None
+    return get_environment_setting(name, 'name')
 
-    environment = None
-    try:
-        environment = environments.name
-    except KeyError:
-        pass
 
+def add_environment(env):
+    """Register `env` in environments with a release of its own, so --envs can deploy it next to the others"""
+    if env in get_environments():
+        return None
+
+    environment = dict(name=env)
+    if get_environments():
+        environment['release'] = '{}-{}'.format(get_name(), env)
+    file_util.set_value("environments", {env: environment}, file_util.config_file)
     return environment
 
 
@@ -116,6 +112,76 @@ def set_environment_variable(env, env_vars):
     file_util.set_value("environments", environments, file_util.config_file)
 
 
+def get_deploy_options(env):
+    return get_environment_setting(env, 'options', dict())
+
+
+def get_deploy_option_files(env):
+    """--set-file options saved for `env`: {key: file}"""
+    return get_environment_setting(env, 'option_files', dict())
+
+
+def set_deploy_options(env, options, files=None):
+    environments = file_util.get_value("environments", file_util.config_file)
+
+    for key, value in (('options', options), ('option_files', files)):
+        if value:
+            environments[env][key] = value
+        else:
+            environments[env].pop(key, None)
+    file_util.set_value("environments", environments, file_util.config_file)
+
+
+def get_environments():
+    environments = file_util.get_value("environments", file_util.config_file)
+    if not environments:
+        return []
+    return list(environments.keys())
+
+
+def get_environment_setting(env, key, default=None):
+    environments = file_util.get_value("environments", file_util.config_file)
+
+    value = None
+    try:
+        value = environments[env][key]
+    except (KeyError, TypeError):
+        pass
+
+    if value is None:
+        return default
+    return value
+
+
+def get_release_name(env):
+    return get_environment_setting(env, 'release', get_name())
+
+
+def get_kube_context(env):
+    return get_environment_setting(env, 'kube_context')
+
+
+def get_secret_keys(env):
+    """Secret variable names or patterns, per environment or global; None when not configured."""
+    return get_environment_setting(env, 'secret_keys',
+                                   file_util.get_value('secret_keys', file_util.config_file))
+
+
+CANARY_DEFAULTS = dict(
+    steps=[10],         # canary size per step, percent of the stable replicas
+    soak=300,           # seconds to watch each step
+    interval=10,        # seconds between two checks of the canary pods
+    max_restarts=0,     # container restarts tolerated during a step
+    unready_grace=30,   # seconds a canary pod may stay unready
+    suffix='-canary',   # canary release name = release + suffix
+)
+
+
+def get_canary_settings(env):
+    """CANARY_DEFAULTS overridden by environments.<env>.canary"""
+    return dict(CANARY_DEFAULTS, **(get_environment_setting(env, 'canary') or {}))
+
+
 def get_environment_variables(env):
     environments = file_util.get_value("environments", file_util.config_file)
 
@@ -0,0 +1,193 @@
+import os
+import re
+import hashlib
+from collections import defaultdict
+
+from kubeb import tracing
+
+
+def _translate(pattern):
+    """Translate a .dockerignore pattern to a regular expression.
+
+    Follows the Go filepath.Match syntax docker uses, plus ``**`` for any
+    number of directories. A pattern also matches everything below a
+    matching directory.
+    """
+    i, n = 0, len(pattern)
+    regex = ''
+    while i < n:
+        c = pattern[i]
+        if c == '*':
+            if pattern[i:i + 2] == '**':
+                i += 2
+                if pattern[i:i + 1] == '/':
+                    i += 1
+                    regex += '(?:.*/)?'
+                else:
+                    regex += '.*'
+                continue
+            regex += '[^/]*'
+        elif c == '?':
+            regex += '[^/]'
+        elif c == '\\' and i + 1 < n:
+            i += 1
+            regex += re.escape(pattern[i])
+        elif c == '[':
+            j = pattern.find(']', i + 1)
+            if j == -1:
+                regex += re.escape(c)
+            else:
+                chars = pattern[i + 1:j]
+                if chars.startswith('^'):
+                    chars = '!' + chars[1:]
+                if chars.startswith('!'):
+                    chars = '^' + chars[1:]
+                regex += '[' + chars.replace('\\', '\\\\') + ']'
+                i = j
+        else:
+            regex += re.escape(c)
+        i += 1
+    return re.compile('^' + regex + '(?:/.*)?$')
+
+
+def _clean(path):
+    path = os.path.normpath(path.strip()).replace(os.path.sep, '/')
+    return path.lstrip('/')
+
+
+class DockerIgnore(object):
+
+    def __init__(self, patterns=None):
+        self.rules = []
+        for pattern in patterns or []:
+            pattern = pattern.strip()
+            if not pattern or pattern.startswith('#'):
+                continue
+            negate = pattern.startswith('!')
+            if negate:
+                pattern = pattern[1:].strip()
+            pattern = _clean(pattern)
+            if pattern in ('', '.'):
+                continue
+            self.rules.append((_translate(pattern), negate, pattern))
+
+    @classmethod
+    def load(cls, context_dir):
+        path = os.path.join(context_dir, '.dockerignore')
+        try:
+            with open(path, 'r', encoding='utf8') as fh:
+                return cls(fh.read().splitlines())
+        except IOError:
+            return cls()
+
+    def excluded(self, path):
+        """Last matching rule wins, as in docker."""
+        excluded = False
+        for regex, negate, _ in self.rules:
+            if excluded == negate and regex.match(path):
+                excluded = not negate
+        return excluded
+
+    def may_include_below(self, directory):
+        """Whether an exception rule could re-include something in an excluded directory."""
+        prefix = directory + '/'
+        for _, negate, pattern in self.rules:
+            if not negate:
+                continue
+            if pattern.startswith(prefix):
+                return True
+            wildcard = re.search(r'[*?\[\\]', pattern)
+            if wildcard and prefix.startswith(pattern[:wildcard.start()]):
+                return True
+        return False
+
+
+def walk_context(context_dir, dockerfile='Dockerfile', ignore=None):
+    """Yield (relative path, size) for every file docker would send."""
+    ignore = ignore or DockerIgnore.load(context_dir)
+    always = {'.dockerignore', _clean(dockerfile)}
+
+    for root, dirs, files in os.walk(context_dir):
+        rel_root = _clean(os.path.relpath(root, context_dir))
+        rel_root = '' if rel_root == '.' else rel_root + '/'
+
+        kept = []
+        for name in sorted(dirs):
+            path = rel_root + name
+            if ignore.excluded(path) and not ignore.may_include_below(path):
+                continue
+            kept.append(name)
+        dirs[:] = kept
+
+        for name in sorted(files):
+            path = rel_root + name
+            if path not in always and ignore.excluded(path):
+                continue
+            try:
+                size = os.lstat(os.path.join(root, name)).st_size
+            except OSError:
+                continue
+            yield path, size
+
+
+def analyze_context(context_dir, dockerfile='Dockerfile', top=10):
+    total_size = 0
+    total_files = 0
+    directories = defaultdict(lambda: [0, 0])
+
+    for path, size in walk_context(context_dir, dockerfile):
+        total_size += size
+        total_files += 1
+        parts = path.split('/')[:-1]
+        for depth in range(1, min(len(parts), 2) + 1):
+            entry = directories['/'.join(parts[:depth])]
+            entry[0] += size
+            entry[1] += 1
+
+    largest = sorted(directories.items(), key=lambda item: item[1][0], reverse=True)[:top]
+    return dict(size=total_size,
+                files=total_files,
+                largest=[dict(path=path, size=size, files=files) for path, (size, files) in largest])
+
+
+@tracing.traced('context.hash')
+def hash_context(context_dir, dockerfile='Dockerfile', exclude=('.kubeb',)):
+    """Content hash of everything docker would send, Dockerfile included.
+
+    Paths under `exclude` are left out so kubeb's own state does not change
+    the hash between builds.
+    """
+    digest = hashlib.sha256()
+    for path, _ in walk_context(context_dir, dockerfile):
+        if path.split('/')[0] in exclude:
+            continue
+        full_path = os.path.join(context_dir, path)
+        digest.update(path.encode('utf8') + b'\0')
+        if os.path.islink(full_path):
+            digest.update(b'link:' + os.readlink(full_path).encode('utf8'))
+        else:
+            file_digest = hashlib.sha256()
+            with open(full_path, 'rb') as fh:
+                for chunk in iter(lambda: fh.read(1024 * 1024), b''):
+                    file_digest.update(chunk)
+            digest.update(file_digest.digest())
+    return digest.hexdigest()
+
+
+def write_context_tar(context_dir, fileobj, dockerfile='Dockerfile'):
+    """Write the filtered build context to `fileobj` as a gzipped tar."""
+    import tarfile
+
+    count = 0
+    with tarfile.open(fileobj=fileobj, mode='w:gz') as tar:
+        for path, _ in walk_context(context_dir, dockerfile):
+            tar.add(os.path.join(context_dir, path), arcname=path, recursive=False)
+            count += 1
+    return count
+
+
+def format_size(size):
+    for unit in ('B', 'KB', 'MB', 'GB'):
+        if size < 1024 or unit == 'GB':
+            return '{:.1f} {}'.format(size, unit) if unit != 'B' else '{} B'.format(size)
+        size /= 1024.0
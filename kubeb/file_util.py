@@ -1,46 +1,67 @@
 import os
+import copy
+import json
+import pickle
+import hashlib
 import shutil
 import codecs
-import yaml
-from dotenv import dotenv_values
-
-from jinja2 import Environment, FileSystemLoader
+import tempfile
+import contextlib
 
 from kubeb import config
-
-kubeb_directory = '.kubeb' + os.path.sep
-config_file = kubeb_directory + "config.yml"
-helm_value_file = kubeb_directory + "helm-values.yml"
-deploy_option_file = os.path.join(os.getcwd(), "kubeb-values.yml")
-
-docker_file = os.path.join(os.getcwd(), "Dockerfile")
-docker_directory = os.path.join(os.getcwd(), "docker")
+from kubeb.ledger import VersionLedger
+from kubeb.project import current_project, PATHS
+from kubeb import tracing
 
 template_directory = os.path.abspath(os.path.join(os.path.dirname(__file__), './templates/')) + os.path.sep
 ext_template_directory = os.path.abspath(os.path.join(os.path.dirname(__file__), '../ext_templates/')) + os.path.sep
 helm_template_directory = template_directory + "helm"
+user_cache_directory = os.path.join(os.path.expanduser('~'), '.kubeb', 'cache')
+
+config_cache_enabled = os.environ.get('KUBEB_NO_CONFIG_CACHE', '') == ''
 
 _marker = object()
 
+
+def __getattr__(name):
+    # config_file, helm_value_file, ... belong to the current project
+    if name in PATHS:
+        return getattr(current_project(), name)
+    raise AttributeError(name)
+
+
+def _yaml():
+    # yaml, jinja2 and dotenv are imported on first use to keep CLI startup fast
+    import yaml
+    try:
+        from yaml import CSafeLoader as loader, CSafeDumper as dumper
+    except ImportError:
+        from yaml import SafeLoader as loader, SafeDumper as dumper
+    return yaml, loader, dumper
+
 def config_file_exist():
-    return os.path.isfile(config_file)
+    return os.path.isfile(current_project().config_file)
 
 
 def docker_file_exist():
-    return os.path.isfile(docker_file)
+    return os.path.isfile(current_project().docker_file)
 
 
 def init_config_dir():
-    directory = os.path.join(os.getcwd(), kubeb_directory)
+    directory = current_project().kubeb_directory
     if not os.path.isdir(directory):
         os.makedirs(directory)
 
 
 def remove_config_dir():
-    directory = os.path.join(os.getcwd(), kubeb_directory)
+    directory = current_project().kubeb_directory
     if os.path.isdir(directory):
         shutil.rmtree(directory)
 
+    for store in _stores.values():
+        store.invalidate()
+    _ledgers.clear()
+
 
 def get_template_directory(template, external=False):
     if external:
@@ -62,22 +83,24 @@ def generate_config_file(name, user, template, ext_template, image, env):
         image=image,
     )
 
-    with open(config_file, "w") as fh:
-        fh.write(yaml.dump(values,
-                           default_flow_style=False,
-                           line_break=os.linesep))
+    store = get_store(current_project().config_file)
+    if store.get('version'):
+        # init --force: move the build history out of config.yml first
+        config.get_ledger()
 
-    environments = dict()
-    environments[env] = dict(
-        name=env
-    )
+    # other environments, deploy options and secret_keys survive a re-init
+    environments = store.get('environments') or dict()
+    environments.setdefault(env, dict(name=env))
 
-    set_value('environments', environments, config_file)
-    set_value('current_environment', env, config_file)
+    with store.batch():
+        for key, value in values.items():
+            store.set(key, value)
+        store.set('environments', environments)
+        store.set('current_environment', env)
 
-def generate_docker_file(template):
-    work_dir = os.getcwd()
-    template_dir = template_directory + template
+def generate_docker_file(template, ext_template=False):
+    work_dir = current_project().directory
+    template_dir = get_template_dir(template, ext_template)
 
     docker_file_dst = os.path.join(work_dir, 'Dockerfile')
     if os.path.isfile(docker_file_dst):
@@ -95,72 +118,415 @@ def generate_docker_file(template):
         if os.path.isfile(ignore_src):
             shutil.copy(ignore_src, docker_ignore_dst)
 
-def generate_helm_file(template, ext_template, image, tag, env):
+def get_helm_value_file(env=None):
+    if env is None:
+        return current_project().helm_value_file
+    return current_project().kubeb_directory + "helm-values-{}.yml".format(env)
+
+
+def get_template_dir(template, ext_template):
     if not ext_template:
-        template_dir = template_directory + template
-    else:
-        template_dir = ext_template_directory + template
+        return template_directory + template
+    return ext_template_directory + template
 
-    dotenv_path = get_environment_file(env)
-    if not os.path.exists(dotenv_path):
-        print("can't read %s - it doesn't exist." % dotenv_path)
+
+_jinja2_envs = dict()
+
+
+def get_jinja2_env(template_dir):
+    jinja2_env = _jinja2_envs.get(template_dir)
+    if jinja2_env is None:
+        import jinja2
+
+        bytecode_cache = None
+        bytecode_directory = os.path.join(user_cache_directory, 'jinja2')
+        try:
+            os.makedirs(bytecode_directory, exist_ok=True)
+            bytecode_cache = jinja2.FileSystemBytecodeCache(bytecode_directory)
+        except OSError:
+            pass
+
+        jinja2_env = jinja2.Environment(loader=jinja2.FileSystemLoader(template_dir),
+                                 trim_blocks=True,
+                                 bytecode_cache=bytecode_cache)
+        _jinja2_envs[template_dir] = jinja2_env
+    return jinja2_env
+
+
+def get_render_key(template_dir, image, tag, env_vars):
+    digest = hashlib.sha256()
+    with open(os.path.join(template_dir, 'helm-values.yaml'), 'rb') as fh:
+        digest.update(hashlib.sha256(fh.read()).digest())
+    digest.update(json.dumps([image, tag, env_vars], sort_keys=True, default=str).encode('utf8'))
+    return digest.hexdigest()
+
+
+def get_file_hash(path):
+    try:
+        with open(path, 'rb') as fh:
+            return hashlib.sha256(fh.read()).hexdigest()
+    except IOError:
         return None
 
-    parsed_dict = dotenv_values(dotenv_path)
 
-    env_vars = dict()
-    for key, value in parsed_dict.items():
-        if value and value != '' and value != 'null':
-            env_vars[key] = value
+def load_json_file(path):
+    try:
+        with open(path, 'r', encoding='utf8') as fh:
+            return json.load(fh)
+    except (IOError, ValueError):
+        return {}
 
-    configured_vars = config.get_environment_variables(env)
-    if configured_vars:
-        for key, value in configured_vars.items():
-            if value and value != '' and value != 'null':
-                env_vars[key] = value
+
+def save_json_file(path, data):
+    with open(path, 'w', encoding='utf8') as fh:
+        json.dump(data, fh, indent=2, sort_keys=True)
+
+
+def load_render_cache():
+    return load_json_file(current_project().render_cache_file)
+
+
+def save_render_cache(output, key, content_hash):
+    cache = load_render_cache()
+    cache[output] = dict(key=key, hash=content_hash)
+    save_json_file(current_project().render_cache_file, cache)
+
+
+def get_directory_hash(directory):
+    digest = hashlib.sha256()
+    for root, dirs, files in os.walk(directory):
+        dirs.sort()
+        for name in sorted(files):
+            path = os.path.join(root, name)
+            digest.update(os.path.relpath(path, directory).encode('utf8') + b'\0')
+            with open(path, 'rb') as fh:
+                digest.update(hashlib.sha256(fh.read()).digest())
+    return digest.hexdigest()
+
+
+def get_deploy_fingerprint(chart_path, values_file, options, values=None):
+    digest = hashlib.sha256()
+    digest.update(get_directory_hash(chart_path).encode('utf8'))
+    if values is not None:
+        digest.update(hashlib.sha256(values.encode('utf8')).hexdigest().encode('utf8'))
+    else:
+        digest.update((get_file_hash(values_file) or '').encode('utf8'))
+    digest.update(json.dumps(options or {}, sort_keys=True, default=str).encode('utf8'))
+    return digest.hexdigest()
+
+
+def get_deploy_fingerprint_key(release, env, kube_context=None):
+    return '{}/{}/{}'.format(kube_context or '', release, env)
+
+
+def get_last_deploy_fingerprint(key):
+    return load_json_file(current_project().deploy_fingerprint_file).get(key)
+
+
+def save_deploy_fingerprint(key, fingerprint):
+    fingerprints = load_json_file(current_project().deploy_fingerprint_file)
+    if fingerprint is None:
+        fingerprints.pop(key, None)
+    else:
+        fingerprints[key] = fingerprint
+    save_json_file(current_project().deploy_fingerprint_file, fingerprints)
+
+
+_secret_support = dict()
+
+
+def template_supports_secrets(template_dir):
+    """True when the template's helm-values.yaml renders `secret_env_vars`."""
+    values_template = os.path.join(template_dir, 'helm-values.yaml')
+    key = (values_template, get_file_stamp(values_template))
+    if key not in _secret_support:
+        from jinja2 import meta
+
+        jinja2_env = get_jinja2_env(template_dir)
+        source = jinja2_env.loader.get_source(jinja2_env, 'helm-values.yaml')[0]
+        _secret_support[key] = 'secret_env_vars' in meta.find_undeclared_variables(jinja2_env.parse(source))
+    return _secret_support[key]
+
+
+@tracing.traced('render.values')
+def _render_helm_values(template_dir, image, tag, env, env_vars, options=None):
+    from kubeb import variables as variable_layers
+
+    secret_env_vars = dict()
+    if template_supports_secrets(template_dir):
+        env_vars, secret_env_vars = variable_layers.split_secrets(env, env_vars)
 
     values = dict(
         image=image,
         tag=tag,
         env_vars=env_vars,
+        secret_env_vars=secret_env_vars,
     )
 
-    jinja2_env = Environment(loader=FileSystemLoader(template_dir), trim_blocks=True)
-    content = jinja2_env.get_template('helm-values.yaml').render(values)
-    with open(helm_value_file, "w") as fh:
+    content = get_jinja2_env(template_dir).get_template('helm-values.yaml').render(values)
+    if not options:
+        return content
+
+    from kubeb import helm_options
+    yaml, loader, _ = _yaml()
+    return dump_yaml(helm_options.merge(yaml.load(content, Loader=loader) or {}, options))
+
+
+def render_helm_values(template, ext_template, image, tag, env, variables=None, options=None):
+    """Helm values of `env` as a string, for `helm -f -`. None when the dotenv file is missing.
+
+    `options` (nested, from --set) are merged over the rendered template.
+    """
+    from kubeb import variables as variable_layers
+
+    dotenv_path = get_environment_file(env)
+    if not os.path.exists(dotenv_path):
+        print("can't read %s - it doesn't exist." % dotenv_path)
+        return None
+
+    template_dir = get_template_dir(template, ext_template)
+    return _render_helm_values(template_dir, image, tag, env, variable_layers.get_variables(env, variables),
+                               options)
+
+
+def generate_helm_file(template, ext_template, image, tag, env, output=None, use_cache=True, variables=None,
+                       options=None):
+    from kubeb import variables as variable_layers
+
+    output = output or current_project().helm_value_file
+    template_dir = get_template_dir(template, ext_template)
+
+    dotenv_path = get_environment_file(env)
+    if not os.path.exists(dotenv_path):
+        print("can't read %s - it doesn't exist." % dotenv_path)
+        return None
+
+    env_vars = variable_layers.get_variables(env, variables)
+
+    render_key = get_render_key(template_dir, image, tag, [env_vars, config.get_secret_keys(env), options])
+    if use_cache:
+        cached = load_render_cache().get(output)
+        if cached and cached['key'] == render_key and cached['hash'] == get_file_hash(output):
+            print("helm-values.yaml in %s is up to date" % output)
+            return output
+
+    content = _render_helm_values(template_dir, image, tag, env, env_vars, options)
+    with open(output, "w") as fh:
         fh.write(content)
+    save_render_cache(output, render_key, get_file_hash(output))
+
+    print("generated helm-values.yaml in %s" % output)
+    return output
 
-    print("generated helm-values.yaml in %s" % helm_value_file)
+
+def remove_helm_file(output=None):
+    """Delete a values file left by an earlier deploy, it may contain secrets."""
+    output = output or current_project().helm_value_file
+    if os.path.isfile(output):
+        os.remove(output)
+        cache = load_render_cache()
+        if cache.pop(output, None) is not None:
+            save_json_file(current_project().render_cache_file, cache)
 
 
 def clean_up():
     remove_config_dir()
 
 
+class ConfigStore(object):
+    """Parsed YAML file kept in memory for the lifetime of the process.
+
+    The file is parsed on first access and again only when its mtime or size
+    changes on disk. Writes inside ``batch()`` are flushed once at the end.
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self._data = None
+        self._stamp = None
+        self._dirty = False
+        self._batch_depth = 0
+
+    def _load(self):
+        stamp = get_file_stamp(self.filename)
+        if self._data is not None and (self._dirty or stamp == self._stamp):
+            return self._data
+
+        data = None
+        if config_cache_enabled and stamp is not None:
+            data = read_yaml_cache(self.filename, stamp)
+        if data is None:
+            with tracing.span('config.parse', file=os.path.basename(self.filename)):
+                data = get_yaml_dict(self.filename) or {}
+            if config_cache_enabled and stamp is not None:
+                write_yaml_cache(self.filename, stamp, data)
+
+        self._data = data
+        self._stamp = stamp
+        return self._data
+
+    def data(self):
+        return copy.deepcopy(self._load())
+
+    def get(self, key_name):
+        value = self._load().get(key_name)
+        return copy.deepcopy(value)
+
+    def set(self, key_name, value):
+        config = self._load()
+        if type(value) is dict:
+            for key in value.keys():
+                config.setdefault(key_name, {})[key] = copy.deepcopy(value[key])
+        else:
+            config[key_name] = copy.deepcopy(value)
+
+        self._dirty = True
+        if self._batch_depth == 0:
+            self.flush()
+
+    def delete(self, key_name):
+        config = self._load()
+        if key_name not in config:
+            return
+
+        del config[key_name]
+        self._dirty = True
+        if self._batch_depth == 0:
+            self.flush()
+
+    @contextlib.contextmanager
+    def batch(self):
+        self._batch_depth += 1
+        try:
+            yield self
+        finally:
+            self._batch_depth -= 1
+            if self._batch_depth == 0 and self._dirty:
+                self.flush()
+
+    def flush(self):
+        if not self._dirty:
+            return
+
+        write_yaml_file(self.filename, self._data)
+        self._stamp = get_file_stamp(self.filename)
+        self._dirty = False
+        if config_cache_enabled and self._stamp is not None:
+            write_yaml_cache(self.filename, self._stamp, self._data)
+
+    def clear(self):
+        self._data = dict()
+        self._dirty = True
+        if self._batch_depth == 0:
+            self.flush()
+
+    def invalidate(self):
+        self._data = None
+        self._stamp = None
+        self._dirty = False
+
+
+_stores = dict()
+_ledgers = dict()
+
+
+def get_store(file):
+    key = os.path.abspath(file)
+    store = _stores.get(key)
+    if store is None:
+        store = _stores[key] = ConfigStore(file)
+    return store
+
+
+def get_ledger(file=None):
+    key = os.path.abspath(file or current_project().version_file)
+    ledger = _ledgers.get(key)
+    if ledger is None:
+        ledger = _ledgers[key] = VersionLedger(file or current_project().version_file)
+    return ledger
+
+
+def get_file_stamp(file):
+    try:
+        stat = os.stat(file)
+    except OSError:
+        return None
+    return stat.st_mtime_ns, stat.st_size
+
+
+def get_yaml_cache_file(file):
+    directory, name = os.path.split(os.path.abspath(file))
+    return os.path.join(directory, '.' + name + '.cache')
+
+
+def read_yaml_cache(file, stamp):
+    try:
+        with open(get_yaml_cache_file(file), 'rb') as f:
+            cached_stamp, data = pickle.load(f)
+    except Exception:
+        return None
+
+    if tuple(cached_stamp) != tuple(stamp):
+        return None
+    return data
+
+
+def write_yaml_cache(file, stamp, data):
+    cache_file = get_yaml_cache_file(file)
+    try:
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(cache_file), prefix='.tmp-')
+        with os.fdopen(fd, 'wb') as f:
+            pickle.dump((stamp, data), f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, cache_file)
+    except OSError:
+        pass
+
+
+def dump_yaml(data):
+    yaml, _, dumper = _yaml()
+    return yaml.dump(data, Dumper=dumper, default_flow_style=False,
+                     line_break=os.linesep)
+
+
+def load_yaml_documents(text):
+    yaml, loader, _ = _yaml()
+    return [document for document in yaml.load_all(text, Loader=loader) if document is not None]
+
+
+def write_yaml_file(file, data):
+    content = dump_yaml(data)
+    if os.path.isfile(file):
+        with open(file, 'r', encoding='utf8', newline='') as f:
+            if f.read() == content:
+                return False
+
+    directory = os.path.dirname(os.path.abspath(file))
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix='.tmp-', suffix='.yml')
+    try:
+        with os.fdopen(fd, 'w', encoding='utf8', newline='') as f:
+            f.write(content)
+        if os.path.isfile(file):
+            shutil.copymode(file, tmp_path)
+        else:
+            os.chmod(tmp_path, 0o644)
+        os.replace(tmp_path, file)
+    except Exception:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    return True
+
+
 def set_value(key_name, value, file):
-    config = get_yaml_dict(file)
-    if not config:
-        config = {}
+    get_store(file).set(key_name, value)
 
-    if type(value) is dict:
-        for key in value.keys():
-            config.setdefault(key_name, {})[key] = value[key]
-    else:
-        config[key_name] = value
 
-    with codecs.open(file, 'w', encoding='utf8') as f:
-        f.write(yaml.dump(config, default_flow_style=False,
-                          line_break=os.linesep))
+def remove_value(key_name, file):
+    get_store(file).delete(key_name)
 
 
 def get_value(key_name, file, default=_marker):
-    value = None
-    config = get_yaml_dict(file)
-    if config:
-        try:
-            value = config[key_name]
-        except KeyError:
-            value = None
+    value = get_store(file).get(key_name)
 
     if value is None and default != _marker:
         return default
@@ -168,43 +534,55 @@ def get_value(key_name, file, default=_marker):
     return value
 
 def get_yaml_dict(filename):
+    yaml, loader, _ = _yaml()
     try:
         with codecs.open(filename, 'r', encoding='utf8') as f:
-            return yaml.load(f)
+            return yaml.load(f, Loader=loader)
     except IOError:
         return {}
 
 def get_environment_file(env):
-    work_dir = os.getcwd()
+    work_dir = current_project().directory
     return os.path.join(work_dir, '.env.' + env)
 
-def generate_environment_file(env, template):
-    work_dir = os.getcwd()
-    template_dir = template_directory + template
+
+def get_base_environment_file():
+    return os.path.join(current_project().directory, '.env')
+
+def generate_environment_file(env, template, ext_template=False):
+    work_dir = current_project().directory
+    template_dir = get_template_dir(template, ext_template)
 
     docker_file_src = os.path.join(template_dir, 'dotenv')
     docker_file_dst = os.path.join(work_dir, '.env.' + env)
-    shutil.copy(docker_file_src, docker_file_dst)
+    copy_file_if_changed(docker_file_src, docker_file_dst)
+
+
+def copy_file_if_changed(src, dst):
+    """Copy `src` to `dst` unless `dst` already has the same content."""
+    if os.path.isfile(dst) and get_file_hash(src) == get_file_hash(dst):
+        return False
+
+    shutil.copy(src, dst)
+    return True
 
 
 def template_exist(template):
-    return os.path.isdir(template_directory + template) \
-           or os.path.isdir(ext_template_directory + template)
+    from kubeb import template_catalog
+    return template_catalog.get_template(template) is not None
 
 
 def is_ext_template(template):
-    return os.path.isdir(ext_template_directory + template)
+    from kubeb import template_catalog
+    return 'ext' in (template_catalog.get_template(template) or {})
 
 
 def add_ext_template(name, path):
-    template_dir = ext_template_directory + name
-    if os.path.isdir(template_dir):
-        shutil.rmtree(template_dir)
+    from kubeb import template_catalog
 
-    shutil.copytree(path, template_dir)
+    template_dir = ext_template_directory + name
+    copied, removed = template_catalog.sync_directory(path, template_dir)
+    template_catalog.update_template(name, 'ext')
+    return copied, removed
 
 
-def save_deploy_options(options):
-    with codecs.open(deploy_option_file, 'w', encoding='utf8') as f:
-        f.write(yaml.dump(options, default_flow_style=False,
-                          line_break=os.linesep))
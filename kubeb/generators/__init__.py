@@ -1,9 +1,162 @@
-from .podder_pipeline_generator import PodderPipelineGenerator
-from .podder_task_bean_generator import PodderTaskBeanGenerator
-from .laravel_generator import LaravelGenerator
+import os
+import sys
+import hashlib
+import importlib
+import importlib.util
+
+# template name -> "module:class", imported only when the generator is used
+GENERATORS = {
+    'laravel': 'kubeb.generators.laravel_generator:LaravelGenerator',
+    'podder-pipeline': 'kubeb.generators.podder_pipeline_generator:PodderPipelineGenerator',
+    'podder-task-bean': 'kubeb.generators.podder_task_bean_generator:PodderTaskBeanGenerator',
+}
+
+ENTRY_POINT_GROUP = 'kubeb.generators'
+DEFAULT_GENERATOR = 'kubeb.generators.base_generator:TemplateGenerator'
+
+_CLASSES = dict((path.split(':')[1], path) for path in GENERATORS.values())
+_index = None
+
+
+def _load(path):
+    module_name, class_name = path.rsplit(':', 1)
+    if module_name.endswith('.py'):
+        # generator shipped as a python file inside the template directory
+        name = 'kubeb_ext_generator_' + hashlib.sha1(module_name.encode('utf8')).hexdigest()[:12]
+        module = sys.modules.get(name)
+        if module is None:
+            spec = importlib.util.spec_from_file_location(name, module_name)
+            module = importlib.util.module_from_spec(spec)
+            spec.loader.exec_module(module)
+            sys.modules[name] = module
+    else:
+        module = importlib.import_module(module_name)
+    return getattr(module, class_name)
+
+
+def _template_dirs():
+    from kubeb import file_util
+    return [file_util.template_directory, file_util.ext_template_directory]
+
+
+def _index_key():
+    """Changes whenever installed packages or template directories change."""
+    digest = hashlib.sha256()
+    for path in list(sys.path) + _template_dirs():
+        try:
+            digest.update('{}:{}\n'.format(path, os.stat(path or '.').st_mtime_ns).encode('utf8'))
+        except OSError:
+            digest.update('{}:-\n'.format(path).encode('utf8'))
+    for directory in _template_dirs():
+        for info_file in _info_files(directory):
+            digest.update('{}:{}\n'.format(info_file, os.stat(info_file).st_mtime_ns).encode('utf8'))
+    return digest.hexdigest()
+
+
+def _info_files(directory):
+    try:
+        names = sorted(os.listdir(directory))
+    except OSError:
+        return []
+    return [os.path.join(directory, name, 'info.yaml') for name in names
+            if os.path.isfile(os.path.join(directory, name, 'info.yaml'))]
+
+
+def _entry_points():
+    """{name: "module:class"} registered under ENTRY_POINT_GROUP."""
+    try:
+        from importlib import metadata
+    except ImportError:
+        # python 3.7
+        try:
+            import importlib_metadata as metadata
+        except ImportError:
+            metadata = None
+
+    if metadata is None:
+        import pkg_resources
+        return dict((entry_point.name, '{}:{}'.format(entry_point.module_name, '.'.join(entry_point.attrs)))
+                    for entry_point in pkg_resources.WorkingSet().iter_entry_points(ENTRY_POINT_GROUP))
+
+    entry_points = metadata.entry_points()
+    if hasattr(entry_points, 'select'):
+        entry_points = entry_points.select(group=ENTRY_POINT_GROUP)
+    else:
+        entry_points = entry_points.get(ENTRY_POINT_GROUP, [])
+    return dict((entry_point.name, entry_point.value) for entry_point in entry_points)
+
+
+def _scan():
+    from kubeb import file_util
+
+    generators = dict(GENERATORS)
+
+    generators.update(_entry_points())
+
+    for directory in _template_dirs():
+        for info_file in _info_files(directory):
+            info = file_util.get_yaml_dict(info_file) or {}
+            generator = info.get('generator')
+            if not generator:
+                continue
+            module_name, class_name = generator.rsplit(':', 1)
+            if module_name.endswith('.py'):
+                module_name = os.path.join(os.path.dirname(info_file), module_name)
+            generators[os.path.basename(os.path.dirname(info_file))] = module_name + ':' + class_name
+
+    return generators
+
+
+def discover():
+    """Generator paths by template name: built-in, entry points, then info.yaml.
+
+    The result is cached in ~/.kubeb/cache/generators.json until installed
+    packages or template directories change.
+    """
+    global _index
+    if _index is not None:
+        return _index
+
+    from kubeb import file_util
+
+    cache_file = os.path.join(file_util.user_cache_directory, 'generators.json')
+    key = _index_key()
+    cached = file_util.load_json_file(cache_file)
+    if cached.get('key') == key:
+        _index = cached['generators']
+        return _index
+
+    _index = _scan()
+    try:
+        os.makedirs(file_util.user_cache_directory, exist_ok=True)
+        file_util.save_json_file(cache_file, dict(key=key, generators=_index))
+    except OSError:
+        pass
+    return _index
+
+
+def get_generator(template):
+    from kubeb import file_util
+
+    path = discover().get(template)
+    if path is None:
+        if not file_util.template_exist(template):
+            return None
+        path = DEFAULT_GENERATOR
+    return _load(path)
+
+
+def __getattr__(name):
+    if name in _CLASSES:
+        return _load(_CLASSES[name])
+    if name == 'TemplateGenerator':
+        return _load(DEFAULT_GENERATOR)
+    raise AttributeError(name)
+
 
 __all__ = [
     'PodderPipelineGenerator',
     'PodderTaskBeanGenerator',
     'LaravelGenerator',
-]
\ No newline at end of file
+    'TemplateGenerator',
+]
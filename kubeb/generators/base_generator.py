@@ -1,6 +1,28 @@
+from kubeb import file_util
+
+
 class BaseGenerator(object):
     def __init__(self, data: dict):
         self.data = data
 
     def execute(self):
         raise NotImplementedError
+
+
+class TemplateGenerator(BaseGenerator):
+    """Generate config, dotenv and Docker files from a template directory.
+
+    Files are only rewritten when their content changes, so re-running
+    `kubeb init --force` leaves unchanged files alone. config.yml keeps its
+    environments and build history.
+    """
+
+    def execute(self):
+        file_util.generate_config_file(self.data["name"],
+                                       self.data["user"],
+                                       self.data["template"],
+                                       self.data["ext_template"],
+                                       self.data["image"],
+                                       self.data["env"])
+        file_util.generate_environment_file(self.data["env"], self.data["template"], self.data["ext_template"])
+        file_util.generate_docker_file(self.data["template"], self.data["ext_template"])
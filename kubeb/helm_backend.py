@@ -0,0 +1,398 @@
+import os
+import sys
+import ssl
+import json
+import queue
+import base64
+import tempfile
+import threading
+import http.client
+from urllib.parse import urlparse, urlencode
+
+from kubeb import file_util
+from kubeb.command import Command
+from kubeb.project import run_in_thread
+
+
+class HelmBackend(object):
+    """Operations kubeb needs from helm.
+
+    `install` reads values from `values_file`, or from the `values` string
+    when given, and returns a CommandResult; the other operations return an exit
+    status, except `history` which returns a list of revision dicts
+    (revision, updated, status, chart, description), [] for an unknown
+    release or None on error.
+    """
+
+    name = None
+
+    def install(self, name, chart_path, values_file, debug=False, timeout=None,
+                kube_context=None, printout=True, cancel_event=None, wait=True, values=None):
+        raise NotImplementedError
+
+    def uninstall(self, name, timeout=None, kube_context=None):
+        raise NotImplementedError
+
+    def rollback(self, name, revision, timeout=None, kube_context=None, printout=True):
+        raise NotImplementedError
+
+    def history(self, name, max_revisions=None, timeout=None, kube_context=None):
+        raise NotImplementedError
+
+    def show_history(self, name, timeout=None, kube_context=None):
+        raise NotImplementedError
+
+    async def install_async(self, name, chart_path, values_file, debug=False, timeout=None,
+                            kube_context=None, printout=True, cancel_event=None, wait=True, values=None):
+        return await run_in_thread(self.install, name, chart_path, values_file, debug, timeout,
+                                   kube_context, printout, cancel_event, wait, values)
+
+    async def rollback_async(self, name, revision, timeout=None, kube_context=None, printout=True):
+        return await run_in_thread(self.rollback, name, revision, timeout, kube_context, printout)
+
+    async def history_async(self, name, max_revisions=None, timeout=None, kube_context=None):
+        return await run_in_thread(self.history, name, max_revisions, timeout, kube_context)
+
+
+class SubprocessBackend(HelmBackend):
+    """Runs the helm CLI for every operation."""
+
+    name = 'subprocess'
+
+    def _command(self, args, kube_context=None):
+        command = ['helm'] + args
+        if kube_context:
+            command += ['--kube-context', kube_context]
+        return command
+
+    def _install_command(self, name, chart_path, values_file, debug=False, kube_context=None,
+                         wait=True, values=None):
+        import shlex
+
+        if values is not None:
+            # stream the values over stdin instead of a file on disk
+            values_file = '-'
+        command = self._command(['upgrade', '--install', '--force', name,
+                                 '-f', values_file, chart_path], kube_context)
+        if wait:
+            command.append('--wait')
+
+        if debug:
+            print(' '.join(shlex.quote(arg) for arg in command))
+            command += ['--dry-run', '--debug']
+        return command
+
+    def install(self, name, chart_path, values_file, debug=False, timeout=None,
+                kube_context=None, printout=True, cancel_event=None, wait=True, values=None):
+        command = self._install_command(name, chart_path, values_file, debug, kube_context, wait, values)
+        return Command(command, timeout=timeout, cancel_event=cancel_event, stdin=values).run(printout=printout)
+
+    async def install_async(self, name, chart_path, values_file, debug=False, timeout=None,
+                            kube_context=None, printout=True, cancel_event=None, wait=True, values=None):
+        command = self._install_command(name, chart_path, values_file, debug, kube_context, wait, values)
+        return await Command(command, timeout=timeout, cancel_event=cancel_event,
+                             stdin=values).run_async(printout=printout)
+
+    def uninstall(self, name, timeout=None, kube_context=None):
+        command = self._command(['delete', '--purge', name], kube_context)
+        status, _, _ = Command(command, timeout=timeout).execute()
+
+        return status
+
+    def rollback(self, name, revision, timeout=None, kube_context=None, printout=True):
+        command = self._command(['rollback', name, str(revision)], kube_context)
+        status, _, _ = Command(command, timeout=timeout).execute(printout=printout)
+
+        return status
+
+    async def rollback_async(self, name, revision, timeout=None, kube_context=None, printout=True):
+        command = self._command(['rollback', name, str(revision)], kube_context)
+        result = await Command(command, timeout=timeout).run_async(printout=printout, capture=not printout)
+
+        return result.exitcode
+
+    def show_history(self, name, timeout=None, kube_context=None):
+        command = self._command(['history', name], kube_context)
+        status, _, _ = Command(command, timeout=timeout).execute()
+
+        return status
+
+    def _history_command(self, name, max_revisions=None, kube_context=None):
+        command = self._command(['history', name, '--output', 'json'], kube_context)
+        if max_revisions:
+            command += ['--max', str(max_revisions)]
+        return command
+
+    @staticmethod
+    def _parse_history(exitcode, output, error):
+        if exitcode != 0:
+            if 'not found' in (error or ''):
+                return []
+            return None
+
+        return json.loads(output) if output.strip() else []
+
+    def history(self, name, max_revisions=None, timeout=None, kube_context=None):
+        command = self._history_command(name, max_revisions, kube_context)
+        return self._parse_history(*Command(command, timeout=timeout).execute(printout=False))
+
+    async def history_async(self, name, max_revisions=None, timeout=None, kube_context=None):
+        command = self._history_command(name, max_revisions, kube_context)
+        result = await Command(command, timeout=timeout).run_async(printout=False, capture=True)
+        return self._parse_history(*result)
+
+
+class ApiError(Exception):
+    pass
+
+
+class KubeConfig(object):
+    """Server address and credentials of one kubeconfig context.
+
+    Supports token, basic auth and client certificate users. Contexts whose
+    user relies on an exec or auth-provider plugin raise ApiError.
+    """
+
+    def __init__(self, server, ssl_context=None, headers=None, namespace=None):
+        self.server = server
+        self.ssl_context = ssl_context
+        self.headers = headers or {}
+        self.namespace = namespace or 'default'
+
+    @classmethod
+    def load(cls, context=None, path=None):
+        """Config of `context` (default: the current one) from the kubeconfig.
+
+        KUBEB_API_SERVER overrides the server address. A plain http address
+        (e.g. `kubectl proxy`) is used without credentials; an https one is
+        another address of the context's cluster and verified with its CA.
+        KUBEB_API_INSECURE=1 skips that verification. The namespace is the
+        context's, 'default' when it has none, as for helm and kubectl.
+        """
+        path = path or os.environ.get('KUBECONFIG', '').split(os.pathsep)[0] \
+            or os.path.join(os.path.expanduser('~'), '.kube', 'config')
+        data = file_util.get_yaml_dict(path) or {}
+
+        context = context or data.get('current-context')
+        context_data = cls._named(data.get('contexts'), context)
+        namespace = context_data.get('namespace')
+
+        server = os.environ.get('KUBEB_API_SERVER')
+        if server and not server.startswith('https'):
+            return cls(server, namespace=namespace)
+
+        cluster = cls._named(data.get('clusters'), context_data.get('cluster'))
+        user = cls._named(data.get('users'), context_data.get('user'))
+        if server:
+            cluster['server'] = server
+            if os.environ.get('KUBEB_API_INSECURE', '') not in ('', '0'):
+                cluster['insecure-skip-tls-verify'] = True
+        if not cluster.get('server'):
+            raise ApiError('cluster for context {} not found in {}'.format(context, path))
+        if 'exec' in user or 'auth-provider' in user:
+            raise ApiError('kubeconfig user {} needs an auth plugin'.format(context_data.get('user')))
+
+        headers = dict()
+        if user.get('token'):
+            headers['Authorization'] = 'Bearer ' + user['token']
+        elif user.get('tokenFile'):
+            with open(user['tokenFile']) as fh:
+                headers['Authorization'] = 'Bearer ' + fh.read().strip()
+        elif user.get('username'):
+            credentials = '{}:{}'.format(user['username'], user.get('password', ''))
+            headers['Authorization'] = 'Basic ' + base64.b64encode(credentials.encode('utf8')).decode('ascii')
+
+        ssl_context = None
+        if cluster['server'].startswith('https'):
+            ssl_context = cls._ssl_context(cluster, user)
+        return cls(cluster['server'], ssl_context, headers, namespace)
+
+    @staticmethod
+    def _named(items, name):
+        for item in items or []:
+            if item.get('name') == name:
+                return dict(item.get('context') or item.get('cluster') or item.get('user') or {})
+        return {}
+
+    @staticmethod
+    def _data_file(data, path):
+        if path:
+            return path
+        fd, path = tempfile.mkstemp(prefix='kubeb-', suffix='.pem')
+        with os.fdopen(fd, 'wb') as fh:
+            fh.write(base64.b64decode(data))
+        return path
+
+    @classmethod
+    def _ssl_context(cls, cluster, user=None):
+        user = user or {}
+        if cluster.get('insecure-skip-tls-verify'):
+            context = ssl._create_unverified_context()
+        elif cluster.get('certificate-authority-data'):
+            context = ssl.create_default_context(
+                cadata=base64.b64decode(cluster['certificate-authority-data']).decode('ascii'))
+        else:
+            context = ssl.create_default_context(cafile=cluster.get('certificate-authority'))
+
+        if user.get('client-certificate') or user.get('client-certificate-data'):
+            cert = cls._data_file(user.get('client-certificate-data'), user.get('client-certificate'))
+            key = cls._data_file(user.get('client-key-data'), user.get('client-key'))
+            try:
+                context.load_cert_chain(cert, key)
+            finally:
+                for path, data in ((cert, user.get('client-certificate-data')), (key, user.get('client-key-data'))):
+                    if data:
+                        os.remove(path)
+        return context
+
+
+class ApiClient(object):
+    """Minimal Kubernetes API client over a pool of keep-alive connections."""
+
+    def __init__(self, kube_config, pool_size=4, timeout=30):
+        self.config = kube_config
+        self.timeout = timeout
+        url = urlparse(kube_config.server)
+        self._https = url.scheme == 'https'
+        self._host = url.hostname
+        self._port = url.port
+        self._prefix = url.path.rstrip('/')
+        self._pool = queue.LifoQueue(maxsize=pool_size)
+
+    def _connection(self):
+        try:
+            return self._pool.get_nowait()
+        except queue.Empty:
+            pass
+        if self._https:
+            return http.client.HTTPSConnection(self._host, self._port, timeout=self.timeout,
+                                               context=self.config.ssl_context)
+        return http.client.HTTPConnection(self._host, self._port, timeout=self.timeout)
+
+    def _release(self, connection):
+        try:
+            self._pool.put_nowait(connection)
+        except queue.Full:
+            connection.close()
+
+    def get(self, path, params=None):
+        url = self._prefix + path
+        if params:
+            url += '?' + urlencode(params)
+        headers = dict(self.config.headers, Accept='application/json')
+
+        for attempt in range(2):
+            connection = self._connection()
+            try:
+                connection.request('GET', url, headers=headers)
+                response = connection.getresponse()
+                body = response.read()
+            except (http.client.HTTPException, OSError):
+                connection.close()
+                if attempt:
+                    raise
+                # stale keep-alive connection, retry on a fresh one
+                continue
+            self._release(connection)
+            break
+
+        if response.status == 404:
+            return None
+        if response.status >= 400:
+            raise ApiError('GET {} failed: {} {}'.format(url, response.status, body[:200]))
+        return json.loads(body.decode('utf8'))
+
+
+class ApiBackend(SubprocessBackend):
+    """Reads release state straight from the Kubernetes API.
+
+    Helm keeps one ConfigMap (helm 2, in the tiller namespace) or Secret
+    (helm 3, in the release namespace) per revision, labelled with the
+    release name, revision and status. `history` lists those labels over a
+    pooled keep-alive connection instead of starting helm. Operations that
+    need helm's rendering or tiller (install, rollback, uninstall) still run
+    the helm CLI.
+    """
+
+    name = 'api'
+
+    def __init__(self, storage=None, namespace=None):
+        self.storage = storage or os.environ.get('KUBEB_HELM_STORAGE', 'configmap')
+        if self.storage == 'secret':
+            # None: the namespace of each kube context
+            self.namespace = namespace
+        else:
+            self.namespace = namespace or os.environ.get('TILLER_NAMESPACE', 'kube-system')
+        self._clients = dict()
+        self._lock = threading.Lock()
+
+    def client(self, kube_context=None):
+        with self._lock:
+            client = self._clients.get(kube_context)
+            if client is None:
+                client = self._clients[kube_context] = ApiClient(KubeConfig.load(kube_context))
+            return client
+
+    def history(self, name, max_revisions=None, timeout=None, kube_context=None):
+        try:
+            items = self._release_objects(name, kube_context)
+        except (ApiError, OSError, http.client.HTTPException) as e:
+            print('kube api history failed ({}), falling back to helm'.format(e), file=sys.stderr)
+            return super(ApiBackend, self).history(name, max_revisions, timeout, kube_context)
+
+        revisions = []
+        for item in items:
+            labels = item['metadata'].get('labels') or {}
+            version = labels.get('VERSION') or labels.get('version')
+            if not version:
+                continue
+            revisions.append(dict(revision=int(version),
+                                  updated=item['metadata'].get('creationTimestamp'),
+                                  status=(labels.get('STATUS') or labels.get('status') or '').upper(),
+                                  chart='',
+                                  description=''))
+
+        revisions.sort(key=lambda r: r['revision'])
+        if max_revisions:
+            revisions = revisions[-max_revisions:]
+        return revisions
+
+    async def history_async(self, name, max_revisions=None, timeout=None, kube_context=None):
+        # the API client is blocking
+        return await run_in_thread(self.history, name, max_revisions, timeout, kube_context)
+
+    def _release_objects(self, name, kube_context=None):
+        if self.storage == 'secret':
+            namespace = self.namespace or self.client(kube_context).config.namespace
+            path = '/api/v1/namespaces/{}/secrets'.format(namespace)
+            selector = 'owner=helm,name={}'.format(name)
+        else:
+            path = '/api/v1/namespaces/{}/configmaps'.format(self.namespace)
+            selector = 'OWNER=TILLER,NAME={}'.format(name)
+
+        result = self.client(kube_context).get(path, dict(labelSelector=selector))
+        return (result or {}).get('items') or []
+
+
+BACKENDS = {
+    SubprocessBackend.name: SubprocessBackend,
+    ApiBackend.name: ApiBackend,
+}
+
+_backends = dict()
+
+
+def get_backend():
+    """Backend chosen by KUBEB_BACKEND or `backend` in config.yml."""
+    name = os.environ.get('KUBEB_BACKEND')
+    if not name and file_util.config_file_exist():
+        name = file_util.get_value('backend', file_util.config_file)
+    name = name or SubprocessBackend.name
+
+    backend = _backends.get(name)
+    if backend is None:
+        backend_class = BACKENDS.get(name)
+        if backend_class is None:
+            raise ValueError('Unknown kubeb backend: {}'.format(name))
+        backend = _backends[name] = backend_class()
+    return backend
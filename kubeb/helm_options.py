@@ -0,0 +1,252 @@
+import os
+import copy
+
+
+def _read(text, pos, stops):
+    """Read up to an unescaped stop character: (token, stop, position after stop).
+
+    Escapes are kept in the token so keys can still tell `\\.` from `.`.
+    """
+    start = pos
+    while pos < len(text):
+        char = text[pos]
+        if char == '\\':
+            pos += 2
+            continue
+        if char in stops:
+            return text[start:pos], char, pos + 1
+        pos += 1
+    return text[start:], None, pos
+
+
+def _unescape(token):
+    chars = []
+    pos = 0
+    while pos < len(token):
+        if token[pos] == '\\' and pos + 1 < len(token):
+            pos += 1
+        chars.append(token[pos])
+        pos += 1
+    return ''.join(chars)
+
+
+def split_key(key):
+    """`a.b[0].c` -> ['a', 'b', 0, 'c']"""
+    parts = []
+    current = []
+    pos = 0
+    while pos < len(key):
+        char = key[pos]
+        if char == '\\' and pos + 1 < len(key):
+            current.append(key[pos + 1])
+            pos += 2
+            continue
+        if char == '.':
+            if current:
+                parts.append(''.join(current))
+            elif not parts or not isinstance(parts[-1], int):
+                raise ValueError('empty key segment in "{}"'.format(key))
+            current = []
+        elif char == '[':
+            end = key.find(']', pos)
+            if end == -1:
+                raise ValueError('unterminated index in "{}"'.format(key))
+            if current:
+                parts.append(''.join(current))
+                current = []
+            if not parts:
+                raise ValueError('key "{}" starts with an index'.format(key))
+            try:
+                index = int(key[pos + 1:end])
+            except ValueError:
+                raise ValueError('invalid index in "{}"'.format(key))
+            if index < 0:
+                raise ValueError('negative index in "{}"'.format(key))
+            parts.append(index)
+            pos = end
+        else:
+            current.append(char)
+        pos += 1
+    if current:
+        parts.append(''.join(current))
+    elif key.endswith('.') and not key.endswith('\\.'):
+        raise ValueError('empty key segment in "{}"'.format(key))
+    if not parts:
+        raise ValueError('empty key')
+    return parts
+
+
+def join_key(parts):
+    """['a', 'b.c', 0] -> `a.b\\.c[0]`, the inverse of split_key"""
+    key = ''
+    for part in parts:
+        if isinstance(part, int):
+            key += '[{}]'.format(part)
+            continue
+        escaped = ''.join('\\' + char if char in '\\.[],=' else char for char in part)
+        key += '.' + escaped if key else escaped
+    return key
+
+
+def typed_value(value):
+    """Helm's --set typing: true/false, null and integers, everything else stays a string."""
+    lower = value.lower()
+    if lower == 'true':
+        return True
+    if lower == 'false':
+        return False
+    if lower == 'null':
+        return None
+    if value and (value[0] != '0' or value == '0'):
+        try:
+            return int(value)
+        except ValueError:
+            pass
+    return value
+
+
+def _assign(values, path, value):
+    container = values
+    for i, part in enumerate(path):
+        last = i == len(path) - 1
+        child = None if last else ([] if isinstance(path[i + 1], int) else {})
+        if isinstance(part, int):
+            if not isinstance(container, list):
+                raise ValueError('{} is not a list'.format('.'.join(str(p) for p in path[:i])))
+            while len(container) <= part:
+                container.append(None)
+        elif not isinstance(container, dict):
+            raise ValueError('{} is not a map'.format('.'.join(str(p) for p in path[:i])))
+
+        if last:
+            container[part] = value
+        else:
+            existing = container.get(part) if isinstance(container, dict) else container[part]
+            if not isinstance(existing, type(child)):
+                container[part] = child
+            container = container[part]
+
+
+def parse_set(text, values=None, typed=True, reader=None):
+    """Parse a helm `--set` style expression into `values`.
+
+    Supports `a.b=1,c[0]=x,list={a,b}` and backslash escapes for `,`, `.`
+    and `=`. `typed=False` keeps every value a string (`--set-string`);
+    `reader(value)` replaces each value (`--set-file`).
+    """
+    values = {} if values is None else values
+    pos = 0
+    while pos < len(text):
+        key, stop, pos = _read(text, pos, '=,')
+        if stop != '=':
+            raise ValueError('key "{}" has no value'.format(_unescape(key)))
+        path = split_key(key)
+
+        if reader is None and text.startswith('{', pos):
+            raw, stop, pos = _read(text, pos + 1, '}')
+            if stop != '}':
+                raise ValueError('list for "{}" is not closed'.format(_unescape(key)))
+            items = []
+            item_pos = 0
+            while item_pos < len(raw):
+                item, _, item_pos = _read(raw, item_pos, ',')
+                items.append(_unescape(item))
+            value = [typed_value(item) if typed else item for item in items]
+            if pos < len(text):
+                if text[pos] != ',':
+                    raise ValueError('unexpected "{}" after list for "{}"'.format(text[pos], _unescape(key)))
+                pos += 1
+        else:
+            raw, _, pos = _read(text, pos, ',')
+            value = _unescape(raw)
+            if reader is not None:
+                value = reader(value)
+            elif typed:
+                value = typed_value(value)
+
+        _assign(values, path, value)
+    return values
+
+
+def read_file(path):
+    with open(path, 'r', encoding='utf8') as fh:
+        return fh.read()
+
+
+def file_references(set_files=()):
+    """{key: file} of --set-file expressions, without reading the files."""
+    references = {}
+    for text in set_files:
+        for path, file in leaves(parse_set(text, reader=lambda value: value)):
+            references[join_key(path)] = file
+    return references
+
+
+def read_references(references, directory=None):
+    """Nested values of {key: file} references; relative files are read from `directory`."""
+    values = {}
+    for key, file in (references or {}).items():
+        _assign(values, split_key(key), read_file(os.path.join(directory or '', file)))
+    return values
+
+
+def parse_options(set_values=(), set_strings=(), set_files=()):
+    """Nested values from --set, --set-string and --set-file, applied in helm's order."""
+    values = {}
+    for text in set_values:
+        parse_set(text, values)
+    for text in set_strings:
+        parse_set(text, values, typed=False)
+    for text in set_files:
+        parse_set(text, values, reader=read_file)
+    return values
+
+
+def merge(base, override):
+    """Deep merge `override` into a copy of `base`; maps merge, anything else replaces."""
+    merged = copy.deepcopy(base) if base else {}
+    for key, value in (override or {}).items():
+        if isinstance(value, dict) and isinstance(merged.get(key), dict):
+            merged[key] = merge(merged[key], value)
+        else:
+            merged[key] = copy.deepcopy(value)
+    return merged
+
+
+def leaves(values, prefix=()):
+    """[(path, value)] of the scalars in the nested maps and lists `values`."""
+    items = values.items() if isinstance(values, dict) else enumerate(values)
+    result = []
+    for key, value in items:
+        path = prefix + (key,)
+        if isinstance(value, (dict, list)) and value:
+            result.extend(leaves(value, path))
+        else:
+            result.append((path, value))
+    return result
+
+
+def overlaps(path, other):
+    """True when one key path is the other or inside it"""
+    length = min(len(path), len(other))
+    return tuple(path[:length]) == tuple(other[:length])
+
+
+def without(values, paths):
+    """Copy of `values` without the keys at `paths`; maps left empty are removed.
+
+    A path into a list removes the whole list.
+    """
+    result = {}
+    for key, value in (values or {}).items():
+        matching = [path[1:] for path in paths if path and path[0] == key]
+        if isinstance(value, list) and matching:
+            continue
+        if any(not path for path in matching):
+            continue
+        if matching and isinstance(value, dict):
+            value = without(value, matching)
+            if not value:
+                continue
+        result[key] = copy.deepcopy(value)
+    return result
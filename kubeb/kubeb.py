@@ -1,14 +1,35 @@
 import sys
 import os
+import math
 
-import yaml
 import time
+import tempfile
+import threading
 import click
-import click_spinner
-spinner = click_spinner.Spinner()
 
-from kubeb import file_util, config, util
-from .generators import (PodderPipelineGenerator, PodderTaskBeanGenerator, LaravelGenerator)
+from kubeb import file_util, config, util, generators, project, tracing
+
+
+class _Spinner(object):
+    """click_spinner.Spinner created on first use, not at import time."""
+
+    _spinner = None
+    enabled = True
+
+    def start(self):
+        if not self.enabled:
+            return
+        if self._spinner is None:
+            import click_spinner
+            self._spinner = click_spinner.Spinner()
+        self._spinner.start()
+
+    def stop(self):
+        if self._spinner is not None:
+            self._spinner.stop()
+
+
+spinner = _Spinner()
 
 
 class Kubeb:
@@ -53,109 +74,853 @@ class Kubeb:
             self.log('Kubeb config file not found in %s', file_util.kubeb_directory)
             return
 
-        config_data = yaml.dump(config.load_config(), default_flow_style=False)
+        config_data = file_util.dump_yaml(config.load_config())
         print(config_data)
 
-    def build(self, message, push):
+    def analyze(self, warn_size=100):
+        """Report what `kubeb build` would send to the docker daemon
+        """
+        from kubeb import docker_context
+
+        context = docker_context.analyze_context(project.current_project().directory)
+
+        self.log('Build context: %s in %d files', docker_context.format_size(context['size']), context['files'])
+        if context['largest']:
+            self.log('Largest directories:')
+            for entry in context['largest']:
+                self.log('  %10s %8d files  %s', docker_context.format_size(entry['size']), entry['files'],
+                         entry['path'])
+
+        if context['size'] > warn_size * 1024 * 1024:
+            self.log('Warning: build context is larger than %d MB. Check your .dockerignore', warn_size)
+
+        return context
+
+    def build(self, message, push, minimal_context=False, content_tag=False, cache_from=None, push_to=None,
+              retries=3):
+        from kubeb import docker_context
 
         if not file_util.config_file_exist():
             self.log('Kubeb config file not found in %s', file_util.kubeb_directory)
             exit(1)
 
-        if not message:
-            marker = '# Add release note:'
-            hint = ['', '', marker]
-            message = click.edit('\n'.join(hint))
-            msg = message.split(marker)[0].rstrip()
-            if not msg:
-                msg = ""
+        msg = self._release_note(message)
+        image = config.get_image()
+        build_needed = True
+        if content_tag:
+            tag = 'c' + docker_context.hash_context(project.current_project().directory)[:16]
+            existing = config.get_version(tag)
+            if existing and (existing.get('pushed') or not push):
+                self.log('Version %s already built from identical sources. Reusing it.', tag)
+                return True
+            if existing:
+                self.log('Version %s already built from identical sources but not pushed yet.', tag)
+                return self._push_existing(image, existing, push_to, retries)
+            if util.docker_image_exists(image, tag):
+                self.log('Docker image %s:%s already exists. Skip build.', image, tag)
+                build_needed = False
         else:
-            msg = '\n'.join(message)
+            tag = 'v' + str(int(round(time.time() * 1000)))
 
-        image = config.get_image()
-        tag = 'v' + str(int(round(time.time() * 1000)))
+        timings = dict()
+        if build_needed:
+            started = time.monotonic()
+            status = self._docker_build(image, tag, minimal_context, cache_from)
+            timings['build'] = round(time.monotonic() - started, 3)
+            if status != 0:
+                self.log('Docker image build failed')
+                return False
+            else:
+                self.log('Docker image build succeed.')
+
+        digest = None
+        pushed = None
+        if push:
+            results = self._push_stage(image, tag, push_to, retries)
+            timings['push'] = dict((target, round(result[1], 3)) for target, result in results.items())
+            pushed = all(result[0] == 0 for result in results.values())
+            if not pushed:
+                self.log('Docker image push failed. Retry later with: kubeb push -v %s', tag)
+            else:
+                self.log('Docker image push succeed.')
+                digest = util.get_docker_image_digest(image, tag)
+
+        config.add_version(tag, msg, digest=digest, pushed=pushed, timings=timings)
+        return pushed is not False
+
+    def _push_existing(self, image, version, push_to=None, retries=3):
+        results = self._push_stage(image, version['tag'], push_to, retries)
+        if any(result[0] != 0 for result in results.values()):
+            self.log('Docker image push failed. Retry later with: kubeb push -v %s', version['tag'])
+            return False
+
+        self.log('Docker image push succeed.')
+        config.set_version_pushed(version, util.get_docker_image_digest(image, version['tag']))
+        return True
+
+    def _release_note(self, message):
+        if message:
+            return '\n'.join(message)
+
+        marker = '# Add release note:'
+        hint = ['', '', marker]
+        message = click.edit('\n'.join(hint))
+        return (message or '').split(marker)[0].rstrip()
+
+    def _push_targets(self, image, push_to=None):
+        targets = [image]
+        for target in list(config.get_registries()) + list(push_to or []):
+            if target not in targets:
+                targets.append(target)
+        return targets
+
+    def _push_stage(self, image, tag, push_to=None, retries=3):
+        """Push `image:tag` to every target concurrently.
+
+        Targets are the configured image plus `registries` from config.yml and
+        `push_to`. Returns {target: (status, duration)}.
+        """
+        results = dict()
+        targets = self._push_targets(image, push_to)
+        for target in targets[1:]:
+            if util.run_docker_tag(image, tag, target) != 0:
+                self.log('[%s] docker tag failed', target)
+                results[target] = (1, 0.0)
+
+        def push_target(target):
+            status, attempts, duration, state = util.push_docker_image(target, tag, retries=retries,
+                                                                        on_line=self._push_progress(target))
+            self._push_summary(target, status, attempts, duration, state)
+            return status, duration
+
+        pending = [target for target in targets if target not in results]
+        import concurrent.futures
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, len(pending))) as executor:
+            futures = [project.submit(executor, push_target, target) for target in pending]
+            for target, future in zip(pending, futures):
+                results[target] = future.result()
+
+        return results
+
+    def _push_progress(self, target):
+        """on_line callback for util.push_docker_image, logging layer changes and push times"""
+        printed = dict()
+
+        def progress(line, parsed, state):
+            if parsed is None:
+                self.log('[%s] %s', target, line)
+                return
+
+            layer, status = parsed
+            if printed.get(layer) == status:
+                return
+            printed[layer] = status
+            if status == 'Pushed':
+                self.log('[%s] %s: %s in %.1fs (%d/%d layers done)', target, layer, status,
+                         state.durations[layer], state.done, len(state.layers))
+            else:
+                self.log('[%s] %s: %s', target, layer, status)
+        return progress
+
+    def _push_summary(self, target, status, attempts, duration, state):
+        slowest = state.slowest()
+        self.log('[%s] %s in %.1fs after %d attempt(s): %d layers pushed, %d existing%s',
+                 target, 'pushed' if status == 0 else 'failed', duration, attempts,
+                 state.count('Pushed'), state.count('Layer already exists'),
+                 ', slowest %s %.1fs' % slowest if slowest else '')
+
+    async def _push_stage_async(self, image, tag, push_to=None, retries=3):
+        """_push_stage() for asyncio code"""
+        import asyncio
+
+        results = dict()
+        targets = self._push_targets(image, push_to)
+        for target in targets[1:]:
+            if await util.run_docker_tag_async(image, tag, target) != 0:
+                self.log('[%s] docker tag failed', target)
+                results[target] = (1, 0.0)
+
+        async def push_target(target):
+            status, attempts, duration, state = await util.push_docker_image_async(
+                target, tag, retries=retries, on_line=self._push_progress(target))
+            self._push_summary(target, status, attempts, duration, state)
+            return status, duration
+
+        pending = [target for target in targets if target not in results]
+        for target, result in zip(pending, await asyncio.gather(*[push_target(target) for target in pending])):
+            results[target] = result
+
+        return results
+
+    def _docker_build(self, image, tag, minimal_context=False, cache_from=None):
+        from kubeb import docker_context
 
         self.log('Building docker image {}:{}...'.format(image, tag))
 
-        spinner.start()
-        status = util.run_docker_build(image, tag, os.getcwd())
-        spinner.stop()
-        if status != 0:
-            self.log('Docker image build failed')
-            return
+        if minimal_context:
+            with tempfile.TemporaryFile() as context_file:
+                count = docker_context.write_context_tar(project.current_project().directory, context_file)
+                self.log('Sending filtered build context: %d files, %s', count,
+                         docker_context.format_size(context_file.tell()))
+                context_file.seek(0)
+                spinner.start()
+                status = util.run_docker_build(image, tag, project.current_project().directory, context_file=context_file,
+                                               cache_from=cache_from)
+                spinner.stop()
         else:
-            self.log('Docker image build succeed.')
-
-        if push:
             spinner.start()
-            status = util.run_docker_push(image, tag)
+            status = util.run_docker_build(image, tag, project.current_project().directory, cache_from=cache_from)
             spinner.stop()
-            if status != 0:
-                self.log('Docker image push failed')
-                return
-            else:
-                self.log('Docker image push succeed.')
 
-        config.add_version(tag, msg)
+        return status
 
-    def push(self, version=None):
+    async def _docker_build_async(self, image, tag, minimal_context=False, cache_from=None):
+        from kubeb import docker_context
+
+        self.log('Building docker image {}:{}...'.format(image, tag))
+        directory = project.current_project().directory
+
+        if not minimal_context:
+            return await util.run_docker_build_async(image, tag, directory, cache_from=cache_from)
+
+        with tempfile.TemporaryFile() as context_file:
+            count = await project.run_in_thread(docker_context.write_context_tar, directory, context_file)
+            self.log('Sending filtered build context: %d files, %s', count,
+                     docker_context.format_size(context_file.tell()))
+            context_file.seek(0)
+            return await util.run_docker_build_async(image, tag, directory, context_file=context_file,
+                                                     cache_from=cache_from)
+
+    def push(self, version=None, push_to=None, retries=3):
 
         if not file_util.config_file_exist():
             self.log('Kubeb config file not found')
             return
 
-        deploy_version = config.get_version(version)
+        deploy_version = config.get_version(version) if version else config.get_latest_version()
         if not deploy_version:
             self.log('No deploy version found')
             return
 
         image = config.get_image()
         self.log('docker push {}:{}'.format(image, deploy_version["tag"]))
+        return self._push_existing(image, deploy_version, push_to, retries)
 
-        spinner.start()
-        status = util.run_docker_push(image, deploy_version["tag"])
-        spinner.stop()
-        if status != 0:
-            self.log('Docker image push failed')
-        else:
-            self.log('Docker image push succeed.')
-
-    def deploy(self, version, options, dry_run, rollback=True):
+    def deploy(self, version, options, dry_run, rollback=True, timeout=None, use_cache=True, always=False,
+               plan=False, watch=True, variables=None, write_values=False, reset_options=False, preflight=True,
+               canary=False, canary_steps=None, option_files=()):
 
         if not file_util.config_file_exist():
             self.log('Kubeb config file not found')
-            return
+            return False
 
         deploy_version = config.get_version(version)
         if not deploy_version:
             self.log('No deployable version found')
-            return
+            return False
 
         self.log('Deploying version: %s', deploy_version["tag"])
-        file_util.generate_helm_file(config.get_template(), config.get_ext_template(), config.get_image(),
-                                     deploy_version["tag"], config.get_current_environment())
+        env = config.get_current_environment()
+        release = config.get_release_name(env)
+        kube_context = config.get_kube_context(env)
+        merged_options = self._deploy_options(env, options, reset_options)
+        if merged_options is None:
+            return False
+        values_file, values = self._helm_values(env, deploy_version["tag"], None, use_cache, variables,
+                                                write_values, merged_options)
+        if values_file is None and values is None:
+            self.log('Render helm values failed')
+            return False
+
+        fingerprint_key = file_util.get_deploy_fingerprint_key(release, env, kube_context)
+        fingerprint = file_util.get_deploy_fingerprint(file_util.get_helm_chart_path(config.get_template()),
+                                                       values_file, None, values)
+        unchanged = fingerprint is not None and fingerprint == file_util.get_last_deploy_fingerprint(fingerprint_key)
+
+        if plan:
+            if unchanged:
+                self.log('Plan: release %s is up to date, no upgrade needed.', release)
+            else:
+                self.log('Plan: release %s will be upgraded to %s.', release, deploy_version["tag"])
+            return True
+
+        if unchanged and not always and not dry_run:
+            self.log('Chart and values unchanged since last deploy. Skip install (use --always to force).')
+            return True
+
+        if preflight and not self._preflight(release, fingerprint, (values_file, values)):
+            return False
 
-        if options and not dry_run:
-            self.log('Saving deploy options ...')
-            file_util.save_deploy_options(options)
+        if (options or reset_options) and not dry_run:
+            self._save_deploy_options(env, options, reset_options, option_files)
+
+        canary = canary and not dry_run
+        if canary:
+            canary_settings = config.get_canary_settings(env)
+            canary_release = release + canary_settings['suffix']
+            if not self._canary(release, canary_release, canary_settings, canary_steps or canary_settings['steps'],
+                                values_file, values, timeout, watch, kube_context):
+                return False
 
         self.log('Installing application ...')
+        watch = watch and not dry_run
         spinner.start()
-        status = util.run_helm_install(config.get_name(), config.get_template(), dry_run, options)
+        status, _, _ = util.run_helm_install(release, config.get_template(), dry_run,
+                                             timeout=timeout, wait=not watch, kube_context=kube_context,
+                                             values_file=values_file, values=values)
         spinner.stop()
+        if status == 0 and watch:
+            self.log('Waiting for rollout ...')
+            ready, failure = util.wait_for_rollout(release, timeout=timeout, kube_context=kube_context,
+                                                   log=lambda line: self.log('%s', line))
+            if not ready:
+                self.log('Rollout failed: %s', failure)
+                status = 1
+        if canary:
+            # promoted or rolled back, the stable release serves all traffic again
+            self._remove_canary(canary_release, kube_context)
         if status != 0:
             self.log('Install application failed.')
+            if not dry_run:
+                file_util.save_deploy_fingerprint(fingerprint_key, None)
 
             if dry_run is False and rollback:
-                last_working_revision = util.get_last_working_revision(config.get_name())
+                last_working_revision = util.get_last_working_revision(release, kube_context=kube_context)
                 if not last_working_revision:
                     self.log('Last working revision not found. Skip rollback')
-                    return
+                    return False
 
                 self.log('Rollback application to last working revision {}'.format(last_working_revision))
                 self.rollback(last_working_revision)
+            return False
+
+        self.log('Install application succeed.')
+        if not dry_run:
+            file_util.save_deploy_fingerprint(fingerprint_key, fingerprint)
+        return True
+
+    def _canary(self, release, canary_release, settings, steps, values_file, values, timeout=None, watch=True,
+                kube_context=None):
+        """Run the new version as a small second release next to `release` and watch it.
+
+        Each step of `steps` (percent of the stable replicas) upgrades the
+        canary release, waits for it to be ready and soaks it for
+        ``settings['soak']`` seconds. Returns True when every step stayed
+        healthy; a failed canary is removed and the stable release is left
+        untouched.
+        """
+        from kubeb import helm_options
+
+        template = config.get_template()
+        chart_values = file_util.get_yaml_dict(os.path.join(file_util.get_helm_chart_path(template),
+                                                            'values.yaml')) or {}
+        if 'canary' not in chart_values:
+            self.log('Template %s does not support canary deploys', template)
+            return False
+
+        invalid = [step for step in steps if not isinstance(step, (int, float)) or not 0 < step <= 100]
+        if invalid:
+            self.log('Invalid canary steps %s, expected percentages between 0 and 100', invalid)
+            return False
+
+        if values is None:
+            with open(values_file, 'r', encoding='utf8') as fh:
+                values = fh.read()
+        base = (file_util.load_yaml_documents(values) or [{}])[0]
+        stable_replicas = int(base.get('replicaCount') or chart_values.get('replicaCount') or 1)
+        # canary pods carry the stable release label, see laravel.podRelease in the chart
+        selector = 'track=canary,release in ({},{})'.format(release, canary_release)
+
+        for percent in steps:
+            replicas = max(1, int(math.ceil(stable_replicas * percent / 100.0)))
+            self.log('Canary %s%%: %d replica(s) in release %s next to %d stable', percent, replicas,
+                     canary_release, stable_replicas)
+            canary_values = file_util.dump_yaml(helm_options.merge(base, dict(
+                replicaCount=replicas, canary=dict(enabled=True, stableRelease=release))))
+
+            result = util.run_helm_install(canary_release, template, False, timeout=timeout,
+                                           values=canary_values, kube_context=kube_context, wait=not watch,
+                                           printout=False)
+            ok, failure = result.ok, 'helm exited with {}'.format(result.exitcode)
+            if not ok:
+                for line in (result.error or result.output).splitlines()[-10:]:
+                    self.log('  %s', line)
+            elif watch:
+                ok, failure = util.wait_for_rollout(canary_release, timeout=timeout, kube_context=kube_context,
+                                                    selector=selector, log=lambda line: self.log('%s', line))
+            if ok:
+                self.log('Soaking canary for %ds ...', settings['soak'])
+                ok, failure = util.soak_pods(selector, settings['soak'], kube_context=kube_context,
+                                             interval=settings['interval'],
+                                             max_restarts=settings['max_restarts'],
+                                             unready_grace=settings['unready_grace'],
+                                             log=lambda line: self.log('%s', line))
+            if not ok:
+                self.log('Canary failed: %s', failure)
+                self._remove_canary(canary_release, kube_context)
+                return False
+
+        self.log('Canary healthy, promoting release %s', release)
+        return True
+
+    def _remove_canary(self, canary_release, kube_context=None):
+        self.log('Removing canary release %s ...', canary_release)
+        if util.run_helm_uninstall(canary_release, kube_context=kube_context) != 0:
+            self.log('Removing canary release failed. Remove it with: helm delete --purge %s', canary_release)
+
+    def deploy_many(self, envs, version, options, dry_run, rollback=True, timeout=None, jobs=4,
+                    fail_fast=False, use_cache=True, always=False, plan=False, watch=True, variables=None,
+                    write_values=False, reset_options=False, preflight=True, option_files=()):
+        """Deploy one version to several environments concurrently.
+
+        ``envs=None`` deploys every configured environment. Values are
+        rendered up front; only the helm installs run on the worker pool.
+        Each environment gets its own values file, release name
+        (``environments.<env>.release``) and kube context
+        (``environments.<env>.kube_context``), and rolls back on its own.
+        Environments whose chart and values fingerprint match their last
+        successful deploy are skipped unless ``always`` is set, the others
+        run the pre-flight check before installing.
+        """
+        if not file_util.config_file_exist():
+            self.log('Kubeb config file not found')
+            return False
+
+        known_envs = config.get_environments()
+        if envs is None:
+            envs = known_envs
+        unknown_envs = [env for env in envs if env not in known_envs]
+        if unknown_envs:
+            self.log('Environment not found: %s', ', '.join(unknown_envs))
+            return False
+
+        targets = dict()
+        for env in envs:
+            target = (config.get_release_name(env), config.get_kube_context(env))
+            if target in targets:
+                self.log('Environments %s and %s both deploy release %s to the same cluster. '
+                         'Set environments.<env>.release or kube_context in config.yml',
+                         targets[target], env, target[0])
+                return False
+            targets[target] = env
+
+        deploy_version = config.get_version(version)
+        if not deploy_version:
+            self.log('No deployable version found')
+            return False
+
+        self.log('Deploying version %s to %s', deploy_version["tag"], ', '.join(envs))
+        results = dict()
+        rendered = dict()
+        fingerprints = dict()
+        chart_path = file_util.get_helm_chart_path(config.get_template())
+        for env in envs:
+            env_options = self._deploy_options(env, options, reset_options, '[%s] ' % env)
+            if env_options is None:
+                results[env] = 'failed'
+                continue
+            if (options or reset_options) and not dry_run and not plan:
+                self._save_deploy_options(env, options, reset_options, option_files, '[%s] ' % env)
+
+            rendered[env] = self._helm_values(env, deploy_version["tag"], file_util.get_helm_value_file(env),
+                                              use_cache, variables, write_values, env_options)
+            if rendered[env] == (None, None):
+                self.log('[%s] Render helm values failed', env)
+                results[env] = 'failed'
+                continue
+
+            key = file_util.get_deploy_fingerprint_key(config.get_release_name(env), env,
+                                                       config.get_kube_context(env))
+            fingerprints[env] = key, file_util.get_deploy_fingerprint(chart_path, rendered[env][0], None,
+                                                                      rendered[env][1])
+            if fingerprints[env][1] == file_util.get_last_deploy_fingerprint(key) and (plan or not always):
+                results[env] = 'unchanged'
+
+        if plan:
+            for env in envs:
+                self.log('%-20s %s', env, results.get(env, 'upgrade'))
+            return 'failed' not in results.values()
+
+        if 'failed' in results.values() and fail_fast:
+            return False
+
+        cancel_event = threading.Event()
+        template = config.get_template()
+        release_options = [(env, config.get_release_name(env), config.get_kube_context(env))
+                           for env in envs if env not in results]
+
+        def deploy_env(env, release, kube_context):
+            if cancel_event.is_set():
+                return 'skipped'
+            with tracing.span('deploy.env', env=env):
+                if preflight and not self._preflight(release, fingerprints[env][1], rendered[env], '[%s] ' % env):
+                    return 'failed'
+                return self._deploy_env(env, release, kube_context, template, rendered[env],
+                                        dry_run, rollback, timeout, cancel_event, watch)
+
+        import concurrent.futures
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, jobs)) as executor:
+            futures = {project.submit(executor, deploy_env, *target): target[0] for target in release_options}
+            for future in concurrent.futures.as_completed(futures):
+                env = futures[future]
+                try:
+                    results[env] = future.result()
+                except Exception as e:
+                    self.log('[%s] %s', env, e)
+                    results[env] = 'failed'
+
+                if results[env] != 'succeeded' and fail_fast and not cancel_event.is_set():
+                    self.log('Cancelling remaining deploys')
+                    cancel_event.set()
+
+        if not dry_run:
+            for env, (key, fingerprint) in fingerprints.items():
+                if results.get(env) == 'succeeded':
+                    file_util.save_deploy_fingerprint(key, fingerprint)
+                elif results.get(env) != 'unchanged':
+                    file_util.save_deploy_fingerprint(key, None)
+
+        self.log('')
+        for env in envs:
+            self.log('%-20s %s', env, results.get(env, 'skipped'))
+
+        return all(status in ('succeeded', 'unchanged') for status in results.values())
+
+    def _deploy_options(self, env, options, reset_options=False, prefix=''):
+        """--set options saved for `env` with the new ones merged over them, None if a saved file is missing"""
+        from kubeb import helm_options
+
+        if reset_options:
+            return helm_options.merge(dict(), options)
+
+        try:
+            saved_files = helm_options.read_references(config.get_deploy_option_files(env),
+                                                       project.current_project().directory)
+        except (IOError, ValueError) as e:
+            self.log('%sSaved --set-file option failed: %s. Pass it again or use --reset-options', prefix, e)
+            return None
+        return helm_options.merge(helm_options.merge(config.get_deploy_options(env), saved_files), options)
+
+    def _save_deploy_options(self, env, options, reset_options=False, option_files=(), prefix=''):
+        """Save the --set options of `env` for the next deploys.
+
+        --set-file options are saved as references to their files, values
+        of secret-like keys (see variables.split_secrets) are not saved.
+        """
+        from kubeb import helm_options, variables
+
+        self.log('%sSaving deploy options ...', prefix)
+        saved = dict() if reset_options else config.get_deploy_options(env)
+        saved_files = dict() if reset_options else config.get_deploy_option_files(env)
+
+        new_files = helm_options.file_references(option_files)
+        new_paths = [path for path, _ in helm_options.leaves(options or {})]
+        files = dict((key, file) for key, file in saved_files.items()
+                     if not any(helm_options.overlaps(helm_options.split_key(key), path) for path in new_paths))
+        files.update(new_files)
+
+        plain = helm_options.without(helm_options.merge(saved, options),
+                                     [helm_options.split_key(key) for key in files])
+        patterns = variables.secret_patterns(env)
+        secret = []
+        for path, _ in helm_options.leaves(plain):
+            for i, part in enumerate(path):
+                if isinstance(part, str) and variables.is_secret(part, patterns):
+                    secret.append(path[:i + 1])
+                    break
+        if secret:
+            self.log('%sNot saving secret-like options %s, pass them again on the next deploy', prefix,
+                     ', '.join(sorted(set(helm_options.join_key(path) for path in secret))))
+        config.set_deploy_options(env, helm_options.without(plain, secret), files)
+
+    def _helm_values(self, env, tag, output, use_cache, variables, write_values, options=None):
+        """(values_file, None) with write_values, else (None, values rendered in memory)."""
+        if write_values:
+            return file_util.generate_helm_file(config.get_template(), config.get_ext_template(),
+                                                config.get_image(), tag, env, output=output,
+                                                use_cache=use_cache, variables=variables, options=options), None
+
+        # don't leave plaintext values from an earlier file based deploy around
+        file_util.remove_helm_file(output)
+        return None, file_util.render_helm_values(config.get_template(), config.get_ext_template(),
+                                                  config.get_image(), tag, env, variables=variables,
+                                                  options=options)
+
+    def _preflight(self, release, fingerprint, rendered, prefix=''):
+        """Lint and validate the chart with the rendered values, False if helm would be given a broken release"""
+        from kubeb import preflight
+
+        values_file, values = rendered
+        problems, cached = preflight.check(release, file_util.get_helm_chart_path(config.get_template()),
+                                           fingerprint, values_file, values)
+        if problems:
+            self.log('%sPre-flight check failed:', prefix)
+            for problem in problems:
+                self.log('%s  %s', prefix, problem)
+            return False
+
+        self.log('%sPre-flight check passed%s.', prefix, ' (cached)' if cached else '')
+        return True
+
+    def _deploy_env(self, env, release, kube_context, template, rendered, dry_run, rollback,
+                    timeout, cancel_event, watch=True):
+        values_file, values = rendered
+        started = time.monotonic()
+        self.log('[%s] Installing release %s ...', env, release)
+        watch = watch and not dry_run
+        result = util.run_helm_install(release, template, dry_run,
+                                       timeout=timeout,
+                                       values_file=values_file,
+                                       values=values,
+                                       kube_context=kube_context,
+                                       printout=False,
+                                       cancel_event=cancel_event,
+                                       wait=not watch)
+        cancelled = result.cancelled
+        if result.ok and watch:
+            ready, failure = util.wait_for_rollout(release, timeout=timeout, kube_context=kube_context,
+                                                   log=lambda line: self.log('[%s] %s', env, line),
+                                                   cancel_event=cancel_event)
+            if ready:
+                self.log('[%s] Rollout succeed in %.1fs', env, time.monotonic() - started)
+                return 'succeeded'
+            cancelled = failure == 'cancelled'
+            if not cancelled:
+                self.log('[%s] Rollout failed: %s', env, failure)
+        elif result.ok:
+            self.log('[%s] Install succeed in %.1fs', env, result.duration)
+            return 'succeeded'
+        elif not cancelled:
+            self.log('[%s] Install failed in %.1fs', env, result.duration)
+            for line in (result.error or result.output).splitlines()[-10:]:
+                self.log('[%s]   %s', env, line)
+
+        if cancelled:
+            self.log('[%s] Install cancelled', env)
+
+        if dry_run is False and rollback:
+            last_working_revision = util.get_last_working_revision(release, kube_context=kube_context)
+            if not last_working_revision:
+                self.log('[%s] Last working revision not found. Skip rollback', env)
+                return 'failed'
+
+            self.log('[%s] Rollback to last working revision %s', env, last_working_revision)
+            status = util.run_helm_rollback(release, last_working_revision, kube_context=kube_context,
+                                            printout=False)
+            return 'rolled back' if status == 0 else 'rollback failed'
+
+        return 'cancelled' if cancelled else 'failed'
+
+    def ship(self, message, minimal_context=False, content_tag=False, cache_from=None, push_to=None, retries=3,
+             options=None, rollback=True, timeout=None, always=False, watch=True, variables=None,
+             write_values=False, reset_options=False, preflight=True, option_files=()):
+        """Build, push and deploy to the current environment in one overlapped run.
+
+        Helm values are rendered, the release is checked for a pending helm
+        operation and the pre-flight check runs while the image builds and
+        pushes; helm only installs once the push succeeded.
+        """
+        import asyncio
+
+        if not file_util.config_file_exist():
+            self.log('Kubeb config file not found in %s', file_util.kubeb_directory)
+            return False
+
+        msg = self._release_note(message)
+        return asyncio.run(self._ship(msg, minimal_context, content_tag, cache_from, push_to, retries,
+                                      options or dict(), rollback, timeout, always, watch, variables,
+                                      write_values, reset_options, preflight, option_files))
+
+    async def _ship(self, msg, minimal_context, content_tag, cache_from, push_to, retries, options, rollback,
+                    timeout, always, watch, variables, write_values, reset_options, preflight, option_files):
+        import asyncio
+        from kubeb import docker_context
+
+        image = config.get_image()
+        env = config.get_current_environment()
+        name = config.get_release_name(env)
+        kube_context = config.get_kube_context(env)
+
+        existing = None
+        build_needed = True
+        if content_tag:
+            context_hash = await project.run_in_thread(docker_context.hash_context,
+                                                       project.current_project().directory)
+            tag = 'c' + context_hash[:16]
+            existing = config.get_version(tag)
+            if existing:
+                self.log('Version %s already built from identical sources. Reusing it.', tag)
+                build_needed = False
+            elif await util.docker_image_exists_async(image, tag):
+                self.log('Docker image %s:%s already exists. Skip build.', image, tag)
+                build_needed = False
         else:
+            tag = 'v' + str(int(round(time.time() * 1000)))
+        push_needed = not (existing and existing.get('pushed'))
+
+        async def image_stage():
+            timings = dict()
+            if build_needed:
+                started = time.monotonic()
+                status = await self._docker_build_async(image, tag, minimal_context, cache_from)
+                timings['build'] = round(time.monotonic() - started, 3)
+                if status != 0:
+                    self.log('Docker image build failed')
+                    return None
+                self.log('Docker image build succeed.')
+
+            digest = existing.get('digest') if existing else None
+            if push_needed:
+                results = await self._push_stage_async(image, tag, push_to, retries)
+                timings['push'] = dict((target, round(result[1], 3)) for target, result in results.items())
+                if any(result[0] != 0 for result in results.values()):
+                    self.log('Docker image push failed. Retry later with: kubeb push -v %s', tag)
+                    if not existing:
+                        config.add_version(tag, msg, pushed=False, timings=timings)
+                    return None
+                self.log('Docker image push succeed.')
+                digest = await util.get_docker_image_digest_async(image, tag)
+            return timings, digest
+
+        async def preflight_stage():
+            history = await util.get_helm_history_async(name, max_revisions=1, kube_context=kube_context)
+            if history:
+                status = (history[-1].get('status') or '').upper().replace('-', '_')
+                if status.startswith('PENDING'):
+                    self.log('Release %s has a helm operation in progress (%s)', name, status)
+                    return None
+
+            merged_options = self._deploy_options(env, options, reset_options)
+            if merged_options is None:
+                return None
+            rendered = await project.run_in_thread(self._helm_values, env, tag, None, True, variables,
+                                                   write_values, merged_options)
+            if rendered == (None, None):
+                self.log('Render helm values failed')
+                return None
+            self.log('Helm values for %s rendered.', env)
+
+            fingerprint = file_util.get_deploy_fingerprint(file_util.get_helm_chart_path(config.get_template()),
+                                                           rendered[0], None, rendered[1])
+            if preflight and not await project.run_in_thread(self._preflight, name, fingerprint, rendered):
+                return None
+            return merged_options, rendered, fingerprint
+
+        image_task = asyncio.ensure_future(image_stage())
+        try:
+            checked = await preflight_stage()
+            if checked is None:
+                return False
+            built = await image_task
+        finally:
+            image_task.cancel()
+        if built is None:
+            return False
+
+        timings, digest = built
+        if not existing:
+            config.add_version(tag, msg, digest=digest, pushed=True, timings=timings)
+        elif push_needed:
+            config.set_version_pushed(existing, digest)
+
+        merged_options, (values_file, values), fingerprint = checked
+        fingerprint_key = file_util.get_deploy_fingerprint_key(name, env, kube_context)
+        if not always and fingerprint is not None \
+                and fingerprint == file_util.get_last_deploy_fingerprint(fingerprint_key):
+            self.log('Chart and values unchanged since last deploy. Skip install (use --always to force).')
+            return True
+
+        if options or reset_options:
+            self._save_deploy_options(env, options, reset_options, option_files)
+
+        self.log('Installing application %s ...', tag)
+        result = await util.run_helm_install_async(name, config.get_template(), False, timeout=timeout,
+                                                   wait=not watch, values_file=values_file, values=values,
+                                                   kube_context=kube_context)
+        ok = result.ok
+        if ok and watch:
+            self.log('Waiting for rollout ...')
+            ok, failure = await util.wait_for_rollout_async(name, timeout=timeout, kube_context=kube_context,
+                                                            log=lambda line: self.log('%s', line))
+            if not ok:
+                self.log('Rollout failed: %s', failure)
+        if ok:
             self.log('Install application succeed.')
+            file_util.save_deploy_fingerprint(fingerprint_key, fingerprint)
+            return True
+
+        self.log('Install application failed.')
+        file_util.save_deploy_fingerprint(fingerprint_key, None)
+        if rollback:
+            last_working_revision = await util.get_last_working_revision_async(name, kube_context=kube_context)
+            if not last_working_revision:
+                self.log('Last working revision not found. Skip rollback')
+                return False
+
+            self.log('Rollback application to last working revision {}'.format(last_working_revision))
+            if await util.run_helm_rollback_async(name, last_working_revision, kube_context=kube_context) != 0:
+                self.log('Rollback application to revision failed.')
+            else:
+                self.log('Rollback application to revision succeed.')
+        return False
+
+    def _workspace_plan(self, root, only=None):
+        from kubeb import workspace
+
+        try:
+            return workspace.plan(workspace.discover(root), only)
+        except ValueError as e:
+            self.log('Workspace error: %s', e)
+            return None
+
+    def workspace_list(self, root):
+        """Print the services of a workspace in build order
+        """
+        services = self._workspace_plan(root)
+        if services is None:
+            return False
+
+        for service in services:
+            self.log('%-30s %-40s %s', service.name, os.path.relpath(service.directory, root),
+                     ', '.join(service.depends_on))
+        return True
+
+    def _workspace_run(self, root, only, jobs, fail_fast, name, action):
+        from kubeb import workspace
+
+        services = self._workspace_plan(root, only)
+        if services is None:
+            return False
+        if not services:
+            self.log('No kubeb application found under %s', root)
+            return False
+
+        # concurrent services would garble a shared terminal spinner
+        spinner.enabled = False
+        results = workspace.run(services, action, name, jobs=jobs, fail_fast=fail_fast,
+                                log=lambda line: self.log('%s', line))
+
+        self.log('')
+        for service in services:
+            self.log('%-30s %s', service.name, results.get(service.name, 'skipped'))
+        return all(status == 'succeeded' for status in results.values())
+
+    def workspace_build(self, root, only=None, jobs=4, fail_fast=False, message='', push=False,
+                        minimal_context=False, content_tag=False, push_to=None, retries=3):
+        """Build every application of a workspace, dependencies first
+        """
+        return self._workspace_run(root, only, jobs, fail_fast, 'build',
+                                   lambda service: Kubeb().build((message,), push, minimal_context, content_tag,
+                                                                 push_to=push_to, retries=retries))
+
+    def workspace_deploy(self, root, only=None, jobs=4, fail_fast=False, dry_run=False, rollback=True,
+                         timeout=None, always=False, plan=False, watch=True, preflight=True):
+        """Deploy the latest version of every application of a workspace to its current environment
+        """
+        return self._workspace_run(root, only, jobs, fail_fast, 'deploy',
+                                   lambda service: Kubeb().deploy(None, dict(), dry_run, rollback, timeout,
+                                                                  always=always, plan=plan, watch=watch,
+                                                                  preflight=preflight))
 
     def delete(self):
 
@@ -163,21 +928,32 @@ class Kubeb:
             self.log('Kubeb config file not found')
             return
 
-        status = util.run_helm_uninstall(config.get_name())
+        env = config.get_current_environment()
+        status = util.run_helm_uninstall(config.get_release_name(env), kube_context=config.get_kube_context(env))
         if status != 0:
             self.log('Delete application failed')
             return
 
         self.log('Uninstall application succeed.')
 
-    def version(self):
+    def version(self, previous=False, last=None):
         """Show current application versions
         """
         if not file_util.config_file_exist():
             self.log('Kubeb config file not found in %s', file_util.kubeb_directory)
             return
 
-        versions = config.get_versions()
+        if previous:
+            previous_version = config.get_previous_version()
+            if not previous_version:
+                self.log('No previous version found in %s', file_util.kubeb_directory)
+                return
+            versions = [previous_version]
+        elif last:
+            versions = config.get_recent_versions(last)
+        else:
+            versions = config.get_versions()
+
         if not versions or len(versions) == 0:
             self.log('No version found in %s', file_util.kubeb_directory)
             return
@@ -186,6 +962,7 @@ class Kubeb:
             self.log('- %s: %s', version['tag'], version['message'])
 
     def history(self):
+        from kubeb import release_state
 
         if not file_util.config_file_exist():
             self.log('Kubeb config file not found in %s', file_util.kubeb_directory)
@@ -193,39 +970,85 @@ class Kubeb:
 
         self.log('Get application deploy history ...')
         spinner.start()
-        status = util.run_helm_history(config.get_name())
+        env = config.get_current_environment()
+        snapshot = release_state.refresh(config.get_release_name(env), config.get_kube_context(env))
         spinner.stop()
-        if status != 0:
+        if snapshot is None:
             self.log('Get application deploy history failed.')
-        else:
-            self.log('Get application deploy history succeed.')
+            return
+
+        self.log('%-10s %-26s %-12s %-30s %s', 'REVISION', 'UPDATED', 'STATUS', 'CHART', 'DESCRIPTION')
+        for revision in release_state.revisions(snapshot):
+            self.log('%-10s %-26s %-12s %-30s %s', revision['revision'], revision['updated'] or '',
+                     revision['status'] or '', revision['chart'] or '', revision['description'] or '')
+        self.log('Get application deploy history succeed.')
+
+    def status(self, all_envs=False, jobs=8):
+        """Show the latest revision of the current release or of every environment's release
+        """
+        from kubeb import release_state
+
+        if not file_util.config_file_exist():
+            self.log('Kubeb config file not found in %s', file_util.kubeb_directory)
+            return
+
+        envs = config.get_environments() if all_envs else [config.get_current_environment()]
+        targets = [(env, config.get_release_name(env), config.get_kube_context(env)) for env in envs]
+
+        import concurrent.futures
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, min(jobs, len(targets)))) as executor:
+            futures = [project.submit(executor, release_state.refresh, release, kube_context)
+                       for _, release, kube_context in targets]
+            snapshots = [future.result() for future in futures]
+
+        self.log('%-20s %-30s %-10s %-12s %s', 'ENVIRONMENT', 'RELEASE', 'REVISION', 'STATUS', 'LAST GOOD')
+        for (env, release, _), snapshot in zip(targets, snapshots):
+            if snapshot is None:
+                self.log('%-20s %-30s %-10s %-12s %s', env, release, '-', 'UNKNOWN', '-')
+                continue
+            latest = release_state.latest_revision(snapshot) or {}
+            self.log('%-20s %-30s %-10s %-12s %s', env, release, latest.get('revision', '-'),
+                     latest.get('status') or 'NOT INSTALLED', release_state.last_working_revision(snapshot) or '-')
 
     def rollback(self, revision):
+        from kubeb import release_state
 
         if not file_util.config_file_exist():
             self.log('Kubeb config file not found in %s', file_util.kubeb_directory)
             return
 
+        env = config.get_current_environment()
+        release = config.get_release_name(env)
+        kube_context = config.get_kube_context(env)
+        if revision == 0:
+            snapshot = release_state.refresh(release, kube_context)
+            last_working_revision = snapshot and release_state.last_working_revision(snapshot)
+            if last_working_revision:
+                revision = last_working_revision
+
         self.log('Rollback application to revision {} ...'.format(revision))
         spinner.start()
-        status = util.run_helm_rollback(config.get_name(), revision)
+        status = util.run_helm_rollback(release, revision, kube_context=kube_context)
         spinner.stop()
         if status != 0:
             self.log('Rollback application to revision failed.')
         else:
             self.log('Rollback application to revision succeed.')
 
+        file_util.save_deploy_fingerprint(file_util.get_deploy_fingerprint_key(release, env, kube_context), None)
+
     def env(self, env):
 
         if not file_util.config_file_exist():
             self.log('Kubeb config file not found in %s', file_util.kubeb_directory)
             return
 
-        environment = config.get_env(env)
-        if not environment:
+        if env not in config.get_environments():
             self.log('Environment not found')
             self.log('Initiate environment %s in %s', env, file_util.kubeb_directory)
             file_util.generate_environment_file(env, config.get_template())
+            config.add_environment(env)
+            self.log('Environment %s deploys release %s', env, config.get_release_name(env))
 
         config.set_current_environement(env)
         self.log('Now use %s', env)
@@ -239,15 +1062,74 @@ class Kubeb:
         env = config.get_current_environment()
         config.set_environment_variable(env, env_vars)
 
+    def env_vars(self, env=None, explain=False, cli_vars=None):
+        """Print the resolved variables of an environment
+        """
+        from kubeb import variables
+
+        if not file_util.config_file_exist():
+            self.log('Kubeb config file not found in %s', file_util.kubeb_directory)
+            return
+
+        env = env or config.get_current_environment()
+        if explain:
+            for layer, source, values in variables.get_layers(env, cli_vars):
+                self.log('%-11s %-40s %d keys', layer, source, len(values))
+            self.log('')
+
+        patterns = variables.secret_patterns(env)
+        for key, (value, layer, overridden) in sorted(variables.resolve(env, cli_vars).items()):
+            if variables.is_secret(key, patterns):
+                value = variables.mask(value)
+            if explain:
+                line = '%s=%s  [%s]' % (key, value, layer)
+                if overridden:
+                    line += ' overrides ' + ', '.join(overridden)
+                print(line)
+            else:
+                print('%s=%s' % (key, value))
+
+    def env_diff(self, env_a, env_b):
+        """Compare the resolved variables of two environments
+        """
+        from kubeb import variables
+
+        if not file_util.config_file_exist():
+            self.log('Kubeb config file not found in %s', file_util.kubeb_directory)
+            return
+
+        only_a, only_b, changed = variables.diff(env_a, env_b)
+        for key in only_a:
+            print('- %s (only in %s)' % (key, env_a))
+        for key in only_b:
+            print('+ %s (only in %s)' % (key, env_b))
+        patterns = tuple(variables.secret_patterns(env_a)) + tuple(variables.secret_patterns(env_b))
+        for key, (value_a, value_b) in changed.items():
+            if variables.is_secret(key, patterns):
+                value_a, value_b = variables.mask(value_a), variables.mask(value_b)
+            print('~ %s: %s -> %s' % (key, value_a, value_b))
+        if not (only_a or only_b or changed):
+            self.log('No differences between %s and %s', env_a, env_b)
+
     def template(self,name, path, force):
 
         if file_util.template_exist(name) and not force:
             self.log('Kubeb template found. Please change name or --force')
             return
 
-        file_util.add_ext_template(name, path)
+        copied, removed = file_util.add_ext_template(name, path)
 
-        self.log('Kubeb template add to %s', click.format_filename(file_util.ext_template_directory))
+        self.log('Kubeb template add to %s (%d files updated, %d removed)',
+                 click.format_filename(file_util.ext_template_directory), copied, removed)
+
+    def templates(self):
+        """List builtin and external templates
+        """
+        from kubeb import template_catalog
+
+        for template in template_catalog.list_templates():
+            self.log('- %s (%s) %s %s', template['name'], template['source'],
+                     template['version'] or '-', template['chart_name'] or '')
 
     def destroy(self):
 
@@ -256,10 +1138,4 @@ class Kubeb:
         self.log('Destroyed config directory %s' % file_util.kubeb_directory)
 
     def _get_generator(self, template):
-        generators = {
-            'laravel': LaravelGenerator,
-            'podder-pipeline': PodderPipelineGenerator,
-            'podder-task-bean': PodderTaskBeanGenerator,
-        }
-
-        return generators.get(template, None)
+        return generators.get_generator(template)
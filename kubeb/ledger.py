@@ -0,0 +1,203 @@
+import os
+import re
+import json
+import time
+import bisect
+import contextlib
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+
+def tag_timestamp(tag):
+    """Build time encoded in ``v<milliseconds>`` tags, if any."""
+    match = re.match(r'^v(\d{13})$', str(tag))
+    if not match:
+        return None
+    return int(match.group(1)) / 1000.0
+
+
+class VersionLedger(object):
+    """Append-only JSON-lines log of built versions.
+
+    Each line is one build record. The file is only ever appended to, under
+    an exclusive lock, so parallel builds cannot clobber each other. Records
+    are indexed by tag in memory and kept ordered by build timestamp; new
+    lines written by other processes are picked up incrementally from the
+    last read offset.
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.lock_file = filename + '.lock'
+        self._records = []
+        self._index = dict()
+        self._order = []
+        self._offset = 0
+        self._stamp = None
+
+    @contextlib.contextmanager
+    def lock(self):
+        directory = os.path.dirname(os.path.abspath(self.filename))
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+        with open(self.lock_file, 'a') as fh:
+            if fcntl:
+                fcntl.flock(fh.fileno(), fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                if fcntl:
+                    fcntl.flock(fh.fileno(), fcntl.LOCK_UN)
+
+    def exists(self):
+        return os.path.isfile(self.filename)
+
+    def _refresh(self):
+        try:
+            stat = os.stat(self.filename)
+        except OSError:
+            self._reset()
+            return
+
+        stamp = stat.st_mtime_ns, stat.st_size
+        if stamp == self._stamp:
+            return
+
+        if stat.st_size < self._offset:
+            self._reset()
+
+        records = []
+        with open(self.filename, 'rb') as fh:
+            fh.seek(self._offset)
+            for line in fh:
+                if not line.endswith(b'\n'):
+                    # partial line from a concurrent writer, read it next time
+                    break
+                self._offset += len(line)
+                line = line.strip()
+                if line:
+                    records.append(json.loads(line.decode('utf8')))
+
+        self._add(records)
+        self._stamp = stamp
+
+    def _reset(self):
+        self._records = []
+        self._index = dict()
+        self._order = []
+        self._offset = 0
+        self._stamp = None
+
+    def _add(self, records):
+        keys = []
+        for record in records:
+            previous = self._index.get(record['tag'])
+            if previous is not None:
+                key = self._sort_key(previous)
+                rank = bisect.bisect_left(self._order, key)
+                if rank < len(self._order) and self._order[rank] == key:
+                    del self._order[rank]
+                else:
+                    keys.remove(key)
+
+            position = len(self._records)
+            self._index[record['tag']] = position
+            self._records.append(record)
+            keys.append(self._sort_key(position))
+
+        if len(keys) == 1 and (not self._order or keys[0] > self._order[-1]):
+            self._order.append(keys[0])
+        elif keys:
+            self._order.extend(keys)
+            self._order.sort()
+
+    def _sort_key(self, position):
+        timestamp = self._records[position].get('timestamp')
+        return (timestamp if timestamp is not None else 0.0), position
+
+    def append(self, tag, message='', **extra):
+        record = dict(tag=tag, message=message, timestamp=extra.pop('timestamp', time.time()))
+        record.update(extra)
+        self.extend([record])
+        return record
+
+    def extend(self, records):
+        data = ''.join(json.dumps(record, sort_keys=True) + '\n' for record in records)
+        with self.lock():
+            with open(self.filename, 'a', encoding='utf8') as fh:
+                fh.write(data)
+                fh.flush()
+                os.fsync(fh.fileno())
+
+    def migrate(self, versions):
+        """Seed the ledger from an inline ``version:`` list, once.
+
+        The list is in build order. Entries without a usable timestamp (custom
+        tags) get the one of the entry before them, and timestamps never go
+        backwards, so the ledger keeps the list order.
+        """
+        with self.lock():
+            if self.exists():
+                return False
+
+            lines = []
+            timestamp = 0.0
+            for v in versions:
+                timestamp = max(timestamp, v.get('timestamp') or tag_timestamp(v['tag']) or 0.0)
+                lines.append(json.dumps(dict(tag=v['tag'], message=v.get('message', ''), timestamp=timestamp),
+                                        sort_keys=True) + '\n')
+            data = ''.join(lines)
+            with open(self.filename, 'w', encoding='utf8') as fh:
+                fh.write(data)
+        return True
+
+    def all(self):
+        self._refresh()
+        return [self._records[position] for _, position in self._order]
+
+    def get(self, tag):
+        self._refresh()
+        position = self._index.get(tag)
+        if position is None:
+            return None
+        return self._records[position]
+
+    def latest(self, predicate=None):
+        """Newest version, or the newest one ``predicate`` accepts."""
+        self._refresh()
+        for _, position in reversed(self._order):
+            if predicate is None or predicate(self._records[position]):
+                return self._records[position]
+        return None
+
+    def previous(self, tag=None):
+        """Version built right before ``tag`` (default: the latest one)."""
+        self._refresh()
+        if tag is None:
+            if len(self._order) < 2:
+                return None
+            return self._records[self._order[-2][1]]
+
+        position = self._index.get(tag)
+        if position is None:
+            return None
+
+        rank = bisect.bisect_left(self._order, self._sort_key(position))
+        if rank == 0:
+            return None
+        return self._records[self._order[rank - 1][1]]
+
+    def recent(self, count):
+        """Most recent ``count`` versions, newest first."""
+        self._refresh()
+        if count <= 0:
+            return []
+        return [self._records[position] for _, position in reversed(self._order[-count:])]
+
+    def __len__(self):
+        self._refresh()
+        return len(self._order)
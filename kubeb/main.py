@@ -2,14 +2,67 @@ import os
 
 import click
 
-from kubeb.kubeb import Kubeb
 from kubeb import __version__
 
 
+def Kubeb():
+    # import the command layer only once a subcommand actually runs
+    from kubeb.kubeb import Kubeb
+    return Kubeb()
+
+
+def parse_canary_steps(value):
+    """'10%,50%' -> [10, 50], None without --canary-steps (steps from config.yml)"""
+    if value is None:
+        return None
+
+    steps = []
+    for item in value.split(','):
+        try:
+            step = float(item.strip().rstrip('%'))
+        except ValueError:
+            raise click.BadParameter('expected percentages like 10% or 10%,50%, got {}'.format(value),
+                                     param_hint='--canary-steps')
+        if not 0 < step <= 100:
+            raise click.BadParameter('{} is not between 0% and 100%'.format(item), param_hint='--canary-steps')
+        steps.append(int(step) if step.is_integer() else step)
+    return steps
+
+
+def parse_variables(items):
+    variables = dict()
+    for item in items:
+        if '=' not in item:
+            raise click.BadParameter('expected KEY=VALUE, got {}'.format(item))
+        key, value = item.split('=', 1)
+        variables[key] = value
+    return variables
+
+
 @click.group()
 @click.version_option(__version__)
-def cli():
-    pass
+@click.option('--profile', is_flag=True, help='Print a per-phase timing summary after the command.')
+@click.option('--trace-file', type=click.Path(dir_okay=False),
+              help='Write spans in Chrome trace format (chrome://tracing, Perfetto).')
+@click.pass_context
+def cli(ctx, profile, trace_file):
+    from kubeb import tracing
+    tracing.begin(ctx.invoked_subcommand)
+
+    def report():
+        from kubeb import file_util
+        root, spans = tracing.finish()
+        if profile:
+            tracing.print_summary(root, spans)
+        if trace_file:
+            tracing.write_trace(trace_file, spans)
+        if len(spans) > 1 and file_util.config_file_exist():
+            try:
+                tracing.append_metrics(file_util.metrics_file, root, spans)
+            except OSError:
+                pass
+
+    ctx.call_on_close(report)
 
 
 @cli.command()
@@ -57,47 +110,242 @@ def info():
 @click.option('--push',
               is_flag=True,
               default=False)
-def build(message, push):
+@click.option('--analyze',
+              is_flag=True,
+              default=False,
+              help='Report the build context size instead of building.')
+@click.option('--warn-size', 'warn_size',
+              type=int,
+              default=100,
+              help='Warn when the build context exceeds this many MB.')
+@click.option('--minimal-context', 'minimal_context',
+              is_flag=True,
+              default=False,
+              help='Send a pre-filtered context tarball to docker build.')
+@click.option('--content-tag', 'content_tag',
+              is_flag=True,
+              default=False,
+              help='Tag the image with a hash of the build context and skip unchanged builds.')
+@click.option('--cache-from', 'cache_from',
+              multiple=True,
+              help='Image to use as docker build cache source.')
+@click.option('--push-to', 'push_to',
+              multiple=True,
+              help='Additional image name (registry/repository) to push to.')
+@click.option('--retries',
+              type=int,
+              default=3,
+              help='Retries for a failed push.')
+def build(message, push, analyze, warn_size, minimal_context, content_tag, cache_from, push_to, retries):
     """ Build current application
         Build Dockerfile image
         Add release note, tag to config file
     """
-    Kubeb().build(message, push)
+    if analyze:
+        Kubeb().analyze(warn_size)
+        return
+
+    if not Kubeb().build(message, push, minimal_context, content_tag, cache_from, push_to, retries):
+        exit(1)
 
 
 @cli.command()
 @click.option('--version', '-v',
               help='Push version.')
-def push(version):
+@click.option('--push-to', 'push_to',
+              multiple=True,
+              help='Additional image name (registry/repository) to push to.')
+@click.option('--retries',
+              type=int,
+              default=3,
+              help='Retries for a failed push.')
+def push(version, push_to, retries):
     """ Push docker image to registry
     """
-    Kubeb().push(version)
+    Kubeb().push(version, push_to, retries)
 
 
 @cli.command()
 @click.option('--version', '-v',
               help='Install version.')
-@click.option('--set', 'options',
-              type=str)
+@click.option('--set', 'set_values',
+              multiple=True,
+              help='Helm values, e.g. a.b=1,list={x,y}. Saved for the environment and reused next deploy.')
+@click.option('--set-string', 'set_strings',
+              multiple=True,
+              help='Like --set, values are always strings.')
+@click.option('--set-file', 'set_files',
+              multiple=True,
+              help='Like --set, values are read from the given files.')
+@click.option('--reset-options', 'reset_options',
+              is_flag=True,
+              default=False,
+              help='Forget the --set options saved for the environment.')
 @click.option('--dry-run', 'dry_run',
               is_flag=True,
               default=False)
 @click.option('--rollback',
               is_flag=True,
               default=True)
+@click.option('--timeout',
+              type=int,
+              help='Abort the helm install or rollout after this many seconds.')
+@click.option('--envs',
+              help='Comma separated environments to deploy concurrently.')
+@click.option('--all-envs', 'all_envs',
+              is_flag=True,
+              default=False,
+              help='Deploy to every configured environment concurrently.')
+@click.option('--jobs', '-j',
+              type=int,
+              default=4,
+              help='Number of concurrent deploys with --envs/--all-envs.')
+@click.option('--fail-fast', 'fail_fast',
+              is_flag=True,
+              default=False,
+              help='Cancel remaining deploys after the first failure.')
+@click.option('--no-cache', 'no_cache',
+              is_flag=True,
+              default=False,
+              help='Re-render helm values even if nothing changed.')
+@click.option('--always',
+              is_flag=True,
+              default=False,
+              help='Run helm even if chart and values are unchanged since the last deploy.')
+@click.option('--plan',
+              is_flag=True,
+              default=False,
+              help='Only show whether an upgrade would happen.')
+@click.option('--var', 'variables',
+              multiple=True,
+              help='KEY=VALUE environment variable for this deploy, overrides dotenv and config.yml.')
+@click.option('--write-values', 'write_values',
+              is_flag=True,
+              default=False,
+              help='Write .kubeb/helm-values.yml and pass it to helm instead of streaming values over stdin.')
+@click.option('--watch/--no-watch',
+              default=True,
+              help='Track pod readiness with kubectl and roll back as soon as a pod fails, '
+                   'instead of helm --wait.')
+@click.option('--preflight/--no-preflight',
+              default=True,
+              help='Lint and validate the chart with the values before installing (passes are cached).')
+@click.option('--canary',
+              is_flag=True,
+              default=False,
+              help='Run the new version as a canary of a part of the replicas and promote it after a healthy '
+                   'soak window. Steps come from config.yml.')
+@click.option('--canary-steps', 'canary_steps',
+              help='Canary size per step, e.g. 10% or 10%,50%. Implies --canary.')
 @click.confirmation_option()
-def deploy(version, options, dry_run, rollback):
+def deploy(version, set_values, set_strings, set_files, reset_options, dry_run, rollback, timeout, envs, all_envs,
+           jobs, fail_fast, no_cache, always, plan, watch, variables, write_values, preflight, canary, canary_steps):
     """ Install current application to Kubernetes
         Generate Helm chart value file with docker image version
         If version is not specified, will get the latest version
     """
-    deploy_options = dict()
+    from kubeb import helm_options
 
-    if options:
-        for item in options.split(','):
-            deploy_options.update([item.split('=')])
+    try:
+        deploy_options = helm_options.parse_options(set_values, set_strings, set_files)
+    except (ValueError, IOError) as e:
+        raise click.BadParameter(str(e), param_hint='--set')
 
-    Kubeb().deploy(version, deploy_options, dry_run, rollback)
+    variables = parse_variables(variables)
+    canary_steps = parse_canary_steps(canary_steps)
+    canary = canary or canary_steps is not None
+    if canary and (envs or all_envs):
+        raise click.BadParameter('canary deploys work on one environment', param_hint='--canary')
+
+    if envs or all_envs:
+        env_list = None if all_envs else [e.strip() for e in envs.split(',') if e.strip()]
+        succeed = Kubeb().deploy_many(env_list, version, deploy_options, dry_run, rollback, timeout,
+                                      jobs, fail_fast, not no_cache, always, plan, watch, variables,
+                                      write_values, reset_options, preflight, set_files)
+        if not succeed:
+            exit(1)
+        return
+
+    if not Kubeb().deploy(version, deploy_options, dry_run, rollback, timeout, not no_cache, always, plan, watch,
+                          variables, write_values, reset_options, preflight, canary, canary_steps, set_files):
+        exit(1)
+
+
+@cli.command()
+@click.option('--message', '-m',
+              multiple=True,
+              help='Release note')
+@click.option('--minimal-context', 'minimal_context',
+              is_flag=True,
+              default=False,
+              help='Send a pre-filtered context tarball to docker build.')
+@click.option('--content-tag', 'content_tag',
+              is_flag=True,
+              default=False,
+              help='Tag the image with a hash of the build context and skip unchanged builds.')
+@click.option('--cache-from', 'cache_from',
+              multiple=True,
+              help='Image to use as docker build cache source.')
+@click.option('--push-to', 'push_to',
+              multiple=True,
+              help='Additional image name (registry/repository) to push to.')
+@click.option('--retries',
+              type=int,
+              default=3,
+              help='Retries for a failed push.')
+@click.option('--set', 'set_values',
+              multiple=True,
+              help='Helm values, e.g. a.b=1,list={x,y}. Saved for the environment and reused next deploy.')
+@click.option('--set-string', 'set_strings',
+              multiple=True,
+              help='Like --set, values are always strings.')
+@click.option('--set-file', 'set_files',
+              multiple=True,
+              help='Like --set, values are read from the given files.')
+@click.option('--reset-options', 'reset_options',
+              is_flag=True,
+              default=False,
+              help='Forget the --set options saved for the environment.')
+@click.option('--rollback',
+              is_flag=True,
+              default=True)
+@click.option('--timeout',
+              type=int,
+              help='Abort the helm install or rollout after this many seconds.')
+@click.option('--always',
+              is_flag=True,
+              default=False,
+              help='Run helm even if chart and values are unchanged since the last deploy.')
+@click.option('--var', 'variables',
+              multiple=True,
+              help='KEY=VALUE environment variable for this deploy, overrides dotenv and config.yml.')
+@click.option('--write-values', 'write_values',
+              is_flag=True,
+              default=False,
+              help='Write .kubeb/helm-values.yml and pass it to helm instead of streaming values over stdin.')
+@click.option('--watch/--no-watch',
+              default=True,
+              help='Track pod readiness with kubectl instead of helm --wait.')
+@click.option('--preflight/--no-preflight',
+              default=True,
+              help='Lint and validate the chart with the values before installing (passes are cached).')
+@click.confirmation_option()
+def ship(message, minimal_context, content_tag, cache_from, push_to, retries, set_values, set_strings, set_files,
+         reset_options, rollback, timeout, always, variables, write_values, watch, preflight):
+    """ Build, push and deploy current application
+        Helm values are rendered while the image builds and pushes
+    """
+    from kubeb import helm_options
+
+    try:
+        deploy_options = helm_options.parse_options(set_values, set_strings, set_files)
+    except (ValueError, IOError) as e:
+        raise click.BadParameter(str(e), param_hint='--set')
+
+    if not Kubeb().ship(message, minimal_context, content_tag, cache_from, push_to, retries, deploy_options,
+                        rollback, timeout, always, watch, parse_variables(variables), write_values,
+                        reset_options, preflight, set_files):
+        exit(1)
 
 
 @cli.command()
@@ -109,8 +357,17 @@ def delete():
 
 
 @cli.command()
-def version():
-    Kubeb().version()
+@click.option('--previous',
+              is_flag=True,
+              default=False,
+              help='Show the version built before the latest one.')
+@click.option('--last',
+              type=int,
+              help='Show the N most recent versions.')
+def version(previous, last):
+    """Show current application versions
+    """
+    Kubeb().version(previous, last)
 
 
 @cli.command()
@@ -120,6 +377,17 @@ def history():
     Kubeb().history()
 
 
+@cli.command()
+@click.option('--all', 'all_envs',
+              is_flag=True,
+              default=False,
+              help='Show the releases of every configured environment.')
+def status(all_envs):
+    """Show current application release status
+    """
+    Kubeb().status(all_envs)
+
+
 @cli.command()
 @click.argument('revision',
                 default=0,
@@ -136,10 +404,31 @@ def rollback(revision):
 @click.argument('env',
                 default='local',
                 type=str)
-def env(env):
+@click.argument('args',
+                nargs=-1)
+@click.option('--explain',
+              is_flag=True,
+              default=False,
+              help='With vars: show which layer each value comes from.')
+@click.option('--var', 'variables',
+              multiple=True,
+              help='With vars: KEY=VALUE override to preview.')
+def env(env, args, explain, variables):
     """Use environment
         Example: kubeb env develop to use environment develop
+        kubeb env vars [ENV] [--explain] shows the resolved variables
+        kubeb env diff ENV1 ENV2 compares the resolved variables
     """
+    if env == 'vars':
+        Kubeb().env_vars(args[0] if args else None, explain, parse_variables(variables))
+        return
+
+    if env == 'diff':
+        if len(args) != 2:
+            raise click.UsageError('kubeb env diff ENV1 ENV2')
+        Kubeb().env_diff(*args)
+        return
+
     Kubeb().env(env)
 
 
@@ -171,10 +460,124 @@ def template(name, path, force):
         kubeb [template_name] [template_directory_path]
         Example: kubeb template example ./example
         Will add template to external template directory: ~/.kubeb/ext-templates/[template_name]
+        kubeb template list shows available templates
     """
+    if name == 'list':
+        Kubeb().templates()
+        return
+
     Kubeb().template(name, path, force)
 
 
+@cli.group()
+def workspace():
+    """Build and deploy every kubeb application under a directory
+        Applications are directories with .kubeb/config.yml; list the names of
+        applications that must go first under `depends_on` in config.yml
+    """
+    pass
+
+
+def workspace_options(function):
+    function = click.option('--root',
+                            default='.',
+                            type=click.Path(exists=True, file_okay=False, resolve_path=True),
+                            help='Workspace directory to search for applications.')(function)
+    function = click.option('--only',
+                            help='Comma separated applications to run.')(function)
+    function = click.option('--jobs', '-j',
+                            type=int,
+                            default=4,
+                            help='Number of applications processed concurrently.')(function)
+    function = click.option('--fail-fast', 'fail_fast',
+                            is_flag=True,
+                            default=False,
+                            help='Skip remaining applications after the first failure.')(function)
+    return function
+
+
+def split_names(value):
+    return [name.strip() for name in value.split(',') if name.strip()] if value else None
+
+
+@workspace.command('list')
+@click.option('--root',
+              default='.',
+              type=click.Path(exists=True, file_okay=False, resolve_path=True))
+def workspace_list(root):
+    """List applications in build order
+    """
+    if not Kubeb().workspace_list(root):
+        exit(1)
+
+
+@workspace.command('build')
+@workspace_options
+@click.option('--message', '-m',
+              default='workspace build',
+              help='Release note for every application.')
+@click.option('--push',
+              is_flag=True,
+              default=False)
+@click.option('--minimal-context', 'minimal_context',
+              is_flag=True,
+              default=False,
+              help='Send a pre-filtered context tarball to docker build.')
+@click.option('--content-tag', 'content_tag',
+              is_flag=True,
+              default=False,
+              help='Tag images with a hash of their build context and skip unchanged builds.')
+@click.option('--push-to', 'push_to',
+              multiple=True,
+              help='Additional image name (registry/repository) to push to.')
+@click.option('--retries',
+              type=int,
+              default=3,
+              help='Retries for a failed push.')
+def workspace_build(root, only, jobs, fail_fast, message, push, minimal_context, content_tag, push_to, retries):
+    """Build docker images of all applications
+        Output of each application goes to its .kubeb/logs/build.log
+    """
+    if not Kubeb().workspace_build(root, split_names(only), jobs, fail_fast, message, push, minimal_context,
+                                   content_tag, push_to, retries):
+        exit(1)
+
+
+@workspace.command('deploy')
+@workspace_options
+@click.option('--dry-run', 'dry_run',
+              is_flag=True,
+              default=False)
+@click.option('--rollback',
+              is_flag=True,
+              default=True)
+@click.option('--timeout',
+              type=int,
+              help='Abort each helm install or rollout after this many seconds.')
+@click.option('--always',
+              is_flag=True,
+              default=False,
+              help='Run helm even if chart and values are unchanged since the last deploy.')
+@click.option('--plan',
+              is_flag=True,
+              default=False,
+              help='Only show whether an upgrade would happen.')
+@click.option('--watch/--no-watch',
+              default=True,
+              help='Track pod readiness with kubectl instead of helm --wait.')
+@click.option('--preflight/--no-preflight',
+              default=True,
+              help='Lint and validate the chart with the values before installing (passes are cached).')
+@click.confirmation_option()
+def workspace_deploy(root, only, jobs, fail_fast, dry_run, rollback, timeout, always, plan, watch, preflight):
+    """Deploy the latest version of all applications to their current environment
+        Output of each application goes to its .kubeb/logs/deploy.log
+    """
+    if not Kubeb().workspace_deploy(root, split_names(only), jobs, fail_fast, dry_run, rollback, timeout, always,
+                                    plan, watch, preflight):
+        exit(1)
+
+
 @cli.command()
 @click.confirmation_option()
 def destroy():
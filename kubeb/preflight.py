@@ -0,0 +1,171 @@
+import re
+import time
+import shutil
+
+from kubeb import file_util, tracing
+from kubeb.command import Command
+from kubeb.project import current_project
+
+# passed checks remembered in .kubeb/preflight-cache.json
+cache_size = 100
+
+WORKLOADS = ('Deployment', 'StatefulSet', 'DaemonSet', 'ReplicaSet', 'Job', 'CronJob')
+
+_name = re.compile(r'^[a-z0-9]([-a-z0-9.]*[a-z0-9])?$')
+_quantity = re.compile(r'^[+-]?(\d+(\.\d*)?|\.\d+)(m|k|Ki|Mi|Gi|Ti|Pi|Ei|M|G|T|P|E|[eE][+-]?\d+)?$')
+
+
+def _pod_spec(document):
+    spec = document.get('spec') or {}
+    if document['kind'] == 'CronJob':
+        spec = (spec.get('jobTemplate') or {}).get('spec') or {}
+    return ((spec.get('template') or {}).get('spec')) or {}
+
+
+def _check_strings(where, mapping, problems):
+    for key, value in (mapping or {}).items():
+        if not isinstance(value, str):
+            problems.append('{}: value of {} must be a string, got {!r}'.format(where, key, value))
+
+
+def _check_container(where, container, problems):
+    name = container.get('name')
+    where = '{} container {}'.format(where, name or '?')
+    if not name:
+        problems.append('{}: container without a name'.format(where))
+
+    image = container.get('image')
+    if not isinstance(image, str) or not image or image.endswith(':'):
+        problems.append('{}: invalid image {!r}'.format(where, image))
+
+    for item in container.get('env') or []:
+        if not item.get('name'):
+            problems.append('{}: env entry without a name'.format(where))
+        elif 'value' in item and item['value'] is not None and not isinstance(item['value'], str):
+            problems.append('{}: env {} must be a string, got {!r}'.format(where, item['name'], item['value']))
+
+    for port in container.get('ports') or []:
+        if not isinstance(port.get('containerPort'), int):
+            problems.append('{}: invalid containerPort {!r}'.format(where, port.get('containerPort')))
+
+    for section in ('requests', 'limits'):
+        for resource, value in ((container.get('resources') or {}).get(section) or {}).items():
+            if not _quantity.match(str(value)):
+                problems.append('{}: invalid {} {} {!r}'.format(where, section, resource, value))
+
+
+def validate_manifests(documents):
+    """Structural checks of rendered Kubernetes objects, returns a list of problems."""
+    problems = []
+    seen = set()
+    for document in documents:
+        if not isinstance(document, dict):
+            problems.append('manifest is not a mapping: {!r}'.format(document)[:200])
+            continue
+        if not document.get('apiVersion') or not document.get('kind'):
+            problems.append('manifest without apiVersion or kind: {}'.format(document.get('metadata')))
+            continue
+
+        metadata = document.get('metadata') or {}
+        name = metadata.get('name')
+        where = '{} {}'.format(document['kind'], name)
+        if not isinstance(name, str) or len(name) > 253 or not _name.match(name):
+            problems.append('{}: invalid metadata.name'.format(where))
+        if (document['kind'], name) in seen:
+            problems.append('{}: defined more than once'.format(where))
+        seen.add((document['kind'], name))
+        _check_strings(where + ' labels', metadata.get('labels'), problems)
+        _check_strings(where + ' annotations', metadata.get('annotations'), problems)
+
+        if document['kind'] in WORKLOADS:
+            pod_spec = _pod_spec(document)
+            if not pod_spec.get('containers'):
+                problems.append('{}: no containers'.format(where))
+            for container in (pod_spec.get('containers') or []) + (pod_spec.get('initContainers') or []):
+                _check_container(where, container, problems)
+
+            spec = document.get('spec') or {}
+            match_labels = (spec.get('selector') or {}).get('matchLabels') or {}
+            labels = ((spec.get('template') or {}).get('metadata') or {}).get('labels') or {}
+            missing = [key for key, value in match_labels.items() if labels.get(key) != value]
+            if missing:
+                problems.append('{}: selector {} does not match the pod labels'.format(where, ', '.join(missing)))
+
+        if document['kind'] == 'Service':
+            for port in (document.get('spec') or {}).get('ports') or []:
+                if not isinstance(port.get('port'), int):
+                    problems.append('{}: invalid port {!r}'.format(where, port.get('port')))
+    return problems
+
+
+def _helm(args, values_file, values, timeout):
+    if values is not None:
+        values_file = '-'
+    return Command(['helm'] + args + ['-f', values_file], timeout=timeout,
+                   stdin=values).run(printout=False, capture=True)
+
+
+def _output_problems(result, prefix):
+    lines = [line.strip() for line in (result.error + result.output).splitlines() if line.strip()]
+    if not lines:
+        return ['{} exited with {}'.format(prefix, result.exitcode)]
+    return ['{}: {}'.format(prefix, line) for line in lines[-20:]]
+
+
+def _kubeconform(manifests, timeout):
+    result = Command(['kubeconform', '-strict', '-ignore-missing-schemas', '-summary', '-'], timeout=timeout,
+                     stdin=manifests).run(printout=False, capture=True)
+    if result.ok:
+        return []
+    return _output_problems(result, 'kubeconform')
+
+
+def _cache_key(fingerprint, release, schema_check):
+    return '{}/{}/{}'.format(fingerprint, release, 'kubeconform' if schema_check else 'builtin')
+
+
+def _remember(key, documents):
+    cache = file_util.load_json_file(current_project().preflight_cache_file)
+    cache[key] = dict(checked=time.time(), documents=documents)
+    if len(cache) > cache_size:
+        for old in sorted(cache, key=lambda k: cache[k]['checked'])[:len(cache) - cache_size]:
+            del cache[old]
+    file_util.save_json_file(current_project().preflight_cache_file, cache)
+
+
+@tracing.traced('preflight')
+def check(release, chart_path, fingerprint, values_file=None, values=None, timeout=120):
+    """Lint the chart with the values and validate what it renders.
+
+    Runs `helm lint`, `helm template`, structural checks of every rendered
+    object and `kubeconform` when it is installed. Returns (problems,
+    cached); a pass is remembered by the chart + values `fingerprint`, so
+    the same chart and values aren't checked twice.
+    """
+    schema_check = shutil.which('kubeconform') is not None
+    key = _cache_key(fingerprint, release, schema_check)
+    if fingerprint is not None and key in file_util.load_json_file(current_project().preflight_cache_file):
+        return [], True
+
+    result = _helm(['lint', chart_path], values_file, values, timeout)
+    if not result.ok:
+        return _output_problems(result, 'helm lint'), False
+
+    result = _helm(['template', '--name', release, chart_path], values_file, values, timeout)
+    if not result.ok:
+        return _output_problems(result, 'helm template'), False
+
+    from yaml import YAMLError
+
+    try:
+        documents = file_util.load_yaml_documents(result.output)
+    except YAMLError as e:
+        return ['helm template rendered invalid YAML: {}'.format(e)], False
+
+    problems = validate_manifests(documents)
+    if not problems and schema_check:
+        problems = _kubeconform(result.output, timeout)
+
+    if not problems and fingerprint is not None:
+        _remember(key, len(documents))
+    return problems, False
@@ -0,0 +1,80 @@
+import os
+import functools
+import contextlib
+import contextvars
+
+
+class Project(object):
+    """Paths of one kubeb application.
+
+    ``root=None`` is the working directory, with paths relative to it as
+    kubeb has always used them. Workspace mode creates one Project per
+    service with an absolute root.
+    """
+
+    def __init__(self, root=None):
+        self.root = os.path.abspath(root) if root else None
+        self.kubeb_directory = self._path('.kubeb') + os.path.sep
+        self.config_file = self.kubeb_directory + "config.yml"
+        self.helm_value_file = self.kubeb_directory + "helm-values.yml"
+        self.version_file = self.kubeb_directory + "versions.jsonl"
+        self.render_cache_file = self.kubeb_directory + "render-cache.json"
+        self.deploy_fingerprint_file = self.kubeb_directory + "deploy-fingerprints.json"
+        self.release_state_file = self.kubeb_directory + "releases.json"
+        # no longer written, removed when found
+        self.dotenv_cache_file = self.kubeb_directory + "dotenv-cache.json"
+        self.metrics_file = self.kubeb_directory + "metrics.jsonl"
+        self.preflight_cache_file = self.kubeb_directory + "preflight-cache.json"
+
+    def _path(self, name):
+        return os.path.join(self.root, name) if self.root else name
+
+    @property
+    def directory(self):
+        return self.root or os.getcwd()
+
+    @property
+    def docker_file(self):
+        return os.path.join(self.directory, "Dockerfile")
+
+    @property
+    def docker_directory(self):
+        return os.path.join(self.directory, "docker")
+
+    def __repr__(self):
+        return '<Project {}>'.format(self.directory)
+
+
+PATHS = ('kubeb_directory', 'config_file', 'helm_value_file', 'version_file', 'render_cache_file',
+         'deploy_fingerprint_file', 'release_state_file', 'dotenv_cache_file', 'metrics_file', 'preflight_cache_file',
+         'docker_file', 'docker_directory')
+
+_default = Project()
+_current = contextvars.ContextVar('kubeb_project', default=None)
+
+
+def current_project():
+    return _current.get() or _default
+
+
+@contextlib.contextmanager
+def use_project(project):
+    """Run the block (and threads started with its copied context) against `project`."""
+    token = _current.set(project)
+    try:
+        yield project
+    finally:
+        _current.reset(token)
+
+
+def submit(executor, fn, *args, **kwargs):
+    """executor.submit that keeps the caller's project in the worker thread."""
+    return executor.submit(contextvars.copy_context().run, fn, *args, **kwargs)
+
+
+async def run_in_thread(fn, *args, **kwargs):
+    """Await a blocking call on the default executor, keeping the caller's project."""
+    import asyncio
+
+    call = functools.partial(contextvars.copy_context().run, fn, *args, **kwargs)
+    return await asyncio.get_running_loop().run_in_executor(None, call)
@@ -0,0 +1,100 @@
+import time
+import threading
+
+from kubeb import file_util, util, tracing
+
+# revisions fetched by the first incremental query; doubled until the gap is covered
+initial_batch = 10
+
+# a revision in one of these states never changes again
+FINAL_STATUSES = ('SUPERSEDED', 'FAILED', 'DELETED', 'UNINSTALLED')
+
+_lock = threading.Lock()
+
+
+def _key(release, kube_context=None):
+    return '{}/{}'.format(kube_context or '', release)
+
+
+def _final(status):
+    return (status or '').upper().replace('-', '_') in FINAL_STATUSES
+
+
+def load_snapshot(release, kube_context=None):
+    snapshot = file_util.load_json_file(file_util.release_state_file).get(_key(release, kube_context))
+    if not snapshot:
+        snapshot = dict(release=release, kube_context=kube_context, revisions={}, refreshed=None)
+    return snapshot
+
+
+def _save_snapshot(snapshot):
+    with _lock:
+        snapshots = file_util.load_json_file(file_util.release_state_file)
+        snapshots[_key(snapshot['release'], snapshot['kube_context'])] = snapshot
+        file_util.save_json_file(file_util.release_state_file, snapshots)
+
+
+@tracing.traced('release.refresh')
+def refresh(release, kube_context=None):
+    """Bring the snapshot of `release` up to date with the cluster.
+
+    Only the newest revisions are fetched (`helm history --max`), growing the
+    batch until it reaches the oldest known revision whose status can still
+    change (DEPLOYED, PENDING_*), or the newest known one when all of them
+    are final. Returns None when helm history fails.
+    """
+    snapshot = load_snapshot(release, kube_context)
+    known = [int(revision) for revision in snapshot['revisions']]
+    latest_known = max(known) if known else 0
+    unsettled = [int(revision) for revision, data in snapshot['revisions'].items() if not _final(data['status'])]
+    needed = min(unsettled) if unsettled else latest_known
+
+    batch = initial_batch if latest_known else None
+    while True:
+        history = util.get_helm_history(release, max_revisions=batch, kube_context=kube_context)
+        if history is None:
+            return None
+
+        if not history:
+            # release was deleted or never installed
+            snapshot['revisions'] = {}
+            break
+
+        oldest = min(int(r['revision']) for r in history)
+        newest = max(int(r['revision']) for r in history)
+        if newest < latest_known:
+            # release was purged and re-created, start over
+            snapshot['revisions'] = {}
+            latest_known = needed = 0
+        if batch is None or len(history) < batch:
+            # the whole history, drop revisions helm no longer keeps
+            snapshot['revisions'] = {}
+            break
+        if oldest <= needed:
+            break
+        batch *= 2
+
+    for r in history:
+        snapshot['revisions'][str(r['revision'])] = dict(status=r.get('status'),
+                                                          updated=r.get('updated'),
+                                                          chart=r.get('chart'),
+                                                          description=r.get('description'))
+    snapshot['refreshed'] = time.time()
+    _save_snapshot(snapshot)
+    return snapshot
+
+
+def revisions(snapshot):
+    return [dict(revision=int(revision), **data)
+            for revision, data in sorted(snapshot['revisions'].items(), key=lambda item: int(item[0]))]
+
+
+def latest_revision(snapshot):
+    items = revisions(snapshot)
+    return items[-1] if items else None
+
+
+def last_working_revision(snapshot):
+    working = [int(revision) for revision, data in snapshot['revisions'].items()
+               if data['status'] == 'SUPERSEDED']
+    return max(working) if working else None
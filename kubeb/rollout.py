@@ -0,0 +1,287 @@
+import json
+import time
+import threading
+import contextvars
+from datetime import datetime, timezone
+
+from kubeb.command import Command
+
+# container waiting reasons that will not fix themselves
+FAILURE_REASONS = (
+    'CrashLoopBackOff',
+    'ImagePullBackOff',
+    'ErrImagePull',
+    'InvalidImageName',
+    'CreateContainerConfigError',
+    'CreateContainerError',
+)
+
+
+def _parse_time(value):
+    try:
+        return datetime.strptime(value, '%Y-%m-%dT%H:%M:%SZ').replace(tzinfo=timezone.utc).timestamp()
+    except (TypeError, ValueError):
+        return None
+
+
+class _JsonStream(object):
+    """Split the concatenated JSON documents printed by `kubectl get -w -o json`."""
+
+    def __init__(self, callback):
+        self.callback = callback
+        self._buffer = ''
+        self._decoder = json.JSONDecoder()
+
+    def feed(self, line):
+        self._buffer += line + '\n'
+        while True:
+            text = self._buffer.lstrip()
+            if not text:
+                self._buffer = ''
+                return
+            try:
+                obj, end = self._decoder.raw_decode(text)
+            except ValueError:
+                return
+            self._buffer = text[end:]
+            self.callback(obj)
+
+
+class RolloutWatcher(object):
+    """Follow the Deployments and pods of a release until they are ready.
+
+    Runs `kubectl get -w -o json` for deployments and pods labelled with the
+    release (or matching `selector`) and reacts to every event: prints pod readiness as it changes and
+    stops as soon as a pod is stuck (see FAILURE_REASONS), a deployment
+    exceeds its progress deadline, or everything is rolled out. A release
+    without Deployments has nothing to roll out and is done right away.
+    """
+
+    def __init__(self, release, kube_context=None, namespace=None, timeout=300, log=print,
+                 cancel_event=None, selector=None):
+        self.release = release
+        self.selector = selector or 'release={}'.format(release)
+        self.kube_context = kube_context
+        self.namespace = namespace
+        self.timeout = timeout
+        self.log = log
+        self.cancel_event = cancel_event or threading.Event()
+        self.started = time.time()
+
+        self.deployments = dict()
+        self.pods = dict()
+        self.failure = None
+        self._condition = threading.Condition()
+        self._done = threading.Event()
+        self._pod_states = dict()
+
+    def _command(self, kind, watch=True):
+        command = ['kubectl', 'get', kind, '-l', self.selector, '--output', 'json']
+        if watch:
+            command.append('--watch')
+        if self.kube_context:
+            command += ['--context', self.kube_context]
+        if self.namespace:
+            command += ['--namespace', self.namespace]
+        return command
+
+    def _watch(self, kind):
+        stream = _JsonStream(self._update)
+        while not self._done.is_set():
+            result = Command(self._command(kind), cancel_event=self._done).run(
+                printout=False, on_line=lambda name, line: stream.feed(line) if name == 'stdout' else None)
+            if self._done.is_set():
+                return
+            if result.exitcode == 127:
+                with self._condition:
+                    self.failure = self.failure or 'kubectl not found'
+                    self._done.set()
+                    self._condition.notify_all()
+                return
+            if not result.ok:
+                self.log('kubectl watch {} failed: {}'.format(kind, result.error.strip()))
+                time.sleep(2)
+
+    def _update(self, obj):
+        items = obj.get('items') if obj.get('kind', '').endswith('List') else [obj]
+        with self._condition:
+            for item in items:
+                kind = item.get('kind')
+                name = item['metadata']['name']
+                if kind == 'Deployment':
+                    self.deployments[name] = item
+                elif kind == 'Pod':
+                    self.pods[name] = item
+                    if self._is_new(item):
+                        self._report_pod(name, item)
+            self._evaluate()
+            self._condition.notify_all()
+
+    def _report_pod(self, name, pod):
+        statuses = pod.get('status', {}).get('containerStatuses') or []
+        ready = sum(1 for status in statuses if status.get('ready'))
+        reasons = [status.get('state', {}).get('waiting', {}).get('reason') for status in statuses]
+        reasons = [reason for reason in reasons if reason]
+        restarts = sum(status.get('restartCount', 0) for status in statuses)
+        state = '{} {}/{} ready{}{}'.format(pod.get('status', {}).get('phase', 'Pending'), ready, len(statuses),
+                                           ', restarts {}'.format(restarts) if restarts else '',
+                                           ', ' + ', '.join(reasons) if reasons else '')
+        if self._pod_states.get(name) != state:
+            self._pod_states[name] = state
+            self.log('  pod {}: {}'.format(name, state))
+
+    def _is_new(self, item):
+        created = _parse_time(item['metadata'].get('creationTimestamp'))
+        # one second of slack for the API server's timestamp resolution
+        return created is None or created >= self.started - 1
+
+    def _evaluate(self):
+        if self.failure or self._done.is_set():
+            return
+
+        for name, pod in self.pods.items():
+            if not self._is_new(pod):
+                continue
+            for status in pod.get('status', {}).get('containerStatuses') or []:
+                reason = status.get('state', {}).get('waiting', {}).get('reason')
+                if reason in FAILURE_REASONS:
+                    self.failure = 'pod {} container {}: {}'.format(name, status.get('name'), reason)
+                    self._done.set()
+                    return
+
+        if not self.deployments:
+            return
+
+        for name, deployment in self.deployments.items():
+            status = deployment.get('status', {})
+            for condition in status.get('conditions') or []:
+                if condition.get('type') == 'Progressing' and condition.get('reason') == 'ProgressDeadlineExceeded':
+                    self.failure = 'deployment {}: progress deadline exceeded'.format(name)
+                    self._done.set()
+                    return
+
+        if all(self._rolled_out(deployment) for deployment in self.deployments.values()):
+            self._done.set()
+
+    @staticmethod
+    def _rolled_out(deployment):
+        spec = deployment.get('spec', {})
+        status = deployment.get('status', {})
+        replicas = spec.get('replicas', 1)
+        if status.get('observedGeneration', 0) < deployment['metadata'].get('generation', 0):
+            return False
+        return (status.get('updatedReplicas', 0) >= replicas
+                and status.get('replicas', 0) <= status.get('updatedReplicas', 0)
+                and status.get('availableReplicas', 0) >= replicas)
+
+    def _has_deployments(self):
+        """False when the selector matches no Deployment, True when it does or kubectl can't tell"""
+        result = Command(self._command('deployments', watch=False), timeout=30,
+                         cancel_event=self.cancel_event).run(printout=False, capture=True)
+        if not result.ok:
+            return True
+        try:
+            return bool(json.loads(result.output).get('items'))
+        except ValueError:
+            return True
+
+    def wait(self):
+        """Return True once rolled out, False on failure, timeout or cancel."""
+        self.started = time.time()
+        if not self._has_deployments():
+            self.log('No Deployments match {}, nothing to wait for'.format(self.selector))
+            return True
+        # each watch thread runs in a copy of the caller's context (current project, log target)
+        threads = [threading.Thread(target=contextvars.copy_context().run, args=(self._watch, kind), daemon=True)
+                   for kind in ('deployments', 'pods')]
+        for thread in threads:
+            thread.start()
+
+        deadline = self.started + self.timeout if self.timeout else None
+        with self._condition:
+            while not self._done.is_set():
+                if self.cancel_event.is_set():
+                    self.failure = 'cancelled'
+                    break
+                remaining = deadline - time.time() if deadline else 1
+                if remaining <= 0:
+                    self.failure = 'timed out after {}s'.format(self.timeout)
+                    break
+                self._condition.wait(min(remaining, 1))
+
+        self._done.set()
+        for thread in threads:
+            thread.join(Command.kill_grace_period + 1)
+        return self.failure is None
+
+
+def soak(selector, duration, kube_context=None, namespace=None, interval=10, max_restarts=0, unready_grace=30,
+         log=print, cancel_event=None):
+    """Watch the pods matching `selector` for `duration` seconds, return (ok, failure reason).
+
+    Polls `kubectl get pods` every `interval` seconds and fails when a
+    container is stuck (see FAILURE_REASONS), the containers restarted more
+    than `max_restarts` times since the start, or a pod stayed unready for
+    longer than `unready_grace` seconds.
+    """
+    cancel_event = cancel_event or threading.Event()
+    command = ['kubectl', 'get', 'pods', '-l', selector, '--output', 'json']
+    if kube_context:
+        command += ['--context', kube_context]
+    if namespace:
+        command += ['--namespace', namespace]
+
+    baseline = dict()
+    unready_since = dict()
+    last_state = None
+    deadline = time.monotonic() + duration
+    while True:
+        result = Command(command, timeout=60, cancel_event=cancel_event).run(printout=False, capture=True)
+        if cancel_event.is_set():
+            return False, 'cancelled'
+        if result.exitcode == 127:
+            return False, 'kubectl not found'
+        try:
+            pods = (json.loads(result.output).get('items') or []) if result.ok else None
+        except ValueError:
+            pods = None
+        if pods is None:
+            log('kubectl get pods failed: {}'.format((result.error or result.output).strip()[:200]))
+        else:
+            if not pods:
+                return False, 'no pods match {}'.format(selector)
+
+            now = time.monotonic()
+            ready_pods = 0
+            restarts = 0
+            for pod in pods:
+                name = pod['metadata']['name']
+                statuses = pod.get('status', {}).get('containerStatuses') or []
+                for status in statuses:
+                    reason = status.get('state', {}).get('waiting', {}).get('reason')
+                    if reason in FAILURE_REASONS:
+                        return False, 'pod {} container {}: {}'.format(name, status.get('name'), reason)
+                    key = (name, status.get('name'))
+                    count = status.get('restartCount', 0)
+                    baseline.setdefault(key, count)
+                    restarts += count - baseline[key]
+
+                if statuses and all(status.get('ready') for status in statuses):
+                    ready_pods += 1
+                    unready_since.pop(name, None)
+                elif now - unready_since.setdefault(name, now) > unready_grace:
+                    return False, 'pod {} unready for more than {}s'.format(name, unready_grace)
+
+            if restarts > max_restarts:
+                return False, '{} container restart(s) during the soak window'.format(restarts)
+
+            state = '{}/{} pods ready, {} restart(s)'.format(ready_pods, len(pods), restarts)
+            if state != last_state:
+                last_state = state
+                log('  ' + state)
+
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            return True, None
+        if cancel_event.wait(min(interval, remaining)):
+            return False, 'cancelled'
@@ -0,0 +1,180 @@
+import os
+import shutil
+
+from kubeb import file_util
+
+_catalog = None
+
+
+def _catalog_file():
+    return os.path.join(file_util.user_cache_directory, 'templates.json')
+
+
+def _catalog_key():
+    """Stamps of the template roots, each template directory and its info.yaml and Chart.yaml.
+
+    A root's mtime only changes when templates are added or removed, edits
+    inside a template change the template's own stamps.
+    """
+    stamps = []
+    for directory in (file_util.template_directory, file_util.ext_template_directory):
+        stamps.append([directory, _mtime(directory)])
+        for name in _list_dirs(directory):
+            template_dir = os.path.join(directory, name)
+            stamps.append([template_dir, _mtime(template_dir),
+                           _stamp(os.path.join(template_dir, 'info.yaml')),
+                           _stamp(os.path.join(template_dir, name, 'Chart.yaml'))])
+    return stamps
+
+
+def _mtime(path):
+    try:
+        return os.stat(path).st_mtime_ns
+    except OSError:
+        return None
+
+
+def _stamp(path):
+    # a list, the key is compared with its JSON copy
+    stamp = file_util.get_file_stamp(path)
+    return list(stamp) if stamp else None
+
+
+def _list_dirs(directory):
+    try:
+        return sorted(name for name in os.listdir(directory)
+                      if not name.startswith('.') and os.path.isdir(os.path.join(directory, name)))
+    except OSError:
+        return []
+
+
+def describe_template(name, directory, source):
+    info = {}
+    info_file = os.path.join(directory, 'info.yaml')
+    if os.path.isfile(info_file):
+        info = file_util.get_yaml_dict(info_file) or {}
+
+    chart = {}
+    chart_file = os.path.join(directory, name, 'Chart.yaml')
+    if os.path.isfile(chart_file):
+        chart = file_util.get_yaml_dict(chart_file) or {}
+
+    return dict(name=name,
+                source=source,
+                path=directory,
+                version=str(info.get('version') or chart.get('version') or ''),
+                chart_name=info.get('chart_name') or chart.get('name') or '',
+                hash=file_util.get_directory_hash(directory))
+
+
+def _scan():
+    templates = dict()
+    for source, root in (('builtin', file_util.template_directory), ('ext', file_util.ext_template_directory)):
+        for name in _list_dirs(root):
+            templates.setdefault(name, dict())[source] = describe_template(name, os.path.join(root, name), source)
+    return templates
+
+
+def _save(templates, key):
+    try:
+        os.makedirs(file_util.user_cache_directory, exist_ok=True)
+        file_util.save_json_file(_catalog_file(), dict(key=key, templates=templates))
+    except OSError:
+        pass
+
+
+def load_catalog(refresh=False):
+    """Index of builtin and external templates.
+
+    Kept in ~/.kubeb/cache/templates.json and rebuilt only when a template
+    is added, removed or its directory, info.yaml or Chart.yaml changes. The
+    stamps are checked once per process.
+    """
+    global _catalog
+    if _catalog is not None and not refresh:
+        return _catalog
+
+    key = _catalog_key()
+    cached = file_util.load_json_file(_catalog_file())
+    if not refresh and cached.get('key') == key:
+        _catalog = cached['templates']
+        return _catalog
+
+    _catalog = _scan()
+    _save(_catalog, key)
+    return _catalog
+
+
+def update_template(name, source='ext'):
+    """Refresh one entry after it was added or synced."""
+    catalog = load_catalog()
+    root = file_util.ext_template_directory if source == 'ext' else file_util.template_directory
+    directory = os.path.join(root, name)
+    if os.path.isdir(directory):
+        catalog.setdefault(name, dict())[source] = describe_template(name, directory, source)
+    else:
+        catalog.get(name, dict()).pop(source, None)
+        if not catalog.get(name):
+            catalog.pop(name, None)
+    _save(catalog, _catalog_key())
+
+
+def get_template(name):
+    return load_catalog().get(name)
+
+
+def list_templates():
+    templates = []
+    for name, sources in sorted(load_catalog().items()):
+        for source in ('builtin', 'ext'):
+            if source in sources:
+                templates.append(sources[source])
+    return templates
+
+
+def sync_directory(src, dst):
+    """Make `dst` a copy of `src`, only touching files that differ.
+
+    Returns (copied, removed) file counts.
+    """
+    copied = removed = 0
+    wanted = set()
+
+    for root, dirs, files in os.walk(src):
+        rel_root = os.path.relpath(root, src)
+        dst_root = os.path.normpath(os.path.join(dst, rel_root))
+        if os.path.isfile(dst_root):
+            os.remove(dst_root)
+        os.makedirs(dst_root, exist_ok=True)
+        wanted.add(os.path.normpath(rel_root))
+
+        for name in files:
+            src_file = os.path.join(root, name)
+            dst_file = os.path.join(dst_root, name)
+            wanted.add(os.path.normpath(os.path.join(rel_root, name)))
+            if _same_file(src_file, dst_file):
+                continue
+            if os.path.isdir(dst_file):
+                shutil.rmtree(dst_file)
+            shutil.copy2(src_file, dst_file)
+            copied += 1
+
+    for root, dirs, files in os.walk(dst, topdown=False):
+        rel_root = os.path.relpath(root, dst)
+        for name in files:
+            if os.path.normpath(os.path.join(rel_root, name)) not in wanted:
+                os.remove(os.path.join(root, name))
+                removed += 1
+        if os.path.normpath(rel_root) not in wanted:
+            os.rmdir(root)
+
+    return copied, removed
+
+
+def _same_file(src, dst):
+    try:
+        if os.path.getsize(src) != os.path.getsize(dst):
+            return False
+    except OSError:
+        return False
+    return file_util.get_file_hash(src) == file_util.get_file_hash(dst)
@@ -36,4 +36,15 @@ Create dotenv file from environment varibales
 */}}
 {{- define "dotenv" -}}
 {{- range $key, $val := . }}{{ $key }}={{ $val }}\n{{- end }}
-{{- end -}}
\ No newline at end of file
+{{- end -}}
+
+{{/*
+Release label of the pods. Canary pods carry the stable release's label so its Service routes to them.
+*/}}
+{{- define "laravel.podRelease" -}}
+{{- if .Values.canary.enabled -}}
+{{- .Values.canary.stableRelease -}}
+{{- else -}}
+{{- .Release.Name -}}
+{{- end -}}
+{{- end -}}
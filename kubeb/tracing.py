@@ -0,0 +1,138 @@
+import os
+import sys
+import json
+import inspect
+import time
+import threading
+import functools
+import itertools
+import contextlib
+import contextvars
+
+_spans = []
+_lock = threading.Lock()
+_ids = itertools.count(1)
+_parent = contextvars.ContextVar('kubeb_span', default=None)
+_root = None
+
+
+class Span(object):
+    """One timed phase. `start` is epoch seconds, `duration` seconds."""
+
+    __slots__ = ('id', 'parent', 'name', 'category', 'start', 'duration', 'thread', 'attrs', '_started')
+
+    def __init__(self, name, category, attrs):
+        self.id = next(_ids)
+        self.parent = _parent.get()
+        self.name = name
+        self.category = category
+        self.start = time.time()
+        self.duration = None
+        self.thread = threading.get_ident()
+        self.attrs = attrs
+        self._started = time.perf_counter()
+
+    def set(self, **attrs):
+        self.attrs.update(attrs)
+
+    def end(self):
+        self.duration = time.perf_counter() - self._started
+        with _lock:
+            _spans.append(self)
+
+
+@contextlib.contextmanager
+def span(name, category='phase', **attrs):
+    """Time the block as a child of the current span."""
+    current = Span(name, category, attrs)
+    token = _parent.set(current.id)
+    try:
+        yield current
+    except BaseException as e:
+        current.attrs.setdefault('error', type(e).__name__)
+        raise
+    finally:
+        _parent.reset(token)
+        current.end()
+
+
+def traced(name, category='phase'):
+    """Decorator form of span(), for plain and coroutine functions."""
+    def decorator(function):
+        if inspect.iscoroutinefunction(function):
+            @functools.wraps(function)
+            async def coroutine_wrapper(*args, **kwargs):
+                with span(name, category):
+                    return await function(*args, **kwargs)
+            return coroutine_wrapper
+
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            with span(name, category):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def begin(command):
+    """Start the root span of a CLI command; every later span nests under it."""
+    global _root
+    _root = Span(command, 'command', dict())
+    _parent.set(_root.id)
+    return _root
+
+
+def finish():
+    """End the root span, returns (root, all spans)."""
+    if _root is not None and _root.duration is None:
+        _root.end()
+    with _lock:
+        return _root, list(_spans)
+
+
+def summarize(spans):
+    """[(name, category, calls, total, max)] slowest first, without the root span."""
+    phases = dict()
+    for item in spans:
+        if item.category == 'command':
+            continue
+        calls, total, longest = phases.get((item.name, item.category), (0, 0.0, 0.0))
+        phases[(item.name, item.category)] = (calls + 1, total + item.duration, max(longest, item.duration))
+    rows = [(name, category, calls, total, longest) for (name, category), (calls, total, longest) in phases.items()]
+    return sorted(rows, key=lambda row: row[3], reverse=True)
+
+
+def print_summary(root, spans, out=None):
+    out = out or sys.stderr
+    print('', file=out)
+    print('%-34s %-11s %6s %10s %10s' % ('PHASE', 'KIND', 'CALLS', 'TOTAL', 'MAX'), file=out)
+    for name, category, calls, total, longest in summarize(spans):
+        print('%-34s %-11s %6d %9.3fs %9.3fs' % (name[:34], category, calls, total, longest), file=out)
+    if root is not None:
+        print('%-34s %-11s %6s %9.3fs' % (root.name, 'command', '', root.duration), file=out)
+
+
+def write_trace(path, spans):
+    """Chrome trace event format, loadable in chrome://tracing or Perfetto."""
+    pid = os.getpid()
+    events = []
+    for item in sorted(spans, key=lambda s: s.start):
+        args = dict(item.attrs, id=item.id)
+        if item.parent is not None:
+            args['parent'] = item.parent
+        events.append(dict(name=item.name, cat=item.category, ph='X', pid=pid, tid=item.thread,
+                           ts=int(item.start * 1e6), dur=int(item.duration * 1e6), args=args))
+    with open(path, 'w', encoding='utf8') as fh:
+        json.dump(dict(traceEvents=events, displayTimeUnit='ms'), fh, default=str)
+
+
+def append_metrics(path, root, spans):
+    """Append one line per command run with per-phase totals."""
+    phases = dict((name, round(total, 4)) for name, _, _, total, _ in summarize(spans))
+    record = dict(command=root.name, timestamp=root.start, duration=round(root.duration, 4), phases=phases)
+    record.update(root.attrs)
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o644)
+    try:
+        os.write(fd, (json.dumps(record, sort_keys=True, default=str) + '\n').encode('utf8'))
+    finally:
+        os.close(fd)
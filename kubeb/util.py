@@ -1,71 +1,311 @@
-import json
-from kubeb import file_util
+import re
+import time
+from kubeb import file_util, tracing
 from kubeb.command import Command
+from kubeb.project import run_in_thread
 
 
-def run_docker_build(image, tag, path):
-    command = "docker build -t {}:{} {}".format(image, tag, path)
+def _docker_build_command(image, tag, path, context_file=None, cache_from=None):
+    command = ['docker', 'build', '-t', '{}:{}'.format(image, tag)]
 
-    status, _, _ = Command(command).execute()
+    for cache_image in cache_from or []:
+        command += ['--cache-from', cache_image]
 
-    return status
+    if context_file is not None:
+        # pre-filtered context tarball streamed over stdin
+        command += ['-']
+    else:
+        command += [path]
+    return command
 
 
-def run_docker_push(image, tag):
-    command = "docker push {}:{}".format(image, tag)
-    status, _, _ = Command(command).execute()
+@tracing.traced('docker.build')
+def run_docker_build(image, tag, path, timeout=None, context_file=None, cache_from=None):
+    command = _docker_build_command(image, tag, path, context_file, cache_from)
+    status, _, _ = Command(command, timeout=timeout, stdin=context_file).execute()
 
     return status
 
 
-def run_helm_install(name, template, debug, options):
-    helm_chart_path = file_util.get_helm_chart_path(template)
-    command = "helm upgrade --install --force {} -f .kubeb/helm-values.yml {} --wait".format(name, helm_chart_path)
+@tracing.traced('docker.build')
+async def run_docker_build_async(image, tag, path, timeout=None, context_file=None, cache_from=None):
+    command = _docker_build_command(image, tag, path, context_file, cache_from)
+    result = await Command(command, timeout=timeout, stdin=context_file).run_async()
 
-    if options:
-        option_str = ','.join(['%s=%s' % (key, value) for (key, value) in options.items()])
-        command += ' --set {}'.format(option_str)
+    return result.exitcode
 
-    if debug:
-        print(command)
-        command += ' --dry-run --debug'
 
-    status, _, _ = Command(command).execute()
+def run_docker_push(image, tag, timeout=None):
+    command = ['docker', 'push', '{}:{}'.format(image, tag)]
+    status, _, _ = Command(command, timeout=timeout).execute()
 
     return status
 
 
-def run_helm_uninstall(name):
-    command = "helm delete --purge {}".format(name)
-    status, _, _ = Command(command).execute()
+async def run_docker_push_async(image, tag, timeout=None):
+    command = ['docker', 'push', '{}:{}'.format(image, tag)]
+    result = await Command(command, timeout=timeout).run_async()
 
-    return status
+    return result.exitcode
 
 
-def run_helm_history(image):
-    command = "helm history {}".format(image)
-    status, _, _ = Command(command).execute()
+def run_docker_tag(image, tag, target_image, target_tag=None):
+    command = ['docker', 'tag', '{}:{}'.format(image, tag), '{}:{}'.format(target_image, target_tag or tag)]
+    status, _, _ = Command(command).execute(printout=False)
 
     return status
 
 
-def run_helm_rollback(image, revision):
-    command = "helm rollback {} {}".format(image, revision)
-    status, _, _ = Command(command).execute()
+async def run_docker_tag_async(image, tag, target_image, target_tag=None):
+    command = ['docker', 'tag', '{}:{}'.format(image, tag), '{}:{}'.format(target_image, target_tag or tag)]
+    result = await Command(command).run_async(printout=False, capture=True)
 
-    return status
+    return result.exitcode
 
 
-def get_last_working_revision(name):
-    command = "helm history {} --output json".format(name)
+class PushProgress(object):
+    """Layer states and durations parsed from `docker push` output.
 
-    exitcode, output, _ = Command(command).execute(printout=False)
-    if exitcode != 0:
+    docker only prints transfer progress to a terminal; piped output has one
+    line per layer state change, so layers are timed rather than bytes counted.
+    """
+
+    _layer_line = re.compile(r'^([0-9a-f]{12}): (.*)$')
+    _done = ('Pushed', 'Layer already exists')
+
+    def __init__(self):
+        self.started = time.monotonic()
+        self.layers = dict()
+        self.first_seen = dict()
+        self.durations = dict()
+
+    def feed(self, line):
+        match = self._layer_line.match(line.strip())
+        if not match:
+            return None
+
+        layer, status = match.groups()
+        if status.startswith('Pushing'):
+            # terminal output: Pushing [==>   ]  1.2MB/3.4MB
+            status = 'Pushing'
+        now = time.monotonic()
+        self.first_seen.setdefault(layer, now)
+        if status == 'Pushed' and layer not in self.durations:
+            self.durations[layer] = now - self.first_seen[layer]
+        self.layers[layer] = status
+        return layer, status
+
+    @property
+    def done(self):
+        return sum(1 for value in self.layers.values() if value in self._done)
+
+    def slowest(self):
+        """(layer, seconds) of the longest pushed layer, None when nothing was pushed"""
+        if not self.durations:
+            return None
+        return max(self.durations.items(), key=lambda item: item[1])
+
+    def count(self, status):
+        return sum(1 for value in self.layers.values() if value == status)
+
+
+@tracing.traced('docker.push')
+def push_docker_image(image, tag, retries=3, backoff=2, timeout=None, on_line=None):
+    """Push with retries and exponential backoff.
+
+    `on_line(line, layer_status, progress)` receives every output line, the
+    parsed (layer, status) if it is a layer line, and the attempt's
+    PushProgress. Returns (status, attempts, duration, progress) of the last
+    attempt.
+    """
+    command = ['docker', 'push', '{}:{}'.format(image, tag)]
+    start = time.monotonic()
+    attempt = 0
+    while True:
+        attempt += 1
+        progress = PushProgress()
+
+        def handle(stream, line):
+            on_line(line, progress.feed(line), progress)
+
+        result = Command(command, timeout=timeout).run(printout=on_line is None,
+                                                       on_line=handle if on_line is not None else None)
+        if result.ok or attempt > retries:
+            return result.exitcode, attempt, time.monotonic() - start, progress
+
+        delay = backoff * 2 ** (attempt - 1)
+        if on_line is not None:
+            on_line('push failed, retrying in {}s ({}/{})'.format(delay, attempt, retries), None, progress)
+        time.sleep(delay)
+
+
+@tracing.traced('docker.push')
+async def push_docker_image_async(image, tag, retries=3, backoff=2, timeout=None, on_line=None):
+    """push_docker_image() for asyncio code."""
+    import asyncio
+
+    command = ['docker', 'push', '{}:{}'.format(image, tag)]
+    start = time.monotonic()
+    attempt = 0
+    while True:
+        attempt += 1
+        progress = PushProgress()
+
+        def handle(stream, line):
+            on_line(line, progress.feed(line), progress)
+
+        result = await Command(command, timeout=timeout).run_async(printout=on_line is None,
+                                                                   on_line=handle if on_line is not None else None)
+        if result.ok or attempt > retries:
+            return result.exitcode, attempt, time.monotonic() - start, progress
+
+        delay = backoff * 2 ** (attempt - 1)
+        if on_line is not None:
+            on_line('push failed, retrying in {}s ({}/{})'.format(delay, attempt, retries), None, progress)
+        await asyncio.sleep(delay)
+
+
+def docker_image_exists(image, tag):
+    command = ['docker', 'image', 'inspect', '{}:{}'.format(image, tag)]
+    status, _, _ = Command(command).execute(printout=False)
+
+    return status == 0
+
+
+async def docker_image_exists_async(image, tag):
+    command = ['docker', 'image', 'inspect', '{}:{}'.format(image, tag)]
+    result = await Command(command).run_async(printout=False, capture=True)
+
+    return result.ok
+
+
+def _parse_digest(exitcode, output):
+    if exitcode != 0 or not output.strip():
         return None
 
-    revisions = json.loads(output)
-    revs = [r['revision'] for r in revisions if r['status'] == 'SUPERSEDED']
-    if len(revs) == 0:
+    return output.strip().split(',')[0]
+
+
+def get_docker_image_digest(image, tag):
+    command = ['docker', 'inspect', '--format', '{{join .RepoDigests ","}}', '{}:{}'.format(image, tag)]
+    exitcode, output, _ = Command(command).execute(printout=False)
+
+    return _parse_digest(exitcode, output)
+
+
+async def get_docker_image_digest_async(image, tag):
+    command = ['docker', 'inspect', '--format', '{{join .RepoDigests ","}}', '{}:{}'.format(image, tag)]
+    result = await Command(command).run_async(printout=False, capture=True)
+
+    return _parse_digest(result.exitcode, result.output)
+
+
+def _backend():
+    from kubeb.helm_backend import get_backend
+    return get_backend()
+
+
+@tracing.traced('helm.install')
+def run_helm_install(name, template, debug, timeout=None, values_file=None, kube_context=None,
+                     printout=True, cancel_event=None, wait=True, values=None):
+    helm_chart_path = file_util.get_helm_chart_path(template)
+    if values is None:
+        values_file = values_file or file_util.helm_value_file
+
+    return _backend().install(name, helm_chart_path, values_file, debug,
+                              timeout=timeout,
+                              kube_context=kube_context,
+                              printout=printout,
+                              cancel_event=cancel_event,
+                              wait=wait,
+                              values=values)
+
+
+@tracing.traced('helm.install')
+async def run_helm_install_async(name, template, debug, timeout=None, values_file=None, kube_context=None,
+                                 printout=True, cancel_event=None, wait=True, values=None):
+    helm_chart_path = file_util.get_helm_chart_path(template)
+    if values is None:
+        values_file = values_file or file_util.helm_value_file
+
+    return await _backend().install_async(name, helm_chart_path, values_file, debug,
+                                          timeout=timeout,
+                                          kube_context=kube_context,
+                                          printout=printout,
+                                          cancel_event=cancel_event,
+                                          wait=wait,
+                                          values=values)
+
+
+@tracing.traced('rollout.wait')
+def wait_for_rollout(name, timeout=None, kube_context=None, log=print, cancel_event=None, selector=None):
+    """Watch the release's deployments and pods, return (ok, failure reason)."""
+    from kubeb.rollout import RolloutWatcher
+
+    watcher = RolloutWatcher(name, kube_context=kube_context, timeout=timeout or 300, log=log,
+                             cancel_event=cancel_event, selector=selector)
+    ok = watcher.wait()
+    return ok, watcher.failure
+
+
+@tracing.traced('rollout.wait')
+async def wait_for_rollout_async(name, timeout=None, kube_context=None, log=print, cancel_event=None,
+                                 selector=None):
+    # the watcher reads kubectl from its own threads
+    return await run_in_thread(wait_for_rollout.__wrapped__, name, timeout, kube_context, log, cancel_event,
+                               selector)
+
+
+@tracing.traced('canary.soak')
+def soak_pods(selector, duration, kube_context=None, interval=10, max_restarts=0, unready_grace=30, log=print,
+              cancel_event=None):
+    """Watch pods for a soak window, return (ok, failure reason)."""
+    from kubeb.rollout import soak
+
+    return soak(selector, duration, kube_context=kube_context, interval=interval, max_restarts=max_restarts,
+                unready_grace=unready_grace, log=log, cancel_event=cancel_event)
+
+
+def run_helm_uninstall(name, timeout=None, kube_context=None):
+    return _backend().uninstall(name, timeout=timeout, kube_context=kube_context)
+
+
+def run_helm_history(image, timeout=None, kube_context=None):
+    return _backend().show_history(image, timeout=timeout, kube_context=kube_context)
+
+
+@tracing.traced('helm.rollback')
+def run_helm_rollback(image, revision, timeout=None, kube_context=None, printout=True):
+    return _backend().rollback(image, revision, timeout=timeout, kube_context=kube_context, printout=printout)
+
+
+@tracing.traced('helm.rollback')
+async def run_helm_rollback_async(image, revision, timeout=None, kube_context=None, printout=True):
+    return await _backend().rollback_async(image, revision, timeout=timeout, kube_context=kube_context,
+                                           printout=printout)
+
+
+@tracing.traced('helm.history')
+def get_helm_history(name, max_revisions=None, timeout=None, kube_context=None):
+    return _backend().history(name, max_revisions, timeout=timeout, kube_context=kube_context)
+
+
+@tracing.traced('helm.history')
+async def get_helm_history_async(name, max_revisions=None, timeout=None, kube_context=None):
+    return await _backend().history_async(name, max_revisions, timeout=timeout, kube_context=kube_context)
+
+
+@tracing.traced('rollback.lookup')
+def get_last_working_revision(name, timeout=None, kube_context=None):
+    from kubeb import release_state
+
+    snapshot = release_state.refresh(name, kube_context=kube_context)
+    if snapshot is None:
         return None
 
-    return max(revs)
+    return release_state.last_working_revision(snapshot)
+
+
+@tracing.traced('rollback.lookup')
+async def get_last_working_revision_async(name, timeout=None, kube_context=None):
+    return await run_in_thread(get_last_working_revision.__wrapped__, name, timeout, kube_context)
@@ -0,0 +1,136 @@
+import os
+import fnmatch
+import threading
+
+from kubeb import file_util, config
+
+# lowest precedence first; later layers override earlier ones
+LAYERS = ('dotenv', 'env-dotenv', 'config', 'cli', 'process')
+
+# variables rendered into a Kubernetes Secret unless `secret_keys` is set in config.yml
+DEFAULT_SECRET_PATTERNS = ('*PASSWORD*', '*SECRET*', '*TOKEN*', '*_KEY', '*PRIVATE*', '*CREDENTIAL*')
+
+# process environment variables with this prefix become KEY (KUBEB_VAR_APP_DEBUG -> APP_DEBUG)
+PROCESS_PREFIX = 'KUBEB_VAR_'
+
+_parsed = dict()
+_lock = threading.Lock()
+
+
+def _usable(value):
+    return value is not None and value != '' and value != 'null'
+
+
+def _parse(path):
+    from dotenv import dotenv_values
+    return dict(dotenv_values(path))
+
+
+def parse_dotenv(path):
+    """Parsed dotenv file, {} when it does not exist.
+
+    Parsed files are kept in memory only, dotenv files hold secrets. A file
+    is parsed again when its mtime/size changed and its content hash too.
+    """
+    stamp = file_util.get_file_stamp(path)
+    if stamp is None:
+        return {}
+
+    with _lock:
+        _remove_legacy_cache()
+        cached = _parsed.get(path)
+        if cached and cached['stamp'] == stamp:
+            return cached['values']
+
+        file_hash = file_util.get_file_hash(path)
+        if cached and cached['hash'] == file_hash:
+            cached['stamp'] = stamp
+        else:
+            cached = _parsed[path] = dict(stamp=stamp, hash=file_hash, values=_parse(path))
+        return cached['values']
+
+
+def _remove_legacy_cache():
+    # earlier versions kept parsed values, secrets included, in .kubeb/dotenv-cache.json
+    cache_file = file_util.dotenv_cache_file
+    if os.path.exists(cache_file):
+        try:
+            os.remove(cache_file)
+        except OSError:
+            pass
+
+
+def get_layers(env, cli_vars=None):
+    """[(layer name, source, {key: value})] in precedence order."""
+    base_file = file_util.get_base_environment_file()
+    env_file = file_util.get_environment_file(env)
+    process_vars = dict((key[len(PROCESS_PREFIX):], value) for key, value in os.environ.items()
+                        if key.startswith(PROCESS_PREFIX) and len(key) > len(PROCESS_PREFIX))
+
+    return [
+        ('dotenv', os.path.basename(base_file), parse_dotenv(base_file)),
+        ('env-dotenv', os.path.basename(env_file), parse_dotenv(env_file)),
+        ('config', 'config.yml environments.{}.variables'.format(env), config.get_environment_variables(env) or {}),
+        ('cli', '--var', cli_vars or {}),
+        ('process', PROCESS_PREFIX + '*', process_vars),
+    ]
+
+
+def resolve(env, cli_vars=None):
+    """Resolved variables of `env`: {key: (value, layer, overridden layers)}, sorted by key.
+
+    Empty and `null` values are ignored, so they never hide a lower layer.
+    The key order doesn't depend on where a dotenv file was read from (its
+    cached copy is sorted), so rendered values and fingerprints are stable.
+    """
+    resolved = dict()
+    for layer, _, values in get_layers(env, cli_vars):
+        for key, value in values.items():
+            if not _usable(value):
+                continue
+            overridden = []
+            if key in resolved:
+                overridden = resolved[key][2] + [resolved[key][1]]
+            resolved[key] = (str(value), layer, overridden)
+    return dict(sorted(resolved.items()))
+
+
+def get_variables(env, cli_vars=None):
+    return dict((key, value) for key, (value, _, _) in resolve(env, cli_vars).items())
+
+
+def diff(env_a, env_b):
+    """Compare resolved variables, returns (only in a, only in b, {key: (a, b)})."""
+    vars_a = get_variables(env_a)
+    vars_b = get_variables(env_b)
+    only_a = sorted(set(vars_a) - set(vars_b))
+    only_b = sorted(set(vars_b) - set(vars_a))
+    changed = dict((key, (vars_a[key], vars_b[key])) for key in sorted(set(vars_a) & set(vars_b))
+                   if vars_a[key] != vars_b[key])
+    return only_a, only_b, changed
+
+
+def secret_patterns(env):
+    """The env's secret_keys, DEFAULT_SECRET_PATTERNS when it has none."""
+    patterns = config.get_secret_keys(env)
+    return DEFAULT_SECRET_PATTERNS if patterns is None else patterns
+
+
+def is_secret(key, patterns):
+    key = key.upper()
+    return any(fnmatch.fnmatchcase(key, pattern.upper()) for pattern in patterns)
+
+
+def mask(value):
+    """Stand-in for a secret value in printed output."""
+    return '******' if value else value
+
+
+def split_secrets(env, env_vars):
+    """Split variables into (plain, secret) using the env's secret_keys."""
+    patterns = secret_patterns(env)
+    plain = dict()
+    secret = dict()
+    for key, value in env_vars.items():
+        (secret if is_secret(key, patterns) else plain)[key] = value
+    return plain, secret
@@ -0,0 +1,181 @@
+import os
+import sys
+import time
+import traceback
+import contextlib
+import contextvars
+import concurrent.futures
+
+from kubeb import file_util, tracing
+from kubeb.project import Project, use_project, submit
+
+# never searched for services
+skip_directories = ('node_modules', 'vendor')
+
+_log_file = contextvars.ContextVar('kubeb_workspace_log', default=None)
+
+
+class Service(object):
+
+    def __init__(self, project, name, depends_on):
+        self.project = project
+        self.name = name
+        self.depends_on = depends_on
+
+    @property
+    def directory(self):
+        return self.project.directory
+
+    def __repr__(self):
+        return '<Service {} {}>'.format(self.name, self.directory)
+
+
+def discover(root):
+    """Every directory under `root` with a .kubeb/config.yml, as Services.
+
+    The service name is `name` from its config.yml; `depends_on` lists the
+    names of services that have to be built and deployed first.
+    """
+    services = dict()
+    for directory, dirs, files in os.walk(root):
+        dirs[:] = sorted(name for name in dirs if not name.startswith('.') and name not in skip_directories)
+
+        project = Project(directory)
+        if not os.path.isfile(project.config_file):
+            continue
+
+        with use_project(project):
+            name = file_util.get_value('name', project.config_file) or os.path.basename(project.directory)
+            depends_on = file_util.get_value('depends_on', project.config_file) or []
+        if isinstance(depends_on, str):
+            depends_on = [depends_on]
+
+        if name in services:
+            raise ValueError('service {} found in both {} and {}'.format(name, services[name].directory,
+                                                                       project.directory))
+        services[name] = Service(project, name, list(depends_on))
+    return services
+
+
+def plan(services, only=None):
+    """Services in dependency order, optionally limited to the names in `only`.
+
+    Raises ValueError for unknown dependencies and dependency cycles.
+    """
+    for service in services.values():
+        unknown = [name for name in service.depends_on if name not in services]
+        if unknown:
+            raise ValueError('{} depends on unknown service {}'.format(service.name, ', '.join(unknown)))
+
+    if only:
+        unknown = [name for name in only if name not in services]
+        if unknown:
+            raise ValueError('unknown service {}'.format(', '.join(unknown)))
+        services = dict((name, services[name]) for name in only)
+
+    ordered = []
+    remaining = dict((name, set(dep for dep in service.depends_on if dep in services))
+                     for name, service in services.items())
+    while remaining:
+        ready = sorted(name for name, deps in remaining.items() if not deps)
+        if not ready:
+            raise ValueError('dependency cycle between {}'.format(', '.join(sorted(remaining))))
+        for name in ready:
+            ordered.append(services[name])
+            del remaining[name]
+        for deps in remaining.values():
+            deps.difference_update(ready)
+    return ordered
+
+
+class _Output(object):
+    """sys.stdout/sys.stderr stand-in writing to the log file of the current service, if any."""
+
+    def __init__(self, stream):
+        self._stream = stream
+
+    def _target(self):
+        return _log_file.get() or self._stream
+
+    def write(self, data):
+        return self._target().write(data)
+
+    def flush(self):
+        self._target().flush()
+
+    def isatty(self):
+        return _log_file.get() is None and self._stream.isatty()
+
+    def __getattr__(self, name):
+        return getattr(self._stream, name)
+
+
+@contextlib.contextmanager
+def service_output():
+    """Send output of code running for a service into that service's log file."""
+    stdout, stderr = sys.stdout, sys.stderr
+    sys.stdout, sys.stderr = _Output(stdout), _Output(stderr)
+    try:
+        yield
+    finally:
+        sys.stdout, sys.stderr = stdout, stderr
+
+
+def _run_service(service, action, name):
+    log_directory = os.path.join(service.project.kubeb_directory, 'logs')
+    os.makedirs(log_directory, exist_ok=True)
+    log_path = os.path.join(log_directory, name + '.log')
+
+    started = time.monotonic()
+    with open(log_path, 'w', encoding='utf8', buffering=1) as log_file, use_project(service.project):
+        token = _log_file.set(log_file)
+        try:
+            with tracing.span('workspace.' + name, service=service.name):
+                ok = action(service)
+        except Exception:
+            traceback.print_exc(file=log_file)
+            ok = False
+        finally:
+            _log_file.reset(token)
+    return 'succeeded' if ok else 'failed', time.monotonic() - started, log_path
+
+
+def run(services, action, name, jobs=4, fail_fast=False, log=print):
+    """Run `action(service)` for each service on a pool of `jobs` workers.
+
+    A service starts once all of its dependencies succeeded and is skipped
+    when one of them did not. Output goes to <service>/.kubeb/logs/<name>.log.
+    Returns {service name: status}.
+    """
+    names = set(service.name for service in services)
+    pending = list(services)
+    running = dict()
+    results = dict()
+    failed = False
+
+    with service_output(), concurrent.futures.ThreadPoolExecutor(max_workers=max(1, jobs)) as executor:
+        while pending or running:
+            for service in list(pending):
+                deps = [dep for dep in service.depends_on if dep in names]
+                if fail_fast and failed or any(results.get(dep, 'succeeded') != 'succeeded' for dep in deps
+                                               if dep in results):
+                    results[service.name] = 'skipped'
+                    pending.remove(service)
+                    log('[{}] skipped'.format(service.name))
+                elif all(results.get(dep) == 'succeeded' for dep in deps):
+                    log('[{}] {} started'.format(service.name, name))
+                    running[submit(executor, _run_service, service, action, name)] = service
+                    pending.remove(service)
+
+            if not running:
+                break
+
+            done, _ = concurrent.futures.wait(running, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                service = running.pop(future)
+                status, duration, log_path = future.result()
+                results[service.name] = status
+                failed = failed or status != 'succeeded'
+                log('[{}] {} {} in {:.1f}s, log: {}'.format(service.name, name, status, duration, log_path))
+
+    return results
@@ -29,12 +29,14 @@ setup(
         "License :: OSI Approved :: MIT License",
         "Operating System :: OS Independent",
     ],
+    python_requires='>=3.7',
     install_requires=[
         'click',
         'jinja2',
         'pyyaml',
         'python-dotenv',
         'click-spinner',
+        'importlib_metadata; python_version < "3.8"',
     ],
     entry_points={
         'console_scripts': ['kubeb=kubeb.main:cli'],
@@ -0,0 +1,104 @@
+import os
+import sys
+
+import pytest
+
+# run against the checkout, not an installed kubeb
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+@pytest.fixture
+def project(tmp_path, monkeypatch):
+    """Returns a function creating a kubeb application in a temporary working directory."""
+    import yaml
+    from kubeb import file_util
+
+    root = tmp_path / 'app'
+    root.mkdir()
+    monkeypatch.chdir(root)
+    monkeypatch.setenv('HOME', str(tmp_path))
+    monkeypatch.setattr(file_util, '_stores', dict())
+    monkeypatch.setattr(file_util, '_ledgers', dict())
+
+    def create(versions=0, environments=None, **settings):
+        environments = environments or dict(local=dict(name='local'))
+        (root / '.kubeb').mkdir()
+        for env in environments:
+            (root / ('.env.' + env)).write_text('APP_ENV={}\n'.format(env))
+        config = dict(name='app', image='app', template='laravel', ext_template=False, user='kubeb',
+                      current_environment=list(environments)[0], environments=environments,
+                      version=[dict(tag='v{}'.format(1500000000000 + i * 1000), message='build {}'.format(i))
+                               for i in range(versions)])
+        config.update(settings)
+        with open('.kubeb/config.yml', 'w') as fh:
+            yaml.safe_dump(config, fh)
+        return root
+
+    return create
+
+
+@pytest.fixture
+def helm(tmp_path, monkeypatch):
+    """A fake helm on PATH; returns a function reading the commands it ran.
+
+    `helm history --output json` prints bin/history.json (an empty list by
+    default), `helm upgrade` fails while bin/upgrade-fails exists, every
+    other command succeeds. Values read from stdin end up in bin/values.yaml.
+    """
+    bin_dir = tmp_path / 'bin'
+    bin_dir.mkdir(exist_ok=True)
+    log = bin_dir / 'helm.log'
+    script = bin_dir / 'helm'
+    script.write_text('#!/bin/sh\n'
+                      'echo "$*" >> "{log}"\n'
+                      'case "$*" in\n'
+                      '  *history*json*) cat "{bin}/history.json" 2>/dev/null || echo "[]";;\n'
+                      '  *"-f -"*) cat > "{bin}/values.yaml";;\n'
+                      'esac\n'
+                      'case "$*" in\n'
+                      '  upgrade*) [ -e "{bin}/upgrade-fails" ] && exit 1;;\n'
+                      'esac\n'
+                      'exit 0\n'.format(log=log, bin=bin_dir))
+    script.chmod(0o755)
+    monkeypatch.setenv('PATH', '{}{}{}'.format(bin_dir, os.pathsep, os.environ.get('PATH', '')))
+    monkeypatch.delenv('KUBEB_BACKEND', raising=False)
+
+    def commands():
+        return log.read_text().splitlines() if log.exists() else []
+
+    commands.bin_dir = bin_dir
+    return commands
+
+
+@pytest.fixture
+def docker(tmp_path, monkeypatch):
+    """A fake docker on PATH; returns a function reading the commands it ran.
+
+    `docker push` fails while bin/push-fails exists and otherwise prints the
+    piped (non-terminal) output of one new and one existing layer,
+    `docker image inspect` finds no image.
+    """
+    bin_dir = tmp_path / 'bin'
+    bin_dir.mkdir(exist_ok=True)
+    log = bin_dir / 'docker.log'
+    script = bin_dir / 'docker'
+    script.write_text('#!/bin/sh\n'
+                      'echo "$*" >> "{log}"\n'
+                      'case "$*" in\n'
+                      '  push*) [ -e "{bin}/push-fails" ] && exit 1\n'
+                      '         printf "The push refers to repository [docker.io/library/app]\\n'
+                      '5f70bf18a086: Preparing\\ne2eb06d8af82: Preparing\\ne2eb06d8af82: Waiting\\n'
+                      '5f70bf18a086: Layer already exists\\ne2eb06d8af82: Pushed\\n'
+                      'v1: digest: sha256:0123 size: 528\\n";;\n'
+                      '  "image inspect"*) exit 1;;\n'
+                      '  inspect*) echo "app@sha256:0123";;\n'
+                      'esac\n'
+                      'exit 0\n'.format(log=log, bin=bin_dir))
+    script.chmod(0o755)
+    monkeypatch.setenv('PATH', '{}{}{}'.format(bin_dir, os.pathsep, os.environ.get('PATH', '')))
+
+    def commands():
+        return log.read_text().splitlines() if log.exists() else []
+
+    commands.bin_dir = bin_dir
+    return commands
@@ -0,0 +1,62 @@
+from click.testing import CliRunner
+
+from kubeb import config
+from kubeb.main import cli
+
+
+def _run(*args):
+    return CliRunner().invoke(cli, list(args))
+
+
+def _pushes(docker):
+    return [command for command in docker() if command.startswith('push')]
+
+
+def test_failed_push_is_retried_on_the_next_build(project, docker):
+    project(versions=1)
+    (docker.bin_dir / 'push-fails').touch()
+
+    result = _run('build', '-m', 'first', '--push', '--content-tag', '--retries', '0')
+    assert result.exit_code == 1, result.output
+    tag = config.get_latest_version()['tag']
+    assert config.get_version(tag)['pushed'] is False
+
+    (docker.bin_dir / 'push-fails').unlink()
+    result = _run('build', '-m', 'again', '--push', '--content-tag', '--retries', '0')
+    assert result.exit_code == 0, result.output
+    assert 'not pushed yet' in result.output
+    assert len([command for command in docker() if command.startswith('build')]) == 1
+    assert len(_pushes(docker)) == 2
+    assert config.get_version(tag)['pushed'] is True
+    assert config.get_version(tag)['message'] == 'first'
+
+    result = _run('build', '-m', 'third', '--push', '--content-tag', '--retries', '0')
+    assert result.exit_code == 0, result.output
+    assert 'Reusing it' in result.output
+    assert len(_pushes(docker)) == 2
+
+
+def test_default_version_skips_failed_pushes(project, docker):
+    project(versions=2)
+    pushed = config.get_latest_version()
+    (docker.bin_dir / 'push-fails').touch()
+
+    assert _run('build', '-m', 'broken', '--push', '--retries', '0').exit_code == 1
+    assert config.get_latest_version()['pushed'] is False
+    assert config.get_version() == pushed
+
+    (docker.bin_dir / 'push-fails').unlink()
+    assert _run('push', '--retries', '0').exit_code == 0
+    assert config.get_version()['message'] == 'broken'
+    assert [v['message'] for v in config.get_versions()] == ['build 0', 'build 1', 'broken']
+
+
+def test_push_reports_layers_and_times(project, docker):
+    project(versions=1)
+
+    result = _run('push', '--retries', '0')
+
+    assert result.exit_code == 0, result.output
+    assert 'e2eb06d8af82: Pushed in ' in result.output and '(2/2 layers done)' in result.output
+    assert '1 layers pushed, 1 existing, slowest e2eb06d8af82' in result.output
+    assert '/s' not in result.output
@@ -0,0 +1,88 @@
+import time
+
+import pytest
+from click.testing import CliRunner
+
+from kubeb import file_util
+from kubeb.main import cli
+
+# generous budget for one warm command, the old inline version list took
+# seconds at 10k versions
+latency_budget = 1.0
+
+
+def _tag(i):
+    return 'v{}'.format(1500000000000 + i * 1000)
+
+
+@pytest.fixture
+def parses(monkeypatch):
+    files = []
+    get_yaml_dict = file_util.get_yaml_dict
+
+    def counting(filename):
+        files.append(filename)
+        return get_yaml_dict(filename)
+
+    monkeypatch.setattr(file_util, 'get_yaml_dict', counting)
+    return files
+
+
+def _run(args):
+    # a fresh process: nothing parsed yet
+    file_util._stores.clear()
+    file_util._ledgers.clear()
+    started = time.perf_counter()
+    result = CliRunner().invoke(cli, args)
+    elapsed = time.perf_counter() - started
+    assert result.exit_code == 0, result.output
+    return result, elapsed
+
+
+@pytest.mark.parametrize('versions', [10, 1000, 10000])
+@pytest.mark.parametrize('cache', [True, False])
+def test_version_and_deploy_latency(project, parses, monkeypatch, versions, cache):
+    monkeypatch.setattr(file_util, 'config_cache_enabled', cache)
+    project(versions=versions)
+
+    # first run moves the inline list into versions.jsonl
+    result, _ = _run(['version', '--last', '1'])
+    assert _tag(versions - 1) in result.output
+    assert 'version' not in file_util.get_yaml_dict('.kubeb/config.yml')
+
+    for args, expected in ((['version', '--last', '5'], _tag(versions - 5)),
+                           (['version', '--previous'], _tag(versions - 2)),
+                           (['deploy', '--plan', '--yes'], 'will be upgraded to ' + _tag(versions - 1))):
+        del parses[:]
+        result, elapsed = _run(args)
+        assert expected in result.output
+        # config.yml is parsed at most once per command, never with the cache
+        assert parses.count('.kubeb/config.yml') <= (0 if cache else 1), args
+        assert elapsed < latency_budget, '{} took {:.3f}s with {} versions'.format(args, elapsed, versions)
+
+
+def test_batch_writes_once(project, monkeypatch):
+    project()
+    writes = []
+    write_yaml_file = file_util.write_yaml_file
+    monkeypatch.setattr(file_util, 'write_yaml_file', lambda *args: writes.append(args) or write_yaml_file(*args))
+
+    store = file_util.get_store('.kubeb/config.yml')
+    with store.batch():
+        store.set('image', 'other')
+        store.set('environments', dict(staging=dict(name='staging')))
+        store.delete('user')
+
+    assert len(writes) == 1
+    assert file_util.get_yaml_dict('.kubeb/config.yml')['environments'] == dict(
+        local=dict(name='local'), staging=dict(name='staging'))
+
+
+def test_store_sees_outside_changes(project):
+    project()
+    store = file_util.get_store('.kubeb/config.yml')
+    assert store.get('image') == 'app'
+
+    with open('.kubeb/config.yml', 'a') as fh:
+        fh.write('extra: value\n')
+    assert store.get('extra') == 'value'
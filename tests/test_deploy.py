@@ -0,0 +1,51 @@
+import click
+import pytest
+from click.testing import CliRunner
+
+from kubeb import main
+from kubeb.main import cli
+
+
+def _deploy(*args):
+    return CliRunner().invoke(cli, ['deploy', '--yes', '--no-watch', '--no-preflight'] + list(args))
+
+
+def test_failed_deploy_exits_with_1(project, helm):
+    project(versions=1)
+    (helm.bin_dir / 'upgrade-fails').touch()
+
+    result = _deploy()
+    assert result.exit_code == 1, result.output
+    assert 'Install application failed' in result.output
+
+
+def test_deploy_without_versions_exits_with_1(project, helm):
+    project()
+
+    result = _deploy()
+    assert result.exit_code == 1, result.output
+    assert 'No deployable version found' in result.output
+
+
+def test_canary_steps():
+    assert main.parse_canary_steps(None) is None
+    assert main.parse_canary_steps('10%') == [10]
+    assert main.parse_canary_steps('10%, 50,12.5%') == [10, 50, 12.5]
+    with pytest.raises(click.BadParameter):
+        main.parse_canary_steps('0%')
+    with pytest.raises(click.BadParameter):
+        main.parse_canary_steps('half')
+
+
+def test_canary_steps_imply_canary(project, helm, monkeypatch):
+    project(versions=1)
+    calls = []
+    monkeypatch.setattr('kubeb.kubeb.Kubeb.deploy', lambda self, *args: calls.append(args) or True)
+
+    assert _deploy('--canary-steps', '20%,60%').exit_code == 0
+    assert _deploy('--canary').exit_code == 0
+    assert _deploy().exit_code == 0
+    assert [args[-3:-1] for args in calls] == [(True, [20, 60]), (True, None), (False, None)]
+
+    result = _deploy('--canary', '--envs', 'local')
+    assert result.exit_code == 2
@@ -0,0 +1,85 @@
+import pytest
+import yaml
+from click.testing import CliRunner
+
+from kubeb.main import cli
+
+ENVIRONMENTS = dict(local=dict(name='local'),
+                    staging=dict(name='staging', release='app-staging', kube_context='staging-cluster'))
+
+
+@pytest.fixture
+def app(project, helm):
+    project(versions=1, environments=ENVIRONMENTS, current_environment='staging')
+    return helm
+
+
+def _run(*args):
+    result = CliRunner().invoke(cli, list(args))
+    assert result.exit_code == 0, result.output
+    return result.output
+
+
+def _config():
+    with open('.kubeb/config.yml') as fh:
+        return yaml.safe_load(fh)
+
+
+def test_deploy_uses_release_and_context_of_the_environment(app):
+    _run('deploy', '--yes', '--no-watch', '--no-preflight')
+
+    install = [command for command in app() if command.startswith('upgrade')]
+    assert len(install) == 1
+    assert 'app-staging' in install[0].split()
+    assert '--kube-context staging-cluster' in install[0]
+
+
+def test_rollback_delete_and_status_use_the_environment(app):
+    _run('rollback', '3', '--yes')
+    _run('delete', '--yes')
+    output = _run('status')
+
+    commands = app()
+    assert 'rollback app-staging 3 --kube-context staging-cluster' in commands
+    assert 'delete --purge app-staging --kube-context staging-cluster' in commands
+    assert any(command.startswith('history app-staging') and 'staging-cluster' in command for command in commands)
+    assert 'app-staging' in output
+
+
+def test_env_registers_a_new_environment(app):
+    _run('env', 'qa')
+
+    config = _config()
+    assert config['current_environment'] == 'qa'
+    assert config['environments']['qa'] == dict(name='qa', release='app-qa')
+    assert config['environments']['staging'] == ENVIRONMENTS['staging']
+
+    output = _run('deploy', '--envs', 'local,qa', '--plan', '--yes')
+    assert 'local' in output and 'qa' in output
+
+
+def test_env_keeps_existing_settings(app):
+    _run('env', 'local')
+    _run('env', 'staging')
+
+    assert _config()['environments'] == ENVIRONMENTS
+
+
+def test_init_force_keeps_environments_and_versions(app):
+    with open('.kubeb/config.yml') as fh:
+        config = yaml.safe_load(fh)
+    config['environments']['staging']['options'] = dict(set=dict(replicas='2'))
+    config['secret_keys'] = ['STRIPE_*']
+    with open('.kubeb/config.yml', 'w') as fh:
+        yaml.safe_dump(config, fh)
+
+    _run('init', '--name', 'renamed', '--user', 'kubeb', '--template', 'laravel', '--image', 'app', '--env', 'qa', '--force')
+
+    config = _config()
+    assert config['name'] == 'renamed'
+    assert config['current_environment'] == 'qa'
+    assert config['environments']['qa'] == dict(name='qa')
+    assert config['environments']['staging'] == dict(ENVIRONMENTS['staging'], options=dict(set=dict(replicas='2')))
+    assert config['secret_keys'] == ['STRIPE_*']
+    assert 'version' not in config
+    assert 'v1500000000000' in _run('version', '--last', '1')
@@ -0,0 +1,45 @@
+import builtins
+import sys
+
+import pytest
+
+from kubeb import file_util, generators
+
+
+@pytest.fixture
+def registered(tmp_path, monkeypatch):
+    """A distribution on sys.path registering `acme` under kubeb.generators."""
+    site = tmp_path / 'site'
+    (site / 'acme_kubeb').mkdir(parents=True)
+    (site / 'acme_kubeb' / '__init__.py').write_text(
+        'from kubeb.generators.base_generator import TemplateGenerator\n\n\n'
+        'class AcmeGenerator(TemplateGenerator):\n    pass\n')
+    dist_info = site / 'acme_kubeb-1.0.dist-info'
+    dist_info.mkdir()
+    (dist_info / 'METADATA').write_text('Metadata-Version: 2.1\nName: acme-kubeb\nVersion: 1.0\n')
+    (dist_info / 'entry_points.txt').write_text('[kubeb.generators]\nacme = acme_kubeb:AcmeGenerator\n')
+
+    monkeypatch.syspath_prepend(str(site))
+    monkeypatch.setattr(file_util, 'user_cache_directory', str(tmp_path / 'cache'))
+    monkeypatch.setattr(generators, '_index', None)
+    yield
+    sys.modules.pop('acme_kubeb', None)
+
+
+def test_entry_point_generator(registered):
+    assert generators.discover()['acme'] == 'acme_kubeb:AcmeGenerator'
+    assert generators.get_generator('acme').__name__ == 'AcmeGenerator'
+
+
+def test_entry_point_generator_without_importlib_metadata(registered, monkeypatch):
+    # python 3.7 has neither importlib.metadata nor, unless installed, importlib_metadata
+    real_import = builtins.__import__
+
+    def python37_import(name, globals=None, locals=None, fromlist=(), level=0):
+        if name == 'importlib_metadata' or (name == 'importlib' and 'metadata' in (fromlist or ())):
+            raise ImportError(name)
+        return real_import(name, globals, locals, fromlist, level)
+
+    monkeypatch.setattr(builtins, '__import__', python37_import)
+
+    assert generators.discover()['acme'] == 'acme_kubeb:AcmeGenerator'
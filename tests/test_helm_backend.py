@@ -0,0 +1,182 @@
+import json
+import shutil
+import ssl
+import subprocess
+import threading
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from urllib.parse import urlparse, parse_qs
+
+import pytest
+import yaml
+
+from kubeb.helm_backend import ApiBackend, KubeConfig
+
+
+class FakeApiServer(HTTPServer):
+    """Kubernetes API serving helm release ConfigMaps (helm 2) or Secrets (helm 3); `status` != 200 fails every request"""
+
+    def __init__(self, ssl_context=None):
+        HTTPServer.__init__(self, ('127.0.0.1', 0), FakeApiHandler)
+        if ssl_context:
+            self.socket = ssl_context.wrap_socket(self.socket, server_side=True)
+        self.scheme = 'https' if ssl_context else 'http'
+        self.requests = []
+        self.status = 200
+        self.releases = dict()
+
+    @property
+    def url(self):
+        return '{}://127.0.0.1:{}'.format(self.scheme, self.server_address[1])
+
+
+class FakeApiHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        self.server.requests.append((url.path, parse_qs(url.query), self.headers.get('Authorization')))
+        selector = dict(item.split('=') for item in parse_qs(url.query)['labelSelector'][0].split(','))
+        helm3 = 'name' in selector
+        name = selector['name' if helm3 else 'NAME']
+        items = [dict(metadata=dict(name='{}.v{}'.format(name, revision), creationTimestamp='t',
+                                    labels=dict(name=name, owner='helm', version=str(revision), status=status.lower())
+                                    if helm3 else dict(NAME=name, OWNER='TILLER', VERSION=str(revision), STATUS=status)))
+                 for revision, status in self.server.releases.get(name, [])]
+        body = json.dumps(dict(kind='ConfigMapList', items=items)).encode('utf8')
+        self.send_response(self.server.status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+def _serve(server):
+    thread = threading.Thread(target=server.serve_forever, args=(0.05,), daemon=True)
+    thread.start()
+    return server
+
+
+@pytest.fixture
+def api_server(monkeypatch):
+    server = _serve(FakeApiServer())
+    monkeypatch.setenv('KUBEB_API_SERVER', server.url)
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture(scope='module')
+def certificate(tmp_path_factory):
+    if not shutil.which('openssl'):
+        pytest.skip('openssl not installed')
+    directory = tmp_path_factory.mktemp('tls')
+    cert, key = str(directory / 'server.crt'), str(directory / 'server.key')
+    subprocess.run(['openssl', 'req', '-x509', '-newkey', 'rsa:2048', '-nodes', '-days', '1', '-subj', '/CN=127.0.0.1',
+                    '-addext', 'subjectAltName=IP:127.0.0.1', '-keyout', key, '-out', cert],
+                   stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, check=True)
+    return cert, key
+
+
+@pytest.fixture
+def https_server(certificate, monkeypatch):
+    context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+    context.load_cert_chain(*certificate)
+    server = _serve(FakeApiServer(context))
+    monkeypatch.setenv('KUBEB_API_SERVER', server.url)
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def _kubeconfig(tmp_path, monkeypatch, cluster, user=None, namespace=None):
+    path = tmp_path / 'kubeconfig'
+    context = dict(cluster='test', user='test')
+    if namespace:
+        context['namespace'] = namespace
+    path.write_text(yaml.safe_dump({
+        'current-context': 'test',
+        'contexts': [dict(name='test', context=context)],
+        'clusters': [dict(name='test', cluster=dict(cluster, server='https://cluster.invalid'))],
+        'users': [dict(name='test', user=user or {})],
+    }))
+    monkeypatch.setenv('KUBECONFIG', str(path))
+
+
+def test_history_from_release_configmaps(api_server):
+    api_server.releases['app'] = [(3, 'DEPLOYED'), (1, 'SUPERSEDED'), (2, 'FAILED')]
+    backend = ApiBackend(storage='configmap', namespace='kube-system')
+
+    assert [(r['revision'], r['status']) for r in backend.history('app')] == [
+        (1, 'SUPERSEDED'), (2, 'FAILED'), (3, 'DEPLOYED')]
+    assert [r['revision'] for r in backend.history('app', max_revisions=2)] == [2, 3]
+    assert backend.history('other') == []
+
+    path, query, _ = api_server.requests[0]
+    assert path == '/api/v1/namespaces/kube-system/configmaps'
+    assert query['labelSelector'] == ['OWNER=TILLER,NAME=app']
+
+
+def test_history_from_release_secrets_in_the_context_namespace(api_server, tmp_path, monkeypatch):
+    _kubeconfig(tmp_path, monkeypatch, dict(), namespace='team-a')
+    api_server.releases['app'] = [(2, 'DEPLOYED'), (1, 'SUPERSEDED')]
+
+    assert [(r['revision'], r['status']) for r in ApiBackend(storage='secret').history('app')] == [
+        (1, 'SUPERSEDED'), (2, 'DEPLOYED')]
+    path, query, _ = api_server.requests[0]
+    assert path == '/api/v1/namespaces/team-a/secrets'
+    assert query['labelSelector'] == ['owner=helm,name=app']
+
+    monkeypatch.setenv('KUBECONFIG', str(tmp_path / 'missing'))
+    ApiBackend(storage='secret').history('app')
+    assert api_server.requests[1][0] == '/api/v1/namespaces/default/secrets'
+
+
+def test_history_falls_back_to_helm(api_server, project, helm, capsys):
+    project()
+    (helm.bin_dir / 'history.json').write_text(json.dumps([dict(revision=7, status='DEPLOYED')]))
+    api_server.status = 500
+
+    assert [r['revision'] for r in ApiBackend().history('app')] == [7]
+    assert api_server.requests
+    assert helm() == ['history app --output json']
+    out, err = capsys.readouterr()
+    assert 'falling back to helm' in err and 'falling back' not in out
+
+
+def test_https_server_is_verified(https_server, project, helm, tmp_path, monkeypatch):
+    project()
+    _kubeconfig(tmp_path, monkeypatch, dict())
+    https_server.releases['app'] = [(1, 'DEPLOYED')]
+
+    # self-signed and not trusted: no request gets through, helm answers
+    assert ApiBackend().history('app') == []
+    assert helm() == ['history app --output json']
+    assert KubeConfig.load().ssl_context.verify_mode == ssl.CERT_REQUIRED
+
+
+def test_https_server_with_kubeconfig_ca(https_server, certificate, tmp_path, monkeypatch):
+    _kubeconfig(tmp_path, monkeypatch, {'certificate-authority': certificate[0]}, dict(token='secret'))
+    https_server.releases['app'] = [(1, 'DEPLOYED')]
+
+    assert [r['revision'] for r in ApiBackend().history('app')] == [1]
+    assert https_server.requests[0][2] == 'Bearer secret'
+
+
+def test_insecure_https_is_opt_in(https_server, tmp_path, monkeypatch):
+    _kubeconfig(tmp_path, monkeypatch, dict())
+    monkeypatch.setenv('KUBEB_API_INSECURE', '1')
+    https_server.releases['app'] = [(1, 'DEPLOYED')]
+
+    assert KubeConfig.load().ssl_context.verify_mode == ssl.CERT_NONE
+    assert [r['revision'] for r in ApiBackend().history('app')] == [1]
+
+
+def test_plain_http_server_needs_no_kubeconfig(api_server, tmp_path, monkeypatch):
+    monkeypatch.setenv('KUBECONFIG', str(tmp_path / 'missing'))
+    config = KubeConfig.load()
+
+    assert config.server == api_server.url
+    assert config.ssl_context is None and config.headers == {}
@@ -0,0 +1,89 @@
+import pytest
+import yaml
+from click.testing import CliRunner
+
+from kubeb import helm_options
+from kubeb.main import cli
+
+
+@pytest.mark.parametrize('key', ['a', 'a.b\\.c[0].d', 'list[1][2]', 'we\\,ird\\=key'])
+def test_join_key_is_the_inverse_of_split_key(key):
+    assert helm_options.join_key(helm_options.split_key(key)) == key
+
+
+def test_file_references_do_not_read_the_files():
+    assert helm_options.file_references(['a.b=missing.pem,c=other', 'd[0]=list.txt']) == {
+        'a.b': 'missing.pem', 'c': 'other', 'd[0]': 'list.txt'}
+
+
+def test_without():
+    values = dict(a=dict(b=1, c=2), d=[1, 2], e=dict(f=1))
+    assert helm_options.without(values, [('a', 'b'), ('d', 0), ('e', 'f')]) == dict(a=dict(c=2))
+    assert values == dict(a=dict(b=1, c=2), d=[1, 2], e=dict(f=1))
+
+
+def _deploy(*args):
+    result = CliRunner().invoke(cli, ['deploy', '--yes', '--no-watch', '--no-preflight', '--always'] + list(args))
+    return result
+
+
+def _saved():
+    with open('.kubeb/config.yml') as fh:
+        return yaml.safe_load(fh)['environments']['local']
+
+
+def _values(helm):
+    return yaml.safe_load((helm.bin_dir / 'values.yaml').read_text())
+
+
+@pytest.fixture
+def app(project, helm):
+    root = project(versions=1)
+    (root / 'cert.pem').write_text('-----BEGIN CERTIFICATE-----\n')
+    return root
+
+
+def test_file_contents_and_secrets_are_not_saved(app, helm):
+    result = _deploy('--set-file', 'tls.cert=cert.pem', '--set', 'db.password=hunter2,replicaCount=3')
+    assert result.exit_code == 0, result.output
+    assert 'Not saving secret-like options db.password' in result.output
+    assert _values(helm)['db'] == dict(password='hunter2')
+
+    saved = _saved()
+    assert saved['options'] == dict(replicaCount=3)
+    assert saved['option_files'] == {'tls.cert': 'cert.pem'}
+    config_text = (app / '.kubeb' / 'config.yml').read_text()
+    assert 'hunter2' not in config_text and 'BEGIN CERTIFICATE' not in config_text
+
+    # the next deploy reads the file again and leaves the secret out
+    (app / 'cert.pem').write_text('renewed\n')
+    assert _deploy().exit_code == 0
+    values = _values(helm)
+    assert values['tls'] == dict(cert='renewed\n')
+    assert values['replicaCount'] == 3
+    assert 'db' not in values
+
+
+def test_new_option_replaces_saved_file_reference(app, helm):
+    assert _deploy('--set-file', 'tls.cert=cert.pem').exit_code == 0
+    assert _deploy('--set', 'tls.cert=inline').exit_code == 0
+
+    saved = _saved()
+    assert saved['options'] == dict(tls=dict(cert='inline'))
+    assert 'option_files' not in saved
+
+    assert _deploy('--set-file', 'tls=cert.pem').exit_code == 0
+    saved = _saved()
+    assert 'options' not in saved
+    assert saved['option_files'] == dict(tls='cert.pem')
+
+
+def test_missing_saved_file_fails_the_deploy(app, helm):
+    assert _deploy('--set-file', 'tls.cert=cert.pem').exit_code == 0
+    (app / 'cert.pem').unlink()
+
+    result = _deploy()
+    assert result.exit_code == 1
+    assert 'Saved --set-file option failed' in result.output
+    assert _deploy('--reset-options').exit_code == 0
+    assert 'option_files' not in _saved()
@@ -0,0 +1,73 @@
+import json
+
+import pytest
+
+from kubeb.ledger import VersionLedger
+
+
+def _tag(i):
+    return 'v{}'.format(1500000000000 + i * 1000)
+
+
+@pytest.fixture
+def ledger(tmp_path):
+    return VersionLedger(str(tmp_path / 'versions.jsonl'))
+
+
+def test_migrate_keeps_list_order_for_custom_tags(ledger):
+    versions = [dict(tag=_tag(1)), dict(tag='hotfix'), dict(tag=_tag(2)), dict(tag='release-2')]
+    assert ledger.migrate(versions)
+
+    assert [v['tag'] for v in ledger.all()] == [_tag(1), 'hotfix', _tag(2), 'release-2']
+    assert ledger.latest()['tag'] == 'release-2'
+    assert ledger.previous('release-2')['tag'] == _tag(2)
+    assert ledger.previous('hotfix')['tag'] == _tag(1)
+
+
+def test_migrate_only_once(ledger):
+    assert ledger.migrate([dict(tag=_tag(1))])
+    assert not ledger.migrate([dict(tag=_tag(2))])
+    assert [v['tag'] for v in ledger.all()] == [_tag(1)]
+
+
+def test_builds_after_migration_are_newest(ledger):
+    ledger.migrate([dict(tag=_tag(1)), dict(tag='custom')])
+    ledger.append('v9999999999999')
+
+    assert ledger.latest()['tag'] == 'v9999999999999'
+    assert ledger.previous()['tag'] == 'custom'
+
+
+def test_lookup_and_order_on_large_ledger(ledger):
+    count = 100000
+    # appended out of order, the index orders by build time
+    records = [dict(tag=_tag(i), message='', timestamp=float(i)) for i in range(count)]
+    with open(ledger.filename, 'w', encoding='utf8') as fh:
+        for record in records[1::2] + records[::2]:
+            fh.write(json.dumps(record) + '\n')
+
+    assert len(ledger) == count
+    assert ledger.latest()['tag'] == _tag(count - 1)
+    assert ledger.get(_tag(12345))['timestamp'] == 12345.0
+    assert ledger.get('missing') is None
+    assert ledger.previous(_tag(50000))['tag'] == _tag(49999)
+    assert ledger.previous(_tag(0)) is None
+    assert [v['tag'] for v in ledger.recent(3)] == [_tag(count - 1), _tag(count - 2), _tag(count - 3)]
+
+
+def test_rebuilt_tag_moves_to_the_end(ledger):
+    ledger.append('a', timestamp=1.0)
+    ledger.append('b', timestamp=2.0)
+    ledger.append('a', timestamp=3.0)
+
+    assert [v['tag'] for v in ledger.all()] == ['b', 'a']
+    assert ledger.latest()['tag'] == 'a'
+
+
+def test_picks_up_lines_from_other_writers(ledger):
+    ledger.append('a', timestamp=1.0)
+    assert ledger.latest()['tag'] == 'a'
+
+    other = VersionLedger(ledger.filename)
+    other.append('b', timestamp=2.0)
+    assert ledger.latest()['tag'] == 'b'
@@ -0,0 +1,77 @@
+import pytest
+
+from kubeb import release_state, util
+
+
+class FakeHistory(object):
+    """helm history of one release; `--max N` returns the newest N revisions"""
+
+    def __init__(self):
+        self.statuses = []
+        self.calls = []
+
+    def __call__(self, name, max_revisions=None, timeout=None, kube_context=None):
+        self.calls.append(max_revisions)
+        history = [dict(revision=i + 1, status=status, updated='', chart='app-0.1.0', description='')
+                   for i, status in enumerate(self.statuses)]
+        return history[-max_revisions:] if max_revisions else history
+
+    def deploy(self, status='DEPLOYED'):
+        # a failed upgrade leaves the deployed revision as it is
+        if status == 'DEPLOYED':
+            self.statuses = ['SUPERSEDED' if s == 'DEPLOYED' else s for s in self.statuses]
+        self.statuses.append(status)
+
+
+@pytest.fixture
+def helm_history(project, monkeypatch):
+    project()
+    history = FakeHistory()
+    monkeypatch.setattr(util, 'get_helm_history', history)
+    return history
+
+
+def _statuses(snapshot):
+    return dict((r['revision'], r['status']) for r in release_state.revisions(snapshot))
+
+
+def test_refresh_rereads_revisions_that_were_deployed(helm_history):
+    helm_history.deploy()
+    helm_history.deploy()
+    assert _statuses(release_state.refresh('app')) == {1: 'SUPERSEDED', 2: 'DEPLOYED'}
+
+    for _ in range(13):
+        helm_history.deploy('FAILED')
+    snapshot = release_state.refresh('app')
+    assert _statuses(snapshot)[2] == 'DEPLOYED'
+    assert release_state.last_working_revision(snapshot) == 1
+
+    helm_history.deploy()
+    snapshot = release_state.refresh('app')
+    assert _statuses(snapshot)[2] == 'SUPERSEDED'
+    assert _statuses(snapshot)[16] == 'DEPLOYED'
+    assert release_state.last_working_revision(snapshot) == 2
+
+
+def test_refresh_only_fetches_new_revisions_when_settled(helm_history):
+    for _ in range(50):
+        helm_history.deploy()
+    release_state.refresh('app')
+    helm_history.deploy()
+
+    del helm_history.calls[:]
+    snapshot = release_state.refresh('app')
+    # revision 50 was DEPLOYED, 10 revisions reach back to it
+    assert helm_history.calls == [release_state.initial_batch]
+    assert _statuses(snapshot)[50] == 'SUPERSEDED'
+    assert len(snapshot['revisions']) == 51
+
+
+def test_refresh_starts_over_after_purge(helm_history):
+    for _ in range(5):
+        helm_history.deploy()
+    release_state.refresh('app')
+
+    helm_history.statuses = []
+    helm_history.deploy()
+    assert _statuses(release_state.refresh('app')) == {1: 'DEPLOYED'}
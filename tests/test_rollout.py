@@ -0,0 +1,56 @@
+import json
+import os
+import time
+
+import pytest
+
+from kubeb.rollout import RolloutWatcher
+
+
+def _deployment(ready):
+    return dict(kind='Deployment', metadata=dict(name='app', generation=2),
+                spec=dict(replicas=1),
+                status=dict(observedGeneration=2, replicas=1, updatedReplicas=1, availableReplicas=1 if ready else 0))
+
+
+@pytest.fixture
+def kubectl(tmp_path, monkeypatch):
+    """A fake kubectl listing bin/deployments.json, whose watch prints it and then blocks"""
+    bin_dir = tmp_path / 'bin'
+    bin_dir.mkdir()
+    script = bin_dir / 'kubectl'
+    script.write_text('#!/bin/sh\n'
+                      'echo "$*" >> "{bin}/kubectl.log"\n'
+                      'case "$*" in\n'
+                      '  *deployments*--watch*) cat "{bin}/deployments.json" 2>/dev/null; exec sleep 30;;\n'
+                      '  *deployments*) echo "{{\\"kind\\": \\"List\\", \\"items\\": [$(cat "{bin}/deployments.json" '
+                      '2>/dev/null)]}}";;\n'
+                      '  *--watch*) exec sleep 30;;\n'
+                      'esac\n'.format(bin=bin_dir))
+    script.chmod(0o755)
+    monkeypatch.setenv('PATH', '{}{}{}'.format(bin_dir, os.pathsep, os.environ.get('PATH', '')))
+    return bin_dir
+
+
+def test_release_without_deployments_is_done(kubectl):
+    lines = []
+    started = time.monotonic()
+
+    assert RolloutWatcher('app', timeout=10, log=lines.append).wait()
+    assert time.monotonic() - started < 5
+    assert lines == ['No Deployments match release=app, nothing to wait for']
+    assert '--watch' not in (kubectl / 'kubectl.log').read_text()
+
+
+def test_rolled_out_deployment(kubectl):
+    (kubectl / 'deployments.json').write_text(json.dumps(_deployment(ready=True)) + '\n')
+
+    assert RolloutWatcher('app', timeout=10, log=lambda line: None).wait()
+
+
+def test_deployment_not_ready_times_out(kubectl):
+    (kubectl / 'deployments.json').write_text(json.dumps(_deployment(ready=False)) + '\n')
+    watcher = RolloutWatcher('app', timeout=1, log=lambda line: None)
+
+    assert not watcher.wait()
+    assert watcher.failure == 'timed out after 1s'
@@ -0,0 +1,41 @@
+from click.testing import CliRunner
+
+from kubeb import config
+from kubeb.main import cli
+
+
+def _run(*args):
+    return CliRunner().invoke(cli, list(args))
+
+
+def _ship(*args):
+    return _run('ship', '-m', 'shipped', '--retries', '0', '--no-watch', '--no-preflight', '--yes', *args)
+
+
+def test_ship_installs_the_pushed_version(project, docker, helm):
+    project()
+
+    result = _ship()
+    assert result.exit_code == 0, result.output
+    version = config.get_latest_version()
+    assert version['pushed'] is True and version['message'] == 'shipped'
+    assert any(command.startswith('upgrade') for command in helm())
+
+
+def test_failed_push_is_recorded_for_kubeb_push(project, docker, helm):
+    project(versions=1)
+    (docker.bin_dir / 'push-fails').touch()
+
+    result = _ship()
+    assert result.exit_code == 1, result.output
+    version = config.get_latest_version()
+    assert version['pushed'] is False and version['message'] == 'shipped'
+    assert 'kubeb push -v {}'.format(version['tag']) in result.output
+    assert not any(command.startswith('upgrade') for command in helm())
+    assert config.get_version()['message'] == 'build 0'
+
+    (docker.bin_dir / 'push-fails').unlink()
+    result = _run('push', '-v', version['tag'], '--retries', '0')
+    assert result.exit_code == 0, result.output
+    assert config.get_version()['tag'] == version['tag']
+    assert config.get_version()['pushed'] is True
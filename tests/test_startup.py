@@ -0,0 +1,55 @@
+import os
+import subprocess
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# imported on first use only, see file_util._yaml and kubeb.main
+LAZY = ('yaml', 'jinja2', 'dotenv', 'click_spinner', 'asyncio', 'kubeb.kubeb')
+
+# only imported by the commands using them, see kubeb.kubeb.Kubeb
+COMMAND_ONLY = ('yaml', 'jinja2', 'dotenv', 'click_spinner', 'asyncio',
+                'kubeb.docker_context', 'kubeb.release_state', 'kubeb.helm_options')
+
+# microseconds spent in kubeb's own modules, click and the stdlib not counted
+budget = 50000
+
+
+def _importtime(code, cwd=ROOT):
+    env = dict(os.environ, PYTHONPATH=ROOT)
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', code], cwd=cwd, env=env,
+                            stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True, check=True)
+    modules = dict()
+    for line in result.stderr.splitlines():
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+        self_us, cumulative, name = line[len('import time:'):].split('|')
+        modules[name.strip()] = (int(self_us), int(cumulative))
+    return modules
+
+
+def test_cli_startup_stays_lazy():
+    modules = _importtime('from kubeb.main import cli; cli(["--help"], standalone_mode=False)')
+
+    assert 'kubeb.main' in modules
+    assert [name for name in modules if name in LAZY or name.split('.')[0] in LAZY] == []
+
+
+def test_cli_startup_budget():
+    modules = _importtime('import kubeb.main')
+
+    own = sum(self_us for name, (self_us, _) in modules.items() if name.split('.')[0] == 'kubeb')
+    assert own < budget, 'kubeb modules took {}us to import, budget {}us'.format(own, budget)
+
+
+def test_version_command_imports(project):
+    root = project(versions=3)
+    code = 'from kubeb.main import cli; cli(["version"], standalone_mode=False)'
+    # the first run moves the versions to versions.jsonl and fills the config cache
+    _importtime(code, cwd=str(root))
+    modules = _importtime(code, cwd=str(root))
+
+    assert 'kubeb.kubeb' in modules
+    assert [name for name in modules if name in COMMAND_ONLY or name.split('.')[0] in COMMAND_ONLY] == []
+    own = sum(self_us for name, (self_us, _) in modules.items() if name.split('.')[0] == 'kubeb')
+    assert own < budget, 'kubeb modules took {}us to import for `kubeb version`, budget {}us'.format(own, budget)
@@ -0,0 +1,48 @@
+import pytest
+
+from kubeb import file_util, template_catalog
+
+
+@pytest.fixture
+def ext_templates(tmp_path, monkeypatch):
+    root = tmp_path / 'ext_templates'
+    root.mkdir()
+    monkeypatch.setattr(file_util, 'ext_template_directory', str(root) + '/')
+    monkeypatch.setattr(file_util, 'user_cache_directory', str(tmp_path / 'cache'))
+    monkeypatch.setattr(template_catalog, '_catalog', None)
+    return root
+
+
+def _ext(name):
+    # a new process: only the cached catalog on disk
+    template_catalog._catalog = None
+    return template_catalog.get_template(name)['ext']
+
+
+def test_catalog_follows_edits_inside_a_template(ext_templates):
+    (ext_templates / 'acme' / 'acme').mkdir(parents=True)
+    (ext_templates / 'acme' / 'info.yaml').write_text('version: 1\n')
+    (ext_templates / 'acme' / 'acme' / 'Chart.yaml').write_text('name: acme\n')
+    assert _ext('acme')['version'] == '1'
+
+    (ext_templates / 'acme' / 'info.yaml').write_text('version: 10\n')
+    assert _ext('acme')['version'] == '10'
+
+    (ext_templates / 'acme' / 'acme' / 'Chart.yaml').write_text('name: acme-chart\n')
+    assert _ext('acme')['chart_name'] == 'acme-chart'
+
+
+def test_sync_replaces_files_and_directories_of_the_same_name(tmp_path):
+    src, dst = tmp_path / 'src', tmp_path / 'dst'
+    (src / 'templates').mkdir(parents=True)
+    (src / 'templates' / 'deployment.yaml').write_text('kind: Deployment\n')
+    (src / 'values.yaml').write_text('replicaCount: 1\n')
+    (dst / 'values.yaml').mkdir(parents=True)
+    (dst / 'values.yaml' / 'old.yaml').write_text('old\n')
+    (dst / 'templates').write_text('was a file\n')
+
+    template_catalog.sync_directory(str(src), str(dst))
+
+    assert (dst / 'templates' / 'deployment.yaml').read_text() == 'kind: Deployment\n'
+    assert (dst / 'values.yaml').read_text() == 'replicaCount: 1\n'
+    assert template_catalog.sync_directory(str(src), str(dst)) == (0, 0)
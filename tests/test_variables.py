@@ -0,0 +1,57 @@
+from click.testing import CliRunner
+
+from kubeb import variables
+from kubeb.main import cli
+
+
+def _deploy():
+    # a new process: nothing parsed yet
+    variables._parsed.clear()
+    result = CliRunner().invoke(cli, ['deploy', '--yes', '--no-watch', '--no-preflight'])
+    assert result.exit_code == 0, result.output
+    return result.output
+
+
+def test_parsed_dotenv_values_stay_off_disk(project):
+    root = project()
+    (root / '.env.local').write_text('DB_PASSWORD=hunter2\n')
+    (root / '.kubeb' / 'dotenv-cache.json').write_text('{"old": {"values": {"DB_PASSWORD": "hunter2"}}}')
+
+    assert variables.get_variables('local') == dict(DB_PASSWORD='hunter2')
+    assert not (root / '.kubeb' / 'dotenv-cache.json').exists()
+    assert not any(b'hunter2' in path.read_bytes() for path in (root / '.kubeb').iterdir() if path.is_file())
+
+
+def test_cached_dotenv_renders_the_same_values(project, helm):
+    root = project(versions=1)
+    (root / '.env.local').write_text('ZETA=1\nALPHA=2\nMIDDLE=3\n')
+
+    assert 'Install application succeed' in _deploy()
+    assert 'unchanged since last deploy' in _deploy()
+    assert len([command for command in helm() if command.startswith('upgrade')]) == 1
+
+
+def test_resolved_variables_are_sorted(project, monkeypatch):
+    root = project()
+    (root / '.env').write_text('B=1\nA=1\n')
+    (root / '.env.local').write_text('D=1\nC=1\n')
+    monkeypatch.setenv('KUBEB_VAR_AA', '1')
+
+    assert list(variables.get_variables('local', dict(Z='1', E='1'))) == ['A', 'AA', 'B', 'C', 'D', 'E', 'Z']
+
+
+def test_env_vars_and_diff_mask_secrets(project):
+    root = project(environments=dict(local=dict(name='local'), staging=dict(name='staging', secret_keys=['STRIPE_*'])))
+    (root / '.env.local').write_text('DB_PASSWORD=hunter2\nSTRIPE_ID=acct_1\nAPP_NAME=local\n')
+    (root / '.env.staging').write_text('DB_PASSWORD=swordfish\nSTRIPE_ID=acct_2\nAPP_NAME=staging\n')
+
+    output = CliRunner().invoke(cli, ['env', 'vars', 'local', '--explain']).output
+    assert 'DB_PASSWORD=******' in output and 'APP_NAME=local' in output and 'STRIPE_ID=acct_1' in output
+
+    output = CliRunner().invoke(cli, ['env', 'vars', 'staging']).output
+    assert 'STRIPE_ID=******' in output and 'DB_PASSWORD=swordfish' in output
+
+    output = CliRunner().invoke(cli, ['env', 'diff', 'local', 'staging']).output
+    assert '~ DB_PASSWORD: ****** -> ******' in output and '~ STRIPE_ID: ****** -> ******' in output
+    assert '~ APP_NAME: local -> staging' in output
+    assert not any(secret in output for secret in ('hunter2', 'swordfish', 'acct_'))
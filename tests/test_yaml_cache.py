@@ -0,0 +1,73 @@
+import time
+
+import pytest
+import yaml
+
+from kubeb import file_util
+
+
+def _best_of(func, rounds=3):
+    best = None
+    for _ in range(rounds):
+        started = time.perf_counter()
+        func()
+        elapsed = time.perf_counter() - started
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+@pytest.fixture
+def config_file(tmp_path):
+    data = dict(name='app', image='app', template='laravel',
+                environments={'env{}'.format(i): dict(name='env{}'.format(i), release='app-{}'.format(i),
+                                                      options=dict(set=['replicas={}'.format(i)]))
+                              for i in range(300)},
+                version=[dict(tag='v{}'.format(1500000000000 + i), message='build {}'.format(i)) for i in range(1000)])
+    path = tmp_path / 'config.yml'
+    file_util.write_yaml_file(str(path), data)
+    return str(path), data
+
+
+@pytest.mark.skipif(not hasattr(yaml, 'CSafeLoader'), reason='PyYAML built without libyaml')
+def test_c_loader_is_faster(config_file):
+    path, data = config_file
+    assert file_util._yaml()[1] is yaml.CSafeLoader
+
+    with open(path) as fh:
+        text = fh.read()
+    pure = _best_of(lambda: yaml.load(text, Loader=yaml.SafeLoader))
+    native = _best_of(lambda: yaml.load(text, Loader=yaml.CSafeLoader))
+
+    assert file_util.get_yaml_dict(path) == data
+    assert native * 2 < pure, 'CSafeLoader {:.3f}s, SafeLoader {:.3f}s'.format(native, pure)
+
+
+def test_pickle_cache_skips_the_parse(config_file, monkeypatch):
+    path, data = config_file
+    monkeypatch.setattr(file_util, 'config_cache_enabled', True)
+    file_util.ConfigStore(path).get('name')
+
+    parsed = _best_of(lambda: file_util.get_yaml_dict(path))
+    stamp = file_util.get_file_stamp(path)
+    cached = _best_of(lambda: file_util.read_yaml_cache(path, stamp))
+
+    assert file_util.read_yaml_cache(path, stamp) == data
+    assert cached * 2 < parsed, 'cache {:.3f}s, parse {:.3f}s'.format(cached, parsed)
+
+    monkeypatch.setattr(file_util, 'get_yaml_dict', lambda filename: pytest.fail('parsed ' + filename))
+    assert file_util.ConfigStore(path).get('environments') == data['environments']
+
+
+def test_pickle_cache_follows_the_file(config_file, monkeypatch):
+    path, data = config_file
+    monkeypatch.setattr(file_util, 'config_cache_enabled', True)
+    file_util.ConfigStore(path).get('name')
+
+    with open(path, 'a') as fh:
+        fh.write('extra: value\n')
+    assert file_util.read_yaml_cache(path, file_util.get_file_stamp(path)) is None
+    assert file_util.ConfigStore(path).get('extra') == 'value'
+
+    with open(file_util.get_yaml_cache_file(path), 'wb') as fh:
+        fh.write(b'garbage')
+    assert file_util.ConfigStore(path).get('extra') == 'value'